@@ -1,7 +1,9 @@
 import uuid
 import logging
+import threading
 from os import path
 from datetime import datetime
+from collections import OrderedDict
 
 from indra.statements import Agent, Statement, stmts_from_json
 from indra.assemblers.html import HtmlAssembler
@@ -31,6 +33,10 @@ class Bioagent(KQMLModule):
     converter = CLJsonConverter(token_bools=True)
 
     def __init__(self, **kwargs):
+        # Messages are also sent from other threads than the dispatcher,
+        # for instance once figures are rendered in the background, so
+        # writing them to the output stream is serialized
+        self._send_lock = threading.Lock()
         super(Bioagent, self).__init__(name=self.name, **kwargs)
         self.my_log_file = self._add_log_file()
         for task in self.tasks:
@@ -154,6 +160,10 @@ class Bioagent(KQMLModule):
         self.reply(msg, reply_msg)
         return
 
+    def send(self, msg):
+        with self._send_lock:
+            super(Bioagent, self).send(msg)
+
     def tell(self, content):
         """Send a tell message."""
         msg = KQMLPerformative('tell')
@@ -347,6 +357,50 @@ class Bioagent(KQMLModule):
         return msg
 
 
+class LRUCache(object):
+    """A thread-safe mapping holding at most maxsize items.
+
+    When a new item would exceed the size, the least recently set or
+    retrieved item is dropped.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def keys(self):
+        with self._lock:
+            return list(self._items.keys())
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
 def get_img_path(img_name):
     """Get a full path for the given image name.
 
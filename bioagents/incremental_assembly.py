@@ -0,0 +1,177 @@
+"""Incremental assembly of PySB models from INDRA Statements.
+
+Dialogues typically lead to a sequence of models in which each one extends
+the previous one by a few statements. The IncrementalAssembler keeps
+recently assembled models and, when asked to assemble a superset of the
+statements of one of them, assembles only the new statements and merges
+them into a copy of the earlier model. If the new statements could change
+how the earlier ones are assembled, the model is assembled from scratch.
+"""
+import logging
+from copy import deepcopy
+from indra.statements import ActiveForm
+from indra.assemblers.pysb import PysbAssembler
+from bioagents import LRUCache
+
+logger = logging.getLogger('IncrementalAssembly')
+
+
+def get_stmt_key(stmt):
+    """Return a key of a statement which determines the model assembled
+    from it, independent of its evidence."""
+    return '%s %s' % (stmt.get_hash(shallow=True), stmt)
+
+
+class IncrementalAssembler(object):
+    """Assemble PySB models, reusing models assembled earlier.
+
+    Parameters
+    ----------
+    policies : str
+        The assembly policies passed to PysbAssembler.make_model.
+    default_initial : float
+        The default initial amount of each monomer.
+    cache_size : int
+        The number of models to keep.
+    """
+    def __init__(self, policies='one_step', default_initial=100.0,
+                 cache_size=16):
+        self.policies = policies
+        self.default_initial = default_initial
+        # Entries are (model, has_active_forms) by the set of statement keys
+        self.models = LRUCache(cache_size)
+
+    def assemble(self, stmts, base=None):
+        """Return a model of the statements, which the caller may modify."""
+        return deepcopy(self.get_model(stmts, base))
+
+    def get_model(self, stmts, base=None):
+        """Return a model of the statements, which is shared and must not be
+        modified.
+
+        Parameters
+        ----------
+        stmts : list[indra.statements.Statement]
+            The statements to assemble.
+        base : tuple or None
+            A list of statements and their model returned earlier by this
+            method, which is extended if stmts are a superset of them.
+            Otherwise the largest cached model of a subset of stmts is
+            extended.
+
+        Returns
+        -------
+        model : pysb.Model
+            The assembled model.
+        """
+        keys = frozenset(get_stmt_key(stmt) for stmt in stmts)
+        entry = self.models.get(keys)
+        if entry is None:
+            if base is not None:
+                base_stmts, base_model = base
+                base = (frozenset(get_stmt_key(stmt) for stmt in base_stmts),
+                        base_model)
+                if base[0] == keys:
+                    return base_model
+            entry = self._assemble(stmts, keys, base)
+            self.models[keys] = entry
+        else:
+            logger.info('Using cached model of %d statements.' % len(stmts))
+        return entry[0]
+
+    def assemble_full(self, stmts):
+        """Return a model of the statements assembled from scratch."""
+        pa = PysbAssembler()
+        pa.add_statements(stmts)
+        model = pa.make_model(policies=self.policies)
+        pa.add_default_initial_conditions(self.default_initial)
+        return model
+
+    def _assemble(self, stmts, keys, base=None):
+        has_active_forms = any(isinstance(stmt, ActiveForm)
+                               for stmt in stmts)
+        # We extend the given base model or else the largest cached model
+        # of a subset of the statements
+        if base is not None and base[0] < keys:
+            base_keys, base_model = base
+        else:
+            base_keys = max((other for other in self.models.keys()
+                             if other < keys), key=len, default=None)
+            if base_keys is not None:
+                base_model, _ = self.models.get(base_keys)
+        if base_keys is not None and not has_active_forms:
+            new_stmts = [stmt for stmt in stmts
+                         if get_stmt_key(stmt) not in base_keys]
+            model = extend_model(base_model, self.assemble_full(new_stmts))
+            if model is not None:
+                logger.info('Assembled %d new statements incrementally.' %
+                            len(new_stmts))
+                return model, has_active_forms
+        return self.assemble_full(stmts), has_active_forms
+
+
+def extend_model(base_model, new_model):
+    """Return a copy of base_model extended with the components of new_model.
+
+    None is returned if the models cannot be merged without assembling them
+    together, that is, if the new model uses sites or states of monomers
+    that the base model does not have, has components other than
+    monomers, parameters, rules and initial conditions, or has rules or
+    parameters with the names of components of the base model. The new
+    model is consumed in the process.
+    """
+    if new_model.expressions or new_model.observables or \
+            new_model.compartments:
+        return None
+    for monomer in new_model.monomers:
+        base_monomer = base_model.monomers.get(monomer.name)
+        if base_monomer is None:
+            continue
+        if not set(monomer.sites) <= set(base_monomer.sites):
+            return None
+        for site, states in monomer.site_states.items():
+            if not set(states) <= \
+                    set(base_monomer.site_states.get(site, [])):
+                return None
+
+    existing_monomers = {monomer.name for monomer in base_model.monomers}
+    # Initial conditions (and their parameters) of monomers that are
+    # already in the model are kept as they are
+    skipped_params = set()
+    for initial in new_model.initials:
+        monomer_names = {mp.monomer.name for mp in
+                         initial.pattern.monomer_patterns}
+        if monomer_names & existing_monomers:
+            skipped_params.add(initial.value.name)
+    # Assembled together, a rule with the name of an existing one would be
+    # skipped and a parameter would be numbered after the existing ones
+    component_names = set(base_model.all_components().keys())
+    for component in list(new_model.parameters) + list(new_model.rules):
+        if component.name in component_names and \
+                component.name not in skipped_params:
+            return None
+
+    model = deepcopy(base_model)
+    for monomer in new_model.monomers:
+        if monomer.name not in existing_monomers:
+            model.add_component(monomer)
+    for param in new_model.parameters:
+        if param.name in skipped_params:
+            continue
+        model.add_component(param)
+    for rule in new_model.rules:
+        for cp in rule.reactant_pattern.complex_patterns + \
+                rule.product_pattern.complex_patterns:
+            for mp in cp.monomer_patterns:
+                mp.monomer = model.monomers[mp.monomer.name]
+        model.add_component(rule)
+    for initial in new_model.initials:
+        if initial.value.name not in skipped_params:
+            model.add_initial(initial)
+    for annotation in new_model.annotations:
+        subject_name = getattr(annotation.subject, 'name', None)
+        if subject_name in existing_monomers and \
+                annotation.subject is not model.monomers[subject_name]:
+            continue
+        model.add_annotation(annotation)
+    return model
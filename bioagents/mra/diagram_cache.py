@@ -0,0 +1,132 @@
+"""An on-disk cache of the diagrams of models.
+
+Making the diagrams of a model involves BioNetGen, Kappa and graphviz, and
+coloring SBGN may query the context of the cell line, yet the same model is
+often revisited in a dialogue, for instance by undoing a change. Diagrams
+are therefore cached on disk by a key of the content of the model, that is,
+the statements it is assembled from and the assembly settings, along with
+the cell line for colored SBGN. The least recently used diagrams are
+removed when the cache exceeds its size.
+"""
+import os
+import shutil
+import hashlib
+import logging
+import threading
+from bioagents.settings import IMAGE_DIR
+from bioagents.incremental_assembly import get_stmt_key
+
+logger = logging.getLogger('DiagramCache')
+
+
+class DiagramCache(object):
+    """A size-bounded cache of model diagrams in a directory.
+
+    Parameters
+    ----------
+    cache_dir : str or None
+        The directory of the cache, by default diagram_cache in the image
+        directory.
+    max_size : int
+        The largest total size of the cached diagrams, in bytes.
+    """
+    def __init__(self, cache_dir=None, max_size=100000000):
+        self.cache_dir = cache_dir if cache_dir else \
+            os.path.join(IMAGE_DIR, 'diagram_cache')
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def get(self, key, diagram_type, fname=None):
+        """Return a cached diagram, or None if it is not cached.
+
+        Parameters
+        ----------
+        key : str
+            The key of the model.
+        diagram_type : str
+            The type of the diagram.
+        fname : str or None
+            The path to copy a cached image to. If None, the path of the
+            image in the cache is returned.
+
+        Returns
+        -------
+        diagram : str or None
+            The path of an image, or the XML of SBGN.
+        """
+        cache_path = self._get_cache_path(key, diagram_type)
+        with self._lock:
+            try:
+                # The modification time tracks the last use of an entry
+                os.utime(cache_path, None)
+                if diagram_type == 'sbgn':
+                    with open(cache_path, 'rb') as fh:
+                        return fh.read().decode('utf-8')
+                if fname is None:
+                    return cache_path
+                shutil.copyfile(cache_path, fname)
+                return fname
+            except (IOError, OSError):
+                return None
+
+    def put(self, key, diagram_type, diagram):
+        """Add a diagram, the path of an image or SBGN, to the cache."""
+        if not diagram:
+            return
+        cache_path = self._get_cache_path(key, diagram_type)
+        tmp_path = '%s.%d.tmp' % (cache_path, threading.get_ident())
+        with self._lock:
+            try:
+                if diagram_type == 'sbgn':
+                    if not isinstance(diagram, bytes):
+                        diagram = diagram.encode('utf-8')
+                    with open(tmp_path, 'wb') as fh:
+                        fh.write(diagram)
+                else:
+                    shutil.copyfile(diagram, tmp_path)
+                os.replace(tmp_path, cache_path)
+            except (IOError, OSError) as e:
+                logger.error('Could not cache %s diagram.' % diagram_type)
+                logger.exception(e)
+                return
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            for fname in os.listdir(self.cache_dir):
+                os.remove(os.path.join(self.cache_dir, fname))
+
+    def _get_cache_path(self, key, diagram_type):
+        ext = 'sbgn' if diagram_type == 'sbgn' else 'png'
+        return os.path.join(self.cache_dir,
+                            '%s_%s.%s' % (key, diagram_type, ext))
+
+    def _evict(self):
+        # Remove the least recently used entries until the cache fits
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+
+
+def get_model_key(stmts, *settings):
+    """Return a key of the model assembled from statements with the given
+    settings, independent of the order of the statements."""
+    stmt_keys = sorted(get_stmt_key(stmt) for stmt in stmts)
+    key_str = '\n'.join(stmt_keys + [repr(settings)])
+    return hashlib.md5(key_str.encode('utf-8')).hexdigest()
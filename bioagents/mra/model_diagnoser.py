@@ -1,8 +1,7 @@
 import logging
-import itertools
 from copy import deepcopy
 import networkx as nx
-from indra.mechlinker import MechLinker
+from indra.mechlinker import MechLinker, BaseAgentSet
 from indra.statements import *
 from indra.sources.indra_db_rest import get_statements
 from indra.explanation.model_checker import PysbModelChecker
@@ -14,33 +13,41 @@ logger = logging.getLogger('model_diagnoser')
 
 
 class ModelDiagnoser(object):
-    def __init__(self, statements, model=None, explain=None):
+    def __init__(self, statements, model=None, explain=None,
+                 model_checker=None, activity_linker=None):
         self.statements = statements
         self.model = model
         self.explain = explain
+        # A model checker of the model for the explanation goal, which may
+        # be shared along with its influence map
+        self.model_checker = model_checker
+        # The activities of the agents of the statements, which may be
+        # shared
+        self.activity_linker = activity_linker
+
+    def get_model_checker(self):
+        if self.model_checker is None:
+            self.model_checker = PysbModelChecker(self.model, [self.explain])
+        return self.model_checker
 
     def get_missing_activities(self):
-        ml = MechLinker(self.statements)
-        ml.gather_explicit_activities()
+        if self.activity_linker is None:
+            self.activity_linker = ActivityLinker(self.statements)
         suggestions = []
-        for stmt in self.statements:
-            if isinstance(stmt, (Modification, RegulateActivity,
-                                 RegulateAmount)):
-                # The subj here is in an "active" position
-                subj, obj = stmt.agent_list()
-                if subj is None:
-                    continue
-                subj_base = ml._get_base(subj)
-                # If it has any activities but isn't in an active state
-                # here
-                if subj_base.activity_types and not subj.activity:
-                    # We suggest making the subj active in this case
-                    suggestion = deepcopy(stmt)
-                    act_type = subj_base.activity_types[0]
-                    new_subj = deepcopy(subj)
-                    new_subj.activity = ActivityCondition(act_type, True)
-                    suggestion.set_agent_list([new_subj, obj])
-                    suggestions.append(suggestion)
+        for stmt in self.activity_linker.inactive_subj_stmts:
+            # The subj here is in an "active" position
+            subj, obj = stmt.agent_list()
+            activity_types = self.activity_linker.get_activity_types(subj)
+            # If it has any activities but isn't in an active state
+            # here
+            if activity_types:
+                # We suggest making the subj active in this case
+                suggestion = deepcopy(stmt)
+                act_type = activity_types[0]
+                new_subj = deepcopy(subj)
+                new_subj.activity = ActivityCondition(act_type, True)
+                suggestion.set_agent_list([new_subj, obj])
+                suggestions.append(suggestion)
         return suggestions
 
     def check_explanation(self):
@@ -49,7 +56,7 @@ class ModelDiagnoser(object):
         if self.explain is None:
             raise ValueError('check_explanation requires an explanation goal.')
         result = {}
-        mc = PysbModelChecker(self.model, [self.explain])
+        mc = self.get_model_checker()
         try:
             pr = mc.check_statement(self.explain, max_paths=0)
             result['has_explanation'] = pr.path_found
@@ -82,24 +89,15 @@ class ModelDiagnoser(object):
             if source_rules and obs_names:
                 new_edges = [('SOURCE', sr) for sr in source_rules]
                 new_edges += [(on, 'TARGET') for on in obs_names]
-                im = mc.get_im()
+                # The influence map is copied since the model checker may
+                # be reused
+                im = mc.get_im().copy()
                 im.add_edges_from(new_edges)
                 # Now, we know that there is no path between SOURCE and TARGET.
                 # Instead, we consider connections among all possible pairs
                 # of nodes in the graph and count the number of nodes in
                 # the path between source and target:
-                best_edge = (None, 0)
-                for u, v in itertools.permutations(im.nodes(), 2):
-                    # Add the edge to the graph
-                    im.add_edge(u, v)
-                    # Find longest path between source and target
-                    simple_paths = list(nx.all_simple_paths(im, 'SOURCE',
-                                                            'TARGET'))
-                    simple_paths.sort(key=lambda p: len(p), reverse=True)
-                    if simple_paths and len(simple_paths[0]) > best_edge[1]:
-                        best_edge = ((u, v), len(simple_paths[0]))
-                    # Now remove the edge we added before going on to the next
-                    im.remove_edge(u, v)
+                best_edge = get_best_edge(im, 'SOURCE', 'TARGET')
                 if best_edge[0]:
                     result['connect_rules'] = best_edge[0]
                     u_stmt = stmt_from_rule(best_edge[0][0], self.model,
@@ -135,3 +133,152 @@ class ModelDiagnoser(object):
         stmts.sort(key=lambda s: len(s.evidence), reverse=True)
         end_ix = len(stmts) if len(stmts) < num_statements else num_statements
         return stmts[0:end_ix], subj_agent, obj_agent
+
+
+class ActivityLinker(object):
+    """The explicit activities of the agents of statements, as gathered by
+    MechLinker, along with the statements whose subject is in an active
+    position but not in an active state.
+
+    Statements can be added without scanning the earlier ones again, and
+    an ActivityLinker of a model can be extended into one of a model with
+    more statements.
+
+    Parameters
+    ----------
+    stmts : list[indra.statements.Statement] or None
+        The statements to gather activities from.
+    """
+    def __init__(self, stmts=None):
+        self.base_agents = BaseAgentSet()
+        self.inactive_subj_stmts = []
+        if stmts:
+            self.add_statements(stmts)
+
+    def add_statements(self, stmts):
+        """Gather the activities of the agents of statements."""
+        ml = MechLinker(stmts)
+        ml.base_agents = self.base_agents
+        ml.gather_explicit_activities()
+        for stmt in stmts:
+            if isinstance(stmt, (Modification, RegulateActivity,
+                                 RegulateAmount)):
+                subj = stmt.agent_list()[0]
+                if subj is not None and not subj.activity:
+                    self.inactive_subj_stmts.append(stmt)
+
+    def extend(self, stmts):
+        """Return a new ActivityLinker of the statements of this one
+        followed by stmts.
+
+        The base agents are shared with this linker, except for those of
+        the agents of stmts, which are copied since they may be updated.
+        """
+        linker = ActivityLinker()
+        linker.base_agents.agents = dict(self.base_agents.agents)
+        names = {agent.name for stmt in stmts for agent in stmt.agent_list()
+                 if agent is not None}
+        for name in names & set(linker.base_agents.keys()):
+            linker.base_agents.agents[name] = \
+                deepcopy(self.base_agents[name])
+        linker.inactive_subj_stmts = list(self.inactive_subj_stmts)
+        linker.add_statements(stmts)
+        return linker
+
+    def get_activity_types(self, agent):
+        """Return the activity types of an agent, in the order they were
+        found.
+
+        The base agents may be shared with extended linkers, so agents
+        without activities are looked up without adding them.
+        """
+        try:
+            return self.base_agents[agent.name].activity_types
+        except KeyError:
+            return []
+
+
+def get_best_edge(graph, source, target):
+    """Return the edge which, added to a graph, yields the longest path
+    from source to target.
+
+    The longest paths from the source to each node and from each node to
+    the target are computed once on the condensation of the graph, so that
+    each candidate edge is scored in constant time. Paths are measured in
+    nodes, and a path through a strongly connected component is counted
+    as if it visited all of its nodes. An edge only yields a path if the
+    longest path to its start and the longest path from its end share no
+    component. The result is exact if the graph is acyclic and the source
+    is not connected to the target yet, otherwise the path found through
+    an edge may be shorter than the longest one through it, since shorter
+    paths to its start or from its end are not tried.
+
+    Parameters
+    ----------
+    graph : networkx.DiGraph
+        The graph, containing the source and the target.
+    source : str
+        The source node.
+    target : str
+        The target node.
+
+    Returns
+    -------
+    best_edge : tuple
+        The edge (u, v), or None if no edge yields a path, and the number
+        of nodes on the longest path from source to target with it added.
+    """
+    cond = nx.condensation(graph)
+    mapping = cond.graph['mapping']
+    order = list(nx.topological_sort(cond))
+    sizes = {comp: len(cond.nodes[comp]['members']) for comp in cond}
+    from_source, source_paths = \
+        _get_longest_paths(cond, order, mapping[source], sizes,
+                           cond.predecessors)
+    to_target, target_paths = \
+        _get_longest_paths(cond, list(reversed(order)), mapping[target],
+                           sizes, cond.successors)
+    nodes = list(graph.nodes())
+    best_edge = (None, 0)
+    # If the source is already connected to the target, adding any edge
+    # keeps that path, and the first candidate edge is as good as any
+    # that doesn't yield a longer one
+    base_len = from_source.get(mapping[target], 0)
+    if base_len and len(nodes) > 1:
+        best_edge = ((nodes[0], nodes[1]), base_len)
+    # Candidate edges are scored in the order of the pairs of nodes, keeping
+    # the first edge with the longest path
+    us = [node for node in nodes if mapping[node] in from_source]
+    vs = [node for node in nodes if mapping[node] in to_target]
+    for u in us:
+        u_comp = mapping[u]
+        for v in vs:
+            if u == v:
+                continue
+            v_comp = mapping[v]
+            # The paths can only meet if the source is connected to the
+            # target, e.g. if the edge closes a cycle through that path
+            if source_paths[u_comp] & target_paths[v_comp]:
+                continue
+            path_len = from_source[u_comp] + to_target[v_comp]
+            if path_len > best_edge[1]:
+                best_edge = ((u, v), path_len)
+    return best_edge
+
+
+def _get_longest_paths(cond, order, start, sizes, get_neighbors):
+    # The number of nodes on the longest path from the start component to
+    # each component reachable from it, following the given order, and
+    # the components on that path as the bits of an integer
+    lengths = {start: sizes[start]}
+    paths = {start: 1 << start}
+    for comp in order:
+        if comp == start:
+            continue
+        prev_comps = [neighbor for neighbor in get_neighbors(comp)
+                      if neighbor in lengths]
+        if prev_comps:
+            prev_comp = max(prev_comps, key=lambda c: lengths[c])
+            lengths[comp] = lengths[prev_comp] + sizes[comp]
+            paths[comp] = paths[prev_comp] | (1 << comp)
+    return lengths, paths
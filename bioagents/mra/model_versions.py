@@ -0,0 +1,117 @@
+"""A tree of the versions of the models built by MRA.
+
+Each operation on a model (building, expanding, removing statements and
+undoing) creates a new version of it, and versions typically differ from
+the one they were derived from by a few statements. A version is therefore
+stored only as the statements it adds to and removes from its parent
+version, by hash, and each distinct statement is stored once. The
+statements of a version are materialized from the deltas along its path
+in the tree when they are requested, and the most recently requested
+versions are kept materialized.
+"""
+from bioagents import LRUCache
+
+
+class ModelVersions(object):
+    """The statements of model versions, by model ID.
+
+    Parameters
+    ----------
+    cache_size : int
+        The number of materialized versions to keep.
+    """
+    def __init__(self, cache_size=16):
+        # Statements by hash
+        self.stmts = {}
+        # The parent ID and the hashes of the statements added and removed
+        # by model ID
+        self.versions = {}
+        self._materialized = LRUCache(cache_size)
+
+    def add_version(self, model_id, parent_id, added, removed=None):
+        """Add a version of a model.
+
+        Parameters
+        ----------
+        model_id : int
+            The ID of the new version.
+        parent_id : int or None
+            The ID of the version the new one is derived from, or None if
+            it is a new model.
+        added : list[indra.statements.Statement]
+            The statements added to the parent version, in order.
+        removed : list[indra.statements.Statement] or None
+            The statements of the parent version that are removed.
+        """
+        if parent_id is not None and parent_id not in self.versions:
+            raise KeyError(parent_id)
+        added_hashes = tuple(self._intern(stmt) for stmt in added)
+        removed_hashes = frozenset(get_stmt_hash(stmt)
+                                   for stmt in (removed or []))
+        self.versions[model_id] = (parent_id, added_hashes, removed_hashes)
+
+    def get_parent(self, model_id):
+        """Return the ID of the version a version was derived from."""
+        return self.versions[model_id][0]
+
+    def get_delta(self, model_id):
+        """Return the statements a version adds to its parent version and
+        those of the parent version it removes."""
+        _, added, removed = self.versions[model_id]
+        return [self.stmts[stmt_hash] for stmt_hash in added], \
+            [self.stmts[stmt_hash] for stmt_hash in removed
+             if stmt_hash in self.stmts]
+
+    def __getitem__(self, model_id):
+        """Return the statements of a version, which must not be
+        modified."""
+        stmts = self._materialized.get(model_id)
+        if stmts is not None:
+            return stmts
+        if model_id not in self.versions:
+            raise KeyError(model_id)
+        # Find the path to the closest materialized ancestor, if any, and
+        # apply the deltas along it
+        path = []
+        hashes = []
+        version_id = model_id
+        while version_id is not None:
+            stmts = self._materialized.get(version_id)
+            if stmts is not None:
+                hashes = [get_stmt_hash(stmt) for stmt in stmts]
+                break
+            path.append(version_id)
+            version_id = self.versions[version_id][0]
+        for version_id in reversed(path):
+            _, added, removed = self.versions[version_id]
+            if removed:
+                hashes = [stmt_hash for stmt_hash in hashes
+                          if stmt_hash not in removed]
+            hashes = hashes + list(added)
+        stmts = [self.stmts[stmt_hash] for stmt_hash in hashes]
+        self._materialized[model_id] = stmts
+        return stmts
+
+    def get(self, model_id, default=None):
+        if model_id not in self.versions:
+            return default
+        return self[model_id]
+
+    def __contains__(self, model_id):
+        return model_id in self.versions
+
+    def __len__(self):
+        return len(self.versions)
+
+    def keys(self):
+        return self.versions.keys()
+
+    def _intern(self, stmt):
+        stmt_hash = get_stmt_hash(stmt)
+        self.stmts.setdefault(stmt_hash, stmt)
+        return stmt_hash
+
+
+def get_stmt_hash(stmt):
+    """Return a hash of a statement including its evidence."""
+    return stmt.get_hash(shallow=False)
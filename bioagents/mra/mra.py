@@ -10,29 +10,60 @@ import logging
 import networkx
 import subprocess
 from datetime import datetime
+from collections import defaultdict
+from functools import partial
+from concurrent.futures import Future, ProcessPoolExecutor
 
 import kappy
 
-from bioagents import get_img_path
+from bioagents import get_img_path, LRUCache
+from bioagents.incremental_assembly import IncrementalAssembler
 from indra.sources import trips
 from indra.statements import Complex, Activation, IncreaseAmount, \
     stmts_from_json
 from indra.preassembler.hierarchy_manager import hierarchies
 from indra.assemblers.pysb import assembler as pysb_assembler
 from indra.assemblers.pysb import PysbAssembler
-from pysb.bng import BngInterfaceError
+from indra.explanation.model_checker import PysbModelChecker
+from pysb.bng import BngInterfaceError, generate_equations
 from pysb.tools import render_reactions
 
 from pysb.export import export
 from indra.assemblers.pysb.kappa_util import im_json_to_graph, cm_json_to_graph
 from bioagents.mra.sbgn_colorizer import SbgnColorizer
-from bioagents.mra.model_diagnoser import ModelDiagnoser
+from bioagents.mra.model_diagnoser import ModelDiagnoser, ActivityLinker
+from bioagents.mra.stmt_index import StatementIndex
+from bioagents.mra.model_versions import ModelVersions, get_stmt_hash
+from bioagents.mra.diagram_cache import DiagramCache, get_model_key
 logger = logging.getLogger('MRA')
 
 
+DIAGRAM_TYPES = ('reactionnetwork', 'contactmap', 'influencemap', 'sbgn')
+# The diagrams made from the reaction network generated by BioNetGen
+NETWORK_DIAGRAM_TYPES = ('reactionnetwork', 'sbgn')
+
+
 class MRA(object):
     def __init__(self):
-        self.models = {}
+        # The statements of each model version
+        self.models = ModelVersions()
+        # An index of the statements of recent model versions
+        self.stmt_indexes = LRUCache(16)
+        # The assembled PySB model of recent model versions, which is shared
+        # and not modified
+        self.model_execs = LRUCache(16)
+        self.assembler = None
+        # The process pool making diagrams, started when first needed
+        self.diagram_executor = None
+        self.diagram_cache = DiagramCache()
+        # Futures of models with their reaction network generated, by the
+        # key of the model content
+        self.reaction_networks = LRUCache(16)
+        # Model checkers of recent models for explanation goals, along with
+        # their influence maps, by the keys of the model and goal content
+        self.model_checkers = LRUCache(16)
+        # The activities of the agents of recent model versions
+        self.activity_linkers = LRUCache(16)
         self.transformations = []
         self.id_counter = 0
         self.default_policy = 'one_step'
@@ -49,12 +80,146 @@ class MRA(object):
             return True
         return False
 
+    def set_model(self, model_id, parent_id, added, removed=None,
+                  stmt_index=None):
+        """Store a model version by the statements it adds to and removes
+        from its parent version, along with an index of its statements."""
+        self.models.add_version(model_id, parent_id, added, removed)
+        self.stmt_indexes[model_id] = stmt_index if stmt_index is not None \
+            else StatementIndex(self.models[model_id])
+
+    def get_stmt_index(self, model_id):
+        """Return the index of the statements of a model version."""
+        stmt_index = self.stmt_indexes.get(model_id)
+        if stmt_index is None:
+            stmt_index = StatementIndex(self.models[model_id])
+            self.stmt_indexes[model_id] = stmt_index
+        return stmt_index
+
+    def get_assembler(self):
+        """Return the assembler of PySB models, replacing it along with the
+        models assembled so far if the assembly policy has changed."""
+        if self.assembler is None or \
+                self.assembler.policies != self.default_policy or \
+                self.assembler.default_initial != \
+                self.default_initial_amount:
+            self.assembler = IncrementalAssembler(
+                policies=self.default_policy,
+                default_initial=self.default_initial_amount)
+            self.model_execs.clear()
+        return self.assembler
+
     def assemble_pysb(self, stmts):
-        pa = PysbAssembler()
-        pa.add_statements(stmts)
-        pa.make_model(policies=self.default_policy)
-        pa.add_default_initial_conditions(self.default_initial_amount)
-        return pa.model
+        return self.get_assembler().assemble(stmts)
+
+    def get_model_exec(self, model_id, parent_id=None):
+        """Return the PySB model of a model version, which the caller may
+        modify.
+
+        The assembled models of recent versions are kept. A version that
+        adds statements to its parent version is assembled by extending the
+        model of the parent with the new statements, see
+        IncrementalAssembler. The parent defaults to the version that
+        model_id was derived from.
+        """
+        assembler = self.get_assembler()
+        model = self.model_execs.get(model_id)
+        if model is None:
+            if parent_id is None:
+                parent_id = self.models.get_parent(model_id)
+            base_model = self.model_execs.get(parent_id) \
+                if parent_id is not None else None
+            base = (self.models[parent_id], base_model) \
+                if base_model is not None else None
+            model = assembler.get_model(self.models[model_id], base)
+            self.model_execs[model_id] = model
+        return copy.deepcopy(model)
+
+    def submit_diagrams(self, model_exec, model_id):
+        """Start making the diagrams of a model version.
+
+        The diagrams are made in parallel in a pool of processes, each of
+        which gets its own copy of the model, unless they are in the
+        diagram cache.
+
+        Returns
+        -------
+        res : dict
+            The futures of the diagrams by type under 'diagrams' and the
+            paths the images are written to by type under 'diagram_paths'.
+        """
+        if self.diagram_executor is None:
+            self.diagram_executor = \
+                ProcessPoolExecutor(max_workers=len(DIAGRAM_TYPES))
+        stmts = self.models[model_id]
+        model_key = get_model_key(stmts, self.default_policy,
+                                  self.default_initial_amount)
+        paths = get_diagram_paths(model_id)
+        # The reaction network of a model is generated once, along with
+        # its first diagrams, and reused for later ones
+        network_future = self.reaction_networks.get(model_key)
+        if network_future is not None and network_future.done() and \
+                network_future.exception() is None and \
+                network_future.result() is not None:
+            model_exec = network_future.result()
+        else:
+            network_future = None
+        futures, new_network_future = \
+            submit_diagrams(self.diagram_executor, model_exec, model_id,
+                            stmts, self.context, paths, self.diagram_cache,
+                            model_key)
+        if network_future is None and new_network_future is not None:
+            self.reaction_networks[model_key] = new_network_future
+        return {'diagrams': futures, 'diagram_paths': paths}
+
+    def shutdown(self):
+        """Shut down the process pool making diagrams, if started."""
+        if self.diagram_executor is not None:
+            self.diagram_executor.shutdown(wait=False)
+            self.diagram_executor = None
+
+    def get_model_checker(self, model_stmts, model_exec):
+        """Return a model checker of a model for the explanation goal.
+
+        A model checker generates the influence map of its model with the
+        Kappa static analyzer when first used, so the checkers of recent
+        models are kept and shared by the checks of the model diagnoser.
+        A model checker only checks the goal it was made for, so checkers
+        are kept by the content of both the model and the goal. The goal
+        of a shared checker may be an equal copy of the current one, and
+        is the one to check with it.
+        """
+        model_key = get_model_key(model_stmts, self.default_policy,
+                                  self.default_initial_amount)
+        key = (model_key, self.explain.matches_key())
+        mc = self.model_checkers.get(key)
+        if mc is None:
+            # The model checker adds observables to its own copy of the
+            # model
+            mc = PysbModelChecker(copy.deepcopy(model_exec), [self.explain])
+            self.model_checkers[key] = mc
+        return mc
+
+    def get_activity_linker(self, model_id):
+        """Return the activities of the agents of a model version, which
+        are shared and must not be modified.
+
+        The activities of a version that only adds statements to its
+        parent version are gathered from the new statements if those of
+        the parent are kept.
+        """
+        linker = self.activity_linkers.get(model_id)
+        if linker is None:
+            parent_id = self.models.get_parent(model_id)
+            added, removed = self.models.get_delta(model_id)
+            parent_linker = self.activity_linkers.get(parent_id) \
+                if parent_id is not None and not removed else None
+            if parent_linker is not None:
+                linker = parent_linker.extend(added)
+            else:
+                linker = ActivityLinker(self.models[model_id])
+            self.activity_linkers[model_id] = linker
+        return linker
 
     # BUILD / EXPAND / REMOVE / UNDO
 
@@ -71,11 +236,10 @@ class MRA(object):
             return res
         ambiguities = get_ambiguities(tp)
         res['ambiguities'] = ambiguities
-        model_exec = self.assemble_pysb(stmts)
+        model_exec = self.get_model_exec(model_id)
         res['model_exec'] = model_exec
-        res['diagrams'] = make_diagrams(model_exec, model_id,
-                                        self.models[model_id], self.context)
-        self.run_diagnoser(res, stmts, model_exec)
+        res.update(self.submit_diagrams(model_exec, model_id))
+        self.run_diagnoser(res, model_id, model_exec)
         return res
 
     def build_model_from_json(self, model_json):
@@ -89,11 +253,10 @@ class MRA(object):
                'model': stmts}
         if not stmts:
             return res
-        model_exec = self.assemble_pysb(stmts)
+        model_exec = self.get_model_exec(model_id)
         res['model_exec'] = model_exec
-        res['diagrams'] = make_diagrams(model_exec, model_id,
-                                        self.models[model_id], self.context)
-        self.run_diagnoser(res, stmts, model_exec)
+        res.update(self.submit_diagrams(model_exec, model_id))
+        self.run_diagnoser(res, model_id, model_exec)
         return res
 
     def expand_model_from_ekb(self, model_ekb, model_id):
@@ -113,12 +276,10 @@ class MRA(object):
         ambiguities = get_ambiguities(tp)
         res['ambiguities'] = ambiguities
         res['model_new'] = new_stmts
-        model_exec = self.assemble_pysb(model_stmts)
+        model_exec = self.get_model_exec(new_model_id, model_id)
         res['model_exec'] = model_exec
-        res['diagrams'] = make_diagrams(model_exec, new_model_id,
-                                        self.models[new_model_id],
-                                        self.context)
-        self.run_diagnoser(res, model_stmts, model_exec)
+        res.update(self.submit_diagrams(model_exec, new_model_id))
+        self.run_diagnoser(res, new_model_id, model_exec)
         return res
 
     def expand_model_from_json(self, model_json, model_id):
@@ -137,68 +298,73 @@ class MRA(object):
         if not model_stmts:
             return res
         res['model_new'] = new_stmts
-        model_exec = self.assemble_pysb(model_stmts)
+        model_exec = self.get_model_exec(new_model_id, model_id)
         res['model_exec'] = model_exec
-        res['diagrams'] = make_diagrams(model_exec, new_model_id,
-                                        self.models[new_model_id],
-                                        self.context)
-        self.run_diagnoser(res, model_stmts, model_exec)
+        res.update(self.submit_diagrams(model_exec, new_model_id))
+        self.run_diagnoser(res, new_model_id, model_exec)
         return res
 
     def extend_model(self, new_stmts, model_id):
-        # Lists to keep track of types of statements by their
-        # relation compared to the old set of statements
+        # Sets of the hashes of new statements to keep track of their
+        # relation compared to the old set of statements. Only the old
+        # statements that the index finds related to a new statement need
+        # to be compared to it, so only their matches keys are computed.
         old_stmts = self.models[model_id]
+        index = self.get_stmt_index(model_id)
+        new_by_old = defaultdict(list)
+        for j, nst in enumerate(new_stmts):
+            for i in index.get_candidates(nst):
+                new_by_old[i].append(j)
+        new_keys = [nst.matches_key() for nst in new_stmts]
+        new_hashes = [get_stmt_hash(nst) for nst in new_stmts]
         stmts_old_to_propagate = []
-        stmts_old_matched = []
         stmts_old_refined = []
-        stmts_old_refinement = []
         stmts_new_to_add = []
-        stmts_new_refined = []
-        stmts_new_matched = []
+        new_to_add = set()
+        new_refined = set()
+        new_matched = set()
         # Look at each old statement and determine the relationship
-        # of each new statement with respect to it
-        for ost in old_stmts:
-            for nst in new_stmts:
+        # of each related new statement with respect to it
+        for i, ost in enumerate(old_stmts):
+            old_refined = False
+            related_new = new_by_old.get(i, [])
+            old_key = ost.matches_key() if related_new else None
+            for j in related_new:
+                nst = new_stmts[j]
                 # The old and the new statements are exact matches
                 # We propagate the old one
-                if ost.matches(nst):
-                    if ost not in stmts_old_matched:
-                        stmts_old_matched.append(ost)
-                    if nst not in stmts_new_matched:
-                        stmts_new_matched.append(nst)
+                if old_key == new_keys[j]:
+                    new_matched.add(new_hashes[j])
                 # The old statement is a refinement of the new one
                 # We propagate the old one
                 elif ost.refinement_of(nst, hierarchies):
-                    if ost not in stmts_old_refinement:
-                        stmts_old_refinement.append(ost)
-                    if nst not in stmts_new_refined:
-                        stmts_new_refined.append(nst)
+                    new_refined.add(new_hashes[j])
                 # The new statement is a refinement of the old one
                 # We add the new statement and don't propagate the old one
                 elif nst.refinement_of(ost, hierarchies):
-                    if ost not in stmts_old_refined:
-                        stmts_old_refined.append(ost)
-                    if nst not in stmts_new_to_add:
+                    old_refined = True
+                    if new_hashes[j] not in new_to_add:
+                        new_to_add.add(new_hashes[j])
                         stmts_new_to_add.append(nst)
-                # Otherwise there is no relation so the old statement
-                # won't be added to any of the lists above for this
-                # new statement
             # Unless the old statement is refined, it is propagated
-            if ost not in stmts_old_refined:
+            if not old_refined:
                 stmts_old_to_propagate.append(ost)
+            else:
+                stmts_old_refined.append(ost)
 
         # Add any new Statement that has not already been added
         # or is not matched or refined by an old statement
-        for nst in new_stmts:
-            if nst not in stmts_new_refined + stmts_new_matched + \
-                    stmts_new_to_add:
+        for nst, nst_hash in zip(new_stmts, new_hashes):
+            if nst_hash not in new_refined and nst_hash not in new_matched \
+                    and nst_hash not in new_to_add:
+                new_to_add.add(nst_hash)
                 stmts_new_to_add.append(nst)
 
         logger.debug('Statements to propagate: %s' % stmts_old_to_propagate)
         logger.debug('Statements to add: %s' % stmts_new_to_add)
         new_model_id = self.get_new_id()
-        self.models[new_model_id] = stmts_old_to_propagate + stmts_new_to_add
+        self.set_model(new_model_id, model_id, stmts_new_to_add,
+                       stmts_old_refined)
         # FIXME: Would undo-s work after a refinement?
         self.transformations.append(('add_stmts', stmts_new_to_add, model_id,
                                      new_model_id))
@@ -213,30 +379,30 @@ class MRA(object):
         logger.info('Removing statements: %s' % rem_stmts)
 
         model_stmts = self.models[model_id]
-        # Statements that are matched in the model and will be removed
-        stmts_old_to_remove = []
-        # Statements to be removed that are matched in the model
-        stmts_rem_matched = []
-        for ost in model_stmts:
-            for rst in rem_stmts:
-                if ost.refinement_of(rst, hierarchies):
-                    if ost not in stmts_old_to_remove:
-                        stmts_old_to_remove.append(ost)
-                    if rst not in stmts_rem_matched:
-                        stmts_rem_matched.append(rst)
+        stmt_index = self.get_stmt_index(model_id)
+        # The indices of the statements that are matched in the model and
+        # will be removed
+        old_to_remove = set()
         # Statements that to be removed that didn't have any matching
         # Statements in the model
-        stmts_rem_unmatched = [st for st in rem_stmts if st not in
-                               stmts_rem_matched]
-        # Statements in the model that weren't matched by and to-remove
-        # Statements and therefore remain in the model.
-        stmts_old_propagate = [st for st in model_stmts if st not in
-                               stmts_old_to_remove]
-        # Make a new model ID
+        stmts_rem_unmatched = []
+        for rst in rem_stmts:
+            refinements = stmt_index.get_refinements(rst)
+            if refinements:
+                old_to_remove.update(refinements)
+            else:
+                stmts_rem_unmatched.append(rst)
+        stmts_old_to_remove = [model_stmts[idx]
+                               for idx in sorted(old_to_remove)]
+        # Make a new model ID, in which the statements in the model that
+        # weren't matched by any to-remove Statements remain
         # FIXME: this should result in a proper remove transformation added
         #  to the set of transformations.
-        new_model_id = self.new_model(stmts_old_propagate)
-        model_exec = self.assemble_pysb(self.models[new_model_id])
+        new_model_id = self.get_new_id()
+        self.set_model(new_model_id, model_id, [], stmts_old_to_remove)
+        self.transformations.append(('add_stmts', self.models[new_model_id],
+                                     None, new_model_id))
+        model_exec = self.get_model_exec(new_model_id, model_id)
         res = {'model_id': new_model_id, 'model': self.models[new_model_id],
                'model_exec': model_exec}
         if stmts_old_to_remove:
@@ -244,9 +410,7 @@ class MRA(object):
         if stmts_rem_unmatched:
             res['remove_unmatched'] = stmts_rem_unmatched
         if self.models[new_model_id]:
-            res['diagrams'] = make_diagrams(model_exec, new_model_id,
-                                            self.models[new_model_id],
-                                            self.context)
+            res.update(self.submit_diagrams(model_exec, new_model_id))
         return res
 
     def model_undo(self):
@@ -261,7 +425,7 @@ class MRA(object):
                                'reason': 'NO_ACTIONS'}}
         # Or we got an action that we don't know how to undo
         elif forward_action[0] != 'add_stmts':
-            new_model_id = self.id_counter
+            new_model_id = old_model_id = self.id_counter
             stmts = self.models[self.id_counter] \
                 if self.id_counter else []
             undo_action = {'action': 'no_op', 'statements': [],
@@ -274,36 +438,39 @@ class MRA(object):
             new_model_id = self.get_new_id()
             stmts = self.models[old_model_id] \
                 if old_model_id is not None else []
-            self.models[new_model_id] = stmts
+            # The statements are those of the old version, so its index
+            # can be shared
+            self.set_model(new_model_id, old_model_id, [],
+                           stmt_index=self.stmt_indexes.get(old_model_id))
             undo_action = {'action': 'remove_stmts', 'statements': stmts_added}
 
         res = {'model_id': new_model_id,
                'model': stmts,
                'action': undo_action}
 
-        model_exec = self.assemble_pysb(stmts)
         if not stmts:
             return res
+        model_exec = self.get_model_exec(new_model_id, old_model_id)
         res['ambiguities'] = []
-        res['diagrams'] = make_diagrams(model_exec, new_model_id,
-                                        self.models[new_model_id],
-                                        self.context)
+        res.update(self.submit_diagrams(model_exec, new_model_id))
         return res
 
     def new_model(self, stmts):
         model_id = self.get_new_id()
-        self.models[model_id] = stmts
+        self.set_model(model_id, None, stmts)
         self.transformations.append(('add_stmts', stmts, None, model_id))
         return model_id
 
     # MODEL DIAGNOSIS
 
-    def run_diagnoser(self, res, model_stmts, model_exec):
+    def run_diagnoser(self, res, model_id, model_exec):
         # Use a model diagnoser to identify explanations given the executable
         # model, the current statements, and the explanation goal
+        model_stmts = self.models[model_id]
         if self.explain:
-            md = ModelDiagnoser(model_stmts, model=model_exec,
-                                explain=self.explain)
+            mc = self.get_model_checker(model_stmts, model_exec)
+            md = ModelDiagnoser(model_stmts, model=mc.model,
+                                explain=mc.statements[0], model_checker=mc)
             md_result = md.check_explanation()
             res.update(md_result)
             # If we got a proposal for a statement, get a specific
@@ -320,7 +487,8 @@ class MRA(object):
                         res['stmt_suggestions'] = stmt_suggestions
                         res['stmt_suggestions_subj'] = sugg_subj
                         res['stmt_suggestions_obj'] = sugg_obj
-        md = ModelDiagnoser(model_stmts)
+        md = ModelDiagnoser(model_stmts,
+                            activity_linker=self.get_activity_linker(model_id))
         acts = md.get_missing_activities()
         if acts:
             logger.info('Missing activities found: %s' % acts)
@@ -335,12 +503,8 @@ class MRA(object):
             return res
         query_st = stmts[0]
         res['query'] = query_st
-        model_stmts = self.models[model_id]
-        for model_st in model_stmts:
-            if model_st.refinement_of(query_st, hierarchies):
-                res['has_mechanism'] = True
-                return res
-        res['has_mechanism'] = False
+        stmt_index = self.get_stmt_index(model_id)
+        res['has_mechanism'] = bool(stmt_index.get_refinements(query_st))
         return res
 
     def get_upstream(self, target, model_id):
@@ -408,18 +572,160 @@ def get_ambiguities(tp):
 
 
 def make_diagrams(pysb_model, model_id, current_model, context=None):
+    network_model = make_reaction_network(pysb_model)
+    if network_model is not None:
+        pysb_model = network_model
+    return {diagram_type: make_diagram(diagram_type, pysb_model, model_id,
+                                       current_model, context)
+            for diagram_type in DIAGRAM_TYPES}
+
+
+def submit_diagrams(executor, pysb_model, model_id, current_model,
+                    context=None, paths=None, cache=None, model_key=None):
+    """Submit making each diagram of a model to an executor.
+
+    The diagrams made from the reaction network of the model are made by a
+    single task, which generates the network once, unless the model
+    already has its network generated. If a cache and the key of the model
+    are given, cached diagrams are used, with images copied to their
+    paths, and the diagrams made are added to the cache.
+
+    Returns
+    -------
+    futures : dict
+        Futures of the diagrams by diagram type.
+    network_future : concurrent.futures.Future or None
+        A future of the model with its reaction network generated, if it
+        is generated, or None if it could not be.
+    """
+    paths = paths if paths is not None else get_diagram_paths(model_id)
+    futures = {}
+    network_types = []
+    for diagram_type in DIAGRAM_TYPES:
+        fname = paths.get(diagram_type)
+        key = None
+        if cache is not None and model_key is not None:
+            key = model_key if diagram_type != 'sbgn' else \
+                '%s_%s' % (model_key, get_cell_line(context))
+            diagram = cache.get(key, diagram_type, fname)
+            if diagram is not None:
+                logger.info('Using cached %s diagram.' % diagram_type)
+                futures[diagram_type] = Future()
+                futures[diagram_type].set_result(diagram)
+                continue
+        if diagram_type in NETWORK_DIAGRAM_TYPES:
+            future = Future()
+            network_types.append(diagram_type)
+        else:
+            future = executor.submit(make_diagram, diagram_type, pysb_model,
+                                     model_id, current_model, context,
+                                     fname)
+        if key is not None:
+            future.add_done_callback(
+                partial(_cache_diagram, cache, key, diagram_type))
+        futures[diagram_type] = future
+
+    network_future = None
+    if network_types:
+        task_future = executor.submit(make_network_diagrams, network_types,
+                                      pysb_model, model_id, current_model,
+                                      context, paths)
+        network_future = Future()
+        task_future.add_done_callback(
+            partial(_set_network_diagrams, network_future,
+                    {diagram_type: futures[diagram_type]
+                     for diagram_type in network_types}))
+    return futures, network_future
+
+
+def _set_network_diagrams(network_future, futures, task_future):
+    # Pass the results of a make_network_diagrams task on to the futures of
+    # the network and of each diagram
+    try:
+        diagrams, network_model = task_future.result()
+    except Exception as e:
+        network_future.set_exception(e)
+        for future in futures.values():
+            future.set_exception(e)
+        return
+    network_future.set_result(network_model)
+    for diagram_type, future in futures.items():
+        future.set_result(diagrams.get(diagram_type))
+
+
+def _cache_diagram(cache, key, diagram_type, future):
+    if not future.cancelled() and future.exception() is None:
+        cache.put(key, diagram_type, future.result())
+
+
+def make_network_diagrams(diagram_types, pysb_model, model_id, current_model,
+                          context=None, paths=None):
+    """Return diagrams of a model made from its reaction network, along
+    with the model with its network generated, or None if the network
+    could not be generated."""
+    network_model = pysb_model if pysb_model.reactions else \
+        make_reaction_network(pysb_model)
+    model = network_model if network_model is not None else pysb_model
+    diagrams = {diagram_type:
+                make_diagram(diagram_type, model, model_id, current_model,
+                             context, (paths or {}).get(diagram_type))
+                for diagram_type in diagram_types}
+    return diagrams, network_model
+
+
+def make_reaction_network(pysb_model):
+    """Return a model with its reaction network generated by BioNetGen, or
+    None if it could not be generated.
+
+    All monomers are given extended initial conditions of zero, so that
+    the network includes every species that the rules can produce. The
+    model is modified in place.
+    """
+    for m in pysb_model.monomers:
+        pysb_assembler.set_extended_initial_condition(pysb_model, m, 0)
+    try:
+        generate_equations(pysb_model)
+    except Exception as e:
+        logger.error('Could not generate reaction network.')
+        logger.error(e)
+        return None
+    return pysb_model
+
+
+def make_diagram(diagram_type, pysb_model, model_id, current_model,
+                 context=None, fname=None):
+    """Return a diagram of a model, a path to an image or an SBGN string, or
+    None if it could not be made."""
+    if diagram_type == 'reactionnetwork':
+        return draw_reaction_network(pysb_model, model_id, fname)
+    elif diagram_type == 'contactmap':
+        return draw_contact_map(pysb_model, model_id, fname)
+    elif diagram_type == 'influencemap':
+        return draw_influence_map(pysb_model, model_id, fname)
+    elif diagram_type == 'sbgn':
+        return make_colored_sbgn(pysb_model, model_id, current_model,
+                                 context)
+    raise ValueError('Unknown diagram type %s' % diagram_type)
+
+
+def get_cell_line(context):
+    """Return the CCLE cell line of a context, A375 by default."""
+    if context:
+        try:
+            return ccle_map[context]
+        except KeyError:
+            logger.info('Could not find profile info for %s cell line' %
+                        context)
+    return 'A375_SKIN'
+
+
+def make_colored_sbgn(pysb_model, model_id, current_model, context=None):
+    """Return SBGN of a model colored by the expression and mutations of
+    the genes in the cell line of the context."""
     sbgn = make_sbgn(pysb_model, model_id)
     if sbgn is not None:
         sbgn = sbgn.encode('utf-8')
-        if context:
-            try:
-                cell_line = ccle_map[context]
-            except KeyError:
-                logger.info('Could not find profile info for %s cell line' %
-                            context)
-                cell_line = 'A375_SKIN'
-        else:
-            cell_line = 'A375_SKIN'
+        cell_line = get_cell_line(context)
         try:
             logger.info('Coloring SBGN to %s cell line.' % cell_line)
             colorizer = SbgnColorizer(sbgn)
@@ -429,13 +735,7 @@ def make_diagrams(pysb_model, model_id, current_model, context=None):
         except Exception as e:
             logger.error('Could not set SBGN colors')
             logger.error(e)
-
-    rxn = draw_reaction_network(pysb_model, model_id)
-    cm = draw_contact_map(pysb_model, model_id)
-    im = draw_influence_map(pysb_model, model_id)
-    diagrams = {'reactionnetwork': rxn, 'contactmap': cm,
-                'influencemap': im, 'sbgn': sbgn}
-    return diagrams
+    return sbgn
 
 
 def make_pic_name(model_id, token):
@@ -444,6 +744,13 @@ def make_pic_name(model_id, token):
     return get_img_path(s)
 
 
+def get_diagram_paths(model_id):
+    """Return the paths of the image diagrams of a model by type."""
+    return {'reactionnetwork': make_pic_name(model_id, 'rxn') + '.png',
+            'contactmap': make_pic_name(model_id, 'cm') + '.png',
+            'influencemap': make_pic_name(model_id, 'im') + '.png'}
+
+
 def make_sbgn(pysb_model, model_id):
     pa = PysbAssembler()
     pa.model = pysb_model
@@ -457,11 +764,12 @@ def make_sbgn(pysb_model, model_id):
     return sbgn_str
 
 
-def draw_influence_map(pysb_model, model_id):
+def draw_influence_map(pysb_model, model_id, fname=None):
     """Generate a Kappa influence map, draw it and save it as a PNG."""
     try:
         im = make_influence_map(pysb_model)
-        fname = make_pic_name(model_id, 'im') + '.png'
+        if fname is None:
+            fname = make_pic_name(model_id, 'im') + '.png'
         im_agraph = networkx.nx_agraph.to_agraph(im)
         im_agraph.draw(fname, prog='dot')
     except Exception as e:
@@ -479,10 +787,11 @@ def make_influence_map(pysb_model):
     return im
 
 
-def draw_contact_map(pysb_model, model_id):
+def draw_contact_map(pysb_model, model_id, fname=None):
     try:
         cm = make_contact_map(pysb_model)
-        fname = make_pic_name(model_id, 'cm') + '.png'
+        if fname is None:
+            fname = make_pic_name(model_id, 'cm') + '.png'
         cm.draw(fname, prog='dot')
     except Exception as e:
         logger.exception('Could not draw contact map for model.')
@@ -499,7 +808,7 @@ def make_contact_map(pysb_model):
     return cm
 
 
-def draw_reaction_network(pysb_model, model_id):
+def draw_reaction_network(pysb_model, model_id, fname=None):
     """Generate a PySB/BNG reaction network as a PNG file."""
     try:
         for m in pysb_model.monomers:
@@ -512,12 +821,13 @@ def draw_reaction_network(pysb_model, model_id):
         logger.error(e)
         return None
     try:
-        fname_prefix = make_pic_name(model_id, 'rxn')
+        if fname is None:
+            fname = make_pic_name(model_id, 'rxn') + '.png'
+        fname_prefix = fname[:-len('.png')]
         with open(fname_prefix + '.dot', 'wt') as fh:
             fh.write(diagram_dot)
         subprocess.call(('dot -T png -o %s.png %s.dot' %
                          (fname_prefix, fname_prefix)).split(' '))
-        fname = fname_prefix + '.png'
     except Exception as e:
         logger.error('Could not save model diagram.')
         logger.error(e)
@@ -4,6 +4,7 @@ import json
 import random
 import logging
 from threading import Thread
+from functools import partial
 
 import pysb.export
 
@@ -43,6 +44,8 @@ class MRA_Module(Bioagent):
     def __init__(self, **kwargs):
         # Instantiate a singleton MRA agent
         self.mra = MRA()
+        # Futures of diagrams to display once the reply is sent
+        self.diagram_futures = []
         super(MRA_Module, self).__init__(**kwargs)
         self.have_explanation = False
 
@@ -52,19 +55,27 @@ class MRA_Module(Bioagent):
         If a "request" message is received, decode the task and the content
         and call the appropriate function to prepare the response. A reply
         message is then sent back.
+
+        Diagrams of models are made in the background, and the display
+        tells for them are sent after the reply, as each of them is done.
         """
+        self.diagram_futures = []
         try:
             super(MRA_Module, self).receive_request(msg, content)
-            return
         except InvalidModelDescriptionError as e:
             logger.error('Invalid model description.')
             logger.exception(e)
             reply_content = self.make_failure('INVALID_DESCRIPTION')
+            self.reply_with_content(msg, reply_content)
         except InvalidModelIdError as e:
             logger.error('Invalid model ID.')
             logger.error(e)
             reply_content = self.make_failure('INVALID_MODEL_ID')
-        self.reply_with_content(msg, reply_content)
+            self.reply_with_content(msg, reply_content)
+        for diagram_type, future in self.diagram_futures:
+            future.add_done_callback(
+                partial(self._send_made_diagram, diagram_type))
+        self.diagram_futures = []
         return
 
     def respond_build_model(self, content):
@@ -110,10 +121,7 @@ class MRA_Module(Bioagent):
         diagrams = res.get('diagrams')
         if not no_display:
             if diagrams:
-                rxn_diagram = diagrams.get('reactionnetwork')
-                if rxn_diagram:
-                    msg.sets('diagram', rxn_diagram)
-                self.send_display_model(diagrams)
+                self.add_diagram(msg, res)
 
         # Indicate whether the goal has been explained
         has_expl = res.get('has_explanation')
@@ -207,10 +215,7 @@ class MRA_Module(Bioagent):
         if not no_display:
             diagrams = res.get('diagrams')
             if diagrams:
-                rxn_diagram = diagrams.get('reactionnetwork')
-                if rxn_diagram:
-                    msg.sets('diagram', rxn_diagram)
-                self.send_display_model(diagrams)
+                self.add_diagram(msg, res)
         # Analyze the model for issues
 
         # Report ambiguities
@@ -254,10 +259,7 @@ class MRA_Module(Bioagent):
         diagrams = res.get('diagrams')
         if not no_display:
             if diagrams:
-                rxn_diagram = diagrams.get('reactionnetwork')
-                if rxn_diagram:
-                    msg.sets('diagram', rxn_diagram)
-                self.send_display_model(diagrams)
+                self.add_diagram(msg, res)
         return msg
 
     def respond_model_has_mechanism(self, content):
@@ -323,10 +325,7 @@ class MRA_Module(Bioagent):
         logger.info(diagrams)
         if not no_display:
             if diagrams:
-                rxn_diagram = diagrams.get('reactionnetwork')
-                if rxn_diagram:
-                    msg.sets('diagram', rxn_diagram)
-                self.send_display_model(diagrams)
+                self.add_diagram(msg, res)
         return msg
 
     def respond_model_get_upstream(self, content):
@@ -441,19 +440,58 @@ class MRA_Module(Bioagent):
 
         return diagnostic_tells
 
+    def add_diagram(self, msg, res):
+        """Add the path of the reaction network diagram to a reply and send
+        the diagrams to display once they are made.
+
+        Except when testing, the reply does not wait for the reaction
+        network diagram, so the path in the reply is where the image is
+        being written, and the display-image tell for the same path is
+        sent once it exists.
+        """
+        diagrams = res['diagrams']
+        if self.testing:
+            rxn_diagram = diagrams['reactionnetwork'].result()
+        else:
+            rxn_diagram = res['diagram_paths']['reactionnetwork']
+        if rxn_diagram:
+            msg.sets('diagram', rxn_diagram)
+        self.send_display_model(diagrams)
+
     def send_display_model(self, diagrams):
-        for diagram_type, resource in diagrams.items():
-            if not resource:
-                continue
-            if diagram_type == 'sbgn':
-                content = KQMLList('display-sbgn')
-                content.set('type', diagram_type)
-                content.sets('graph', resource)
+        """Send the diagrams given as futures by type to display.
+
+        When testing, the diagrams are sent right away so that the reply
+        remains the last message sent.
+        """
+        for diagram_type, future in diagrams.items():
+            if self.testing:
+                self._send_made_diagram(diagram_type, future)
             else:
-                content = KQMLList('display-image')
-                content.set('type', diagram_type)
-                content.sets('path', resource)
-            self.tell(content)
+                self.diagram_futures.append((diagram_type, future))
+
+    def _send_made_diagram(self, diagram_type, future):
+        try:
+            resource = future.result()
+        except Exception as e:
+            logger.error('Could not make %s diagram.' % diagram_type)
+            logger.exception(e)
+            return
+        if not resource:
+            return
+        if diagram_type == 'sbgn':
+            content = KQMLList('display-sbgn')
+            content.set('type', diagram_type)
+            content.sets('graph', resource)
+        else:
+            content = KQMLList('display-image')
+            content.set('type', diagram_type)
+            content.sets('path', resource)
+        self.tell(content)
+
+    def exit(self, n):
+        self.mra.shutdown()
+        super(MRA_Module, self).exit(n)
 
     def send_clean_model(self):
         msg = KQMLPerformative('request')
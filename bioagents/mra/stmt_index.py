@@ -0,0 +1,107 @@
+"""An index of INDRA Statements for finding related statements quickly.
+
+Two statements can only match or refine one another if they are of the
+same type and some agent of one is related to an agent of the other, that
+is, the two agents have the same entity or one is a family or complex that
+the other is part of. The index buckets statements by type and by the
+entities of their agents, and records which of the entities it holds are
+related. The statements possibly related to a query statement can then be
+looked up by checking the entities of its agents against the entities of
+the index, of which there are typically far fewer than statements, and the
+exact relations only need to be checked for these candidates.
+"""
+from collections import defaultdict
+from indra.preassembler.hierarchy_manager import hierarchies
+
+
+class StatementIndex(object):
+    """An index of statements by type and agent entities.
+
+    Parameters
+    ----------
+    stmts : list[indra.statements.Statement] or None
+        The statements to index.
+    """
+    def __init__(self, stmts=None):
+        self.stmts = []
+        # Statement indices by statement type, for all statements and for
+        # those without agents
+        self.by_type = defaultdict(list)
+        self.no_agents_by_type = defaultdict(list)
+        # Statement indices by statement type and entity key
+        self.by_type_entity = defaultdict(list)
+        # An agent with each entity key, in the order they were indexed
+        self.entity_agents = {}
+        self.entity_keys = []
+        # The entity keys of the index related to a given entity key, along
+        # with the number of entity keys of the index already checked
+        self._related_keys = {}
+        for stmt in (stmts or []):
+            self.add(stmt)
+
+    def __len__(self):
+        return len(self.stmts)
+
+    def add(self, stmt):
+        """Add a statement to the index."""
+        idx = len(self.stmts)
+        self.stmts.append(stmt)
+        stmt_type = type(stmt)
+        self.by_type[stmt_type].append(idx)
+        entities = get_entities(stmt)
+        if not entities:
+            self.no_agents_by_type[stmt_type].append(idx)
+        for key, agent in entities.items():
+            if key not in self.entity_agents:
+                self.entity_agents[key] = agent
+                self.entity_keys.append(key)
+            self.by_type_entity[(stmt_type, key)].append(idx)
+
+    def get_candidates(self, stmt):
+        """Return the indices of the indexed statements which may match or
+        be refinements of stmt, or which stmt may be a refinement of, in
+        increasing order."""
+        stmt_type = type(stmt)
+        entities = get_entities(stmt)
+        # Statements without agents can only be compared by type
+        if not entities:
+            return list(self.by_type.get(stmt_type, []))
+        candidates = set()
+        for key, agent in entities.items():
+            for related_key in self.get_related_keys(key, agent):
+                candidates.update(self.by_type_entity.get((stmt_type,
+                                                           related_key), []))
+        # Indexed statements without agents are candidates for any query
+        candidates.update(self.no_agents_by_type.get(stmt_type, []))
+        return sorted(candidates)
+
+    def get_refinements(self, stmt):
+        """Return the indices of the indexed statements which are
+        refinements of stmt, including those matching it, in increasing
+        order."""
+        return [idx for idx in self.get_candidates(stmt)
+                if self.stmts[idx].refinement_of(stmt, hierarchies)]
+
+    def get_related_keys(self, key, agent):
+        """Return the entity keys of the index related to that of an agent."""
+        num_checked, related = self._related_keys.get(key, (0, []))
+        for other_key in self.entity_keys[num_checked:]:
+            if other_key == key or \
+                    entities_related(agent, self.entity_agents[other_key]):
+                related.append(other_key)
+        self._related_keys[key] = (len(self.entity_keys), related)
+        return related
+
+
+def get_entities(stmt):
+    """Return the agents of a statement by their entity keys."""
+    return {agent.entity_matches_key(): agent
+            for agent in stmt.agent_list() if agent is not None}
+
+
+def entities_related(agent1, agent2):
+    """Return True if the entities of two agents are the same or one is a
+    family or complex that the other is part of."""
+    return agent1.entity_matches(agent2) or \
+        agent1.isa_or_partof(agent2, hierarchies) or \
+        agent2.isa_or_partof(agent1, hierarchies)
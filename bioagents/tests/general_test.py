@@ -1,6 +1,6 @@
 from indra.statements import Agent, Phosphorylation, ModCondition, BoundCondition
 from bioagents.tests.integration import _IntegrationTest
-from bioagents import Bioagent, BioagentException
+from bioagents import Bioagent, BioagentException, LRUCache
 from kqml import KQMLList, KQMLPerformative
 
 
@@ -77,3 +77,15 @@ def test_cljson_stmt():
     cj = Bioagent.make_cljson(stmt)
     stmt2 = Bioagent.get_statement(cj)
     assert stmt.equals(stmt2)
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1
+    cache['c'] = 3
+    assert 'a' in cache and 'c' in cache
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert len(cache) == 2
@@ -1,4 +1,8 @@
+import os
+import copy
 import json
+import shutil
+import tempfile
 import unittest
 import xml.etree.ElementTree as ET
 from kqml.kqml_list import KQMLList
@@ -6,7 +10,10 @@ import indra.statements as sts
 from bioagents.tests.util import ekb_from_text, ekb_kstring_from_text, \
         get_request, stmts_json_from_text, stmts_clj_from_text
 from bioagents.tests.integration import _IntegrationTest, _FailureTest
-from bioagents.mra.mra import MRA, make_influence_map, make_contact_map
+from bioagents.mra.mra import MRA, make_influence_map, make_contact_map, \
+    get_diagram_paths
+from bioagents.mra.model_versions import ModelVersions
+from bioagents.mra.diagram_cache import DiagramCache, get_model_key
 from bioagents.mra.mra_module import MRA_Module, ekb_from_agent, get_target, \
     _get_matching_stmts, CAN_CHECK_STATEMENTS, InvalidModelDescriptionError
 from nose.plugins.skip import SkipTest
@@ -70,6 +77,28 @@ def test_has_mechanism():
     assert has_mechanism
 
 
+def test_remove_mechanism_refinements():
+    m = MRA()
+    mek = sts.Agent('MEK', db_refs={'FPLX': 'MEK'})
+    map2k1 = sts.Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    mapk1 = sts.Agent('MAPK1', db_refs={'HGNC': '6871'})
+    braf = sts.Agent('BRAF', db_refs={'HGNC': '1097'})
+    stmts = [sts.Phosphorylation(braf, map2k1),
+             sts.Phosphorylation(map2k1, mapk1),
+             sts.Phosphorylation(braf, map2k1, 'S', '218')]
+    model_id = m.new_model(stmts)
+    query = sts.Phosphorylation(braf, mek)
+    query_json = json.dumps(sts.stmts_to_json([query]))
+    assert m.has_mechanism(query_json, model_id)['has_mechanism']
+    assert m.get_stmt_index(model_id).get_refinements(query) == [0, 2]
+    unmatched = sts.Phosphorylation(mapk1, braf)
+    res = m.remove_mechanism_from_stmts([query, unmatched], model_id)
+    assert res['removed'] == [stmts[0], stmts[2]], res['removed']
+    assert res['remove_unmatched'] == [unmatched]
+    assert m.models[res['model_id']] == [stmts[1]]
+    assert not m.has_mechanism(query_json, res['model_id'])['has_mechanism']
+
+
 def test_transformations():
     m = MRA()
     stmts1 = [sts.Phosphorylation(sts.Agent('A'), sts.Agent('B'))]
@@ -90,6 +119,107 @@ def test_transformations():
     assert(tr[3] == 2)
 
 
+def test_extend_model_refinements():
+    m = MRA()
+    mek = sts.Agent('MEK', db_refs={'FPLX': 'MEK'})
+    map2k1 = sts.Agent('MAP2K1', db_refs={'HGNC': '6840'})
+    erk = sts.Agent('ERK', db_refs={'FPLX': 'ERK'})
+    mapk1 = sts.Agent('MAPK1', db_refs={'HGNC': '6871'})
+    braf = sts.Agent('BRAF', db_refs={'HGNC': '1097'})
+    old_mek = sts.Phosphorylation(mek, erk)
+    old_braf = sts.Phosphorylation(braf, map2k1)
+    m.new_model([old_mek, old_braf])
+    # The first new statement refines the old MEK statement, the second is
+    # refined by the old BRAF statement, the third matches the old BRAF
+    # statement and the last is unrelated to the model
+    new_stmts = [sts.Phosphorylation(map2k1, mapk1),
+                 sts.Phosphorylation(braf, mek),
+                 sts.Phosphorylation(braf, map2k1),
+                 sts.Dephosphorylation(sts.Agent('DUSP6'), mapk1)]
+    model_id, added = m.extend_model(new_stmts, 1)
+    assert added == [new_stmts[0], new_stmts[3]], added
+    assert m.models[model_id] == [old_braf, new_stmts[0], new_stmts[3]]
+    # A new statement given twice is only added once
+    st_site = sts.Phosphorylation(braf, map2k1, 'S', '218')
+    model_id, added = m.extend_model([st_site, st_site], model_id)
+    assert added == [st_site], added
+    assert m.models[model_id] == [new_stmts[0], new_stmts[3], st_site]
+
+
+def test_model_exec_versions():
+    m = MRA()
+    st1 = sts.Phosphorylation(sts.Agent('A'), sts.Agent('B'))
+    st2 = sts.Phosphorylation(sts.Agent('C'), sts.Agent('D'))
+    m.build_model_from_stmts([st1])
+    res = m.expand_model_from_stmts([st2], 1)
+    assert len(res['model_exec'].rules) == 2
+    assert {mon.name for mon in res['model_exec'].monomers} == \
+        {'A', 'B', 'C', 'D'}
+    # The model returned is a copy of the one kept for the version
+    assert res['model_exec'] is not m.model_execs.get(2)
+    # Undoing shares the model of the restored version
+    res = m.model_undo()
+    assert res['model_id'] == 3
+    assert m.model_execs.get(3) is m.model_execs.get(1)
+    # Changing the policy leads to assembling from scratch
+    m.default_policy = 'two_step'
+    model_exec = m.get_model_exec(2)
+    assert m.assembler.policies == 'two_step'
+    assert len(model_exec.rules) > 2
+
+
+def test_model_exec_full_assembly():
+    m = MRA()
+    braf = sts.Agent('BRAF')
+    m.build_model_from_stmts([sts.Activation(braf, sts.Agent('KRAS'))])
+    # The parameter of the new rule is numbered after that of the first
+    res = m.expand_model_from_stmts([sts.Activation(braf, sts.Agent('KIT'))],
+                                    1)
+    full_model = m.get_assembler().assemble_full(m.models[2])
+
+    def get_components(model):
+        return {(comp.name, str(comp)) for comp in model.all_components()}
+    assert get_components(res['model_exec']) == get_components(full_model)
+
+
+def test_model_versions():
+    versions = ModelVersions(cache_size=1)
+    st1 = sts.Phosphorylation(sts.Agent('A'), sts.Agent('B'))
+    st2 = sts.Phosphorylation(sts.Agent('C'), sts.Agent('D'))
+    st3 = sts.Phosphorylation(sts.Agent('E'), sts.Agent('F'))
+    versions.add_version(1, None, [st1, st2])
+    versions.add_version(2, 1, [st3], [st1])
+    versions.add_version(3, 2, [], [st2])
+    # An equal statement is stored once
+    versions.add_version(4, 1, [copy.deepcopy(st3)])
+    assert versions[3] == [st3]
+    assert versions[1] == [st1, st2]
+    assert versions[2] == [st2, st3]
+    assert versions[4] == [st1, st2, st3]
+    assert len(versions.stmts) == 3
+    assert versions.get_parent(4) == 1
+    assert 5 not in versions
+
+
+def test_model_checkers():
+    m = MRA()
+    m.explain = sts.Phosphorylation(sts.Agent('A'), sts.Agent('C'))
+    st1 = sts.Phosphorylation(sts.Agent('A'), sts.Agent('B'))
+    model_id = m.new_model([st1])
+    model_exec = m.get_model_exec(model_id)
+    mc = m.get_model_checker(m.models[model_id], model_exec)
+    # The model checker has its own copy of the model
+    assert mc.model is not model_exec
+    # A model with the same statements shares the model checker
+    model_id = m.new_model([copy.deepcopy(st1)])
+    assert m.get_model_checker(m.models[model_id], model_exec) is mc
+    # An equal goal shares the model checker, a new one needs a new one
+    m.explain = sts.Phosphorylation(sts.Agent('A'), sts.Agent('C'))
+    assert m.get_model_checker(m.models[model_id], model_exec) is mc
+    m.explain = sts.Phosphorylation(sts.Agent('B'), sts.Agent('C'))
+    assert m.get_model_checker(m.models[model_id], model_exec) is not mc
+
+
 def test_model_undo():
     m = MRA()
     stmts1 = [sts.Phosphorylation(sts.Agent('A'), sts.Agent('B'))]
@@ -107,13 +237,13 @@ def test_sbgn():
     res = m.build_model_from_ekb(ekb)
     ekb = ekb_from_text('NRAS activates BRAF.')
     res = m.expand_model_from_ekb(ekb, 1)
-    sbgn = res['diagrams']['sbgn']
+    sbgn = res['diagrams']['sbgn'].result()
     tree = ET.fromstring(sbgn)
     glyphs = tree.findall('s:map/s:glyph',
                           namespaces={'s': 'http://sbgn.org/libsbgn/0.3'})
     assert len(glyphs) == 6
     res = m.model_undo()
-    sbgn = res['diagrams']['sbgn']
+    sbgn = res['diagrams']['sbgn'].result()
     tree = ET.fromstring(sbgn)
     glyphs = tree.findall('s:map/s:glyph',
                           namespaces={'s': 'http://sbgn.org/libsbgn/0.3'})
@@ -124,7 +254,8 @@ def test_make_diagrams():
     m = MRA()
     ekb = ekb_from_text('KRAS activates BRAF. Active BRAF binds MEK.')
     res = m.build_model_from_ekb(ekb)
-    diagrams = res['diagrams']
+    diagrams = {diagram_type: future.result()
+                for diagram_type, future in res['diagrams'].items()}
     assert diagrams['reactionnetwork']
     assert diagrams['reactionnetwork'].endswith('.png')
     assert diagrams['contactmap']
@@ -133,6 +264,55 @@ def test_make_diagrams():
     assert diagrams['influencemap'].endswith('.png')
 
 
+def test_reaction_network():
+    m = MRA()
+    # Diagrams are not taken from the cache so that they are made
+    cache_dir = tempfile.mkdtemp()
+    try:
+        m.diagram_cache = DiagramCache(os.path.join(cache_dir, 'cache1'))
+        st = sts.Phosphorylation(sts.Agent('MAP2K1'), sts.Agent('MAPK1'))
+        res = m.build_model_from_stmts([st])
+        for future in res['diagrams'].values():
+            future.result()
+        # The network generated for the diagrams is reused by later ones
+        network_futures = [m.reaction_networks.get(key)
+                           for key in m.reaction_networks.keys()]
+        assert len(network_futures) == 1
+        m.diagram_cache = DiagramCache(os.path.join(cache_dir, 'cache2'))
+        res = m.submit_diagrams(res['model_exec'], res['model_id'])
+        for future in res['diagrams'].values():
+            future.result()
+        assert [m.reaction_networks.get(key)
+                for key in m.reaction_networks.keys()] == network_futures
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_diagram_cache():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = DiagramCache(os.path.join(cache_dir, 'cache'), max_size=15)
+        st = sts.Phosphorylation(sts.Agent('A'), sts.Agent('B'))
+        key = get_model_key([st], 'one_step', 100.0)
+        assert key == get_model_key([copy.deepcopy(st)], 'one_step', 100.0)
+        assert key != get_model_key([st], 'two_step', 100.0)
+        assert cache.get(key, 'contactmap') is None
+        img = os.path.join(cache_dir, 'cm.png')
+        with open(img, 'wb') as fh:
+            fh.write(b'0123456789')
+        cache.put(key, 'contactmap', img)
+        copy_path = os.path.join(cache_dir, 'cm_copy.png')
+        assert cache.get(key, 'contactmap', copy_path) == copy_path
+        with open(copy_path, 'rb') as fh:
+            assert fh.read() == b'0123456789'
+        # Adding SBGN exceeds the size so the image is evicted
+        cache.put(key, 'sbgn', '<sbgn/>')
+        assert cache.get(key, 'sbgn') == '<sbgn/>'
+        assert cache.get(key, 'contactmap') is None
+    finally:
+        shutil.rmtree(cache_dir)
+
+
 def test_make_im():
     m = MRA()
     ekb = ekb_from_text('KRAS activates BRAF. Active BRAF binds MEK.')
@@ -168,6 +348,23 @@ def test_respond_build_model_from_json():
     assert(reply.get('model-id') == '1')
 
 
+def test_respond_build_model_diagram_path():
+    mm = MRA_Module(testing=True)
+    # Outside testing, the reply has the path the reaction network is
+    # written to, and the diagrams are sent to display once made
+    mm.testing = False
+    st = sts.Phosphorylation(sts.Agent('MEK'), sts.Agent('ERK'))
+    msg = KQMLList('BUILD-MODEL')
+    msg.sets('description', json.dumps(sts.stmts_to_json([st])))
+    msg.sets('format', 'indra_json')
+    reply = mm.respond_build_model(msg)
+    rxn_path = get_diagram_paths('1')['reactionnetwork']
+    assert reply.gets('diagram') == rxn_path, reply
+    futures = dict(mm.diagram_futures)
+    assert futures['reactionnetwork'].result() == rxn_path
+    assert os.path.exists(rxn_path)
+
+
 def test_respond_expand_model_from_json():
     mm = MRA_Module(testing=True)
     st = stmts_json_from_text('MEK phosphorylates ERK')
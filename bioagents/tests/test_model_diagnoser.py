@@ -1,5 +1,7 @@
 from indra.statements import *
-from bioagents.mra.model_diagnoser import ModelDiagnoser
+import networkx as nx
+from bioagents.mra.model_diagnoser import ModelDiagnoser, ActivityLinker, \
+    get_best_edge
 from indra.assemblers.pysb import PysbAssembler
 from nose.plugins.attrib import attr
 
@@ -37,6 +39,31 @@ def test_missing_activity3():
     assert len(suggs) == 0
 
 
+def test_missing_activity_extend():
+    stmts = [Phosphorylation(mek, erk)]
+    linker = ActivityLinker(stmts)
+    assert len(ModelDiagnoser(stmts, activity_linker=linker)
+               .get_missing_activities()) == 0
+    # The new statement gives MEK an activity missing from the old one
+    new_stmts = stmts + [Activation(raf, mek)]
+    new_linker = linker.extend(new_stmts[1:])
+    suggs = ModelDiagnoser(new_stmts, activity_linker=new_linker) \
+        .get_missing_activities()
+    assert len(suggs) == 1
+    assert suggs[0].enz.name == 'MEK'
+    assert suggs[0].enz.activity.activity_type == 'activity'
+    assert not linker.get_activity_types(mek)
+    # Looking up an agent does not add it to the shared base agents
+    assert not linker.get_activity_types(Agent('MAPK1'))
+    assert 'MAPK1' not in linker.base_agents.keys()
+    # Extending only copies the base agents of the new statements
+    other_linker = new_linker.extend([Phosphorylation(raf, erk)])
+    assert other_linker.base_agents['MEK'] is new_linker.base_agents['MEK']
+    mek_linker = new_linker.extend([Activation(raf, mek)])
+    assert mek_linker.base_agents['MEK'] is not \
+        new_linker.base_agents['MEK']
+
+
 def test_check_model():
     explain = Activation(raf, erk)
     mek_active = Agent('MEK', db_refs={'FPLX': 'MEK'},
@@ -55,6 +82,29 @@ def test_check_model():
     assert path[1] == model_stmts[1]
 
 
+def test_best_edge():
+    im = nx.DiGraph()
+    im.add_edges_from([('SOURCE', 'A'), ('A', 'B'), ('B', 'E'), ('C', 'D'),
+                       ('D', 'TARGET')])
+    assert get_best_edge(im, 'SOURCE', 'TARGET') == (('E', 'C'), 7)
+    # Any edge keeps an existing path
+    im.add_edge('A', 'TARGET')
+    assert get_best_edge(im, 'SOURCE', 'TARGET') == (('E', 'C'), 7)
+    im.add_edge('E', 'C')
+    assert get_best_edge(im, 'SOURCE', 'TARGET') == (('SOURCE', 'A'), 7)
+    # An edge closing a cycle can connect the source to the target
+    im = nx.DiGraph()
+    im.add_edges_from([('SOURCE', 'A'), ('A', 'B'), ('C', 'B'),
+                       ('C', 'TARGET')])
+    assert get_best_edge(im, 'SOURCE', 'TARGET') == (('B', 'C'), 5)
+    # An edge closing a cycle can also extend an existing path
+    im = nx.DiGraph()
+    im.add_edges_from([('SOURCE', 'N0'), ('N0', 'TARGET'), ('N0', 'N1'),
+                       ('N1', 'N3'), ('N2', 'N1'), ('N2', 'N3'),
+                       ('N4', 'TARGET'), ('N4', 'N1')])
+    assert get_best_edge(im, 'SOURCE', 'TARGET') == (('N3', 'N4'), 6)
+
+
 @attr('nonpublic')
 def test_propose_statement():
     jun = Agent('JUN', db_refs={'HGNC':'6204', 'UP': 'P05412'})
@@ -1,9 +1,17 @@
 import json
+import numpy
 from nose.tools import raises
 import sympy.physics.units as units
 from bioagents.tra import tra_module
 from bioagents.tra import tra
-from pysb import Model, Rule, Monomer, Parameter, Initial, SelfExporter
+from bioagents.tra import model_checker
+from bioagents.tra import steady_state
+from bioagents.tra import ssa
+from bioagents.tra import benchmark
+from bioagents.tra.trajectories import TrajectoryBundle
+from bioagents.incremental_assembly import IncrementalAssembler
+from pysb import Model, Rule, Monomer, Parameter, Initial, Observable, \
+    SelfExporter
 from indra.statements import *
 from kqml import KQMLPerformative, KQMLList, KQMLToken
 from bioagents import Bioagent
@@ -256,6 +264,327 @@ def test_apply_condition_decrease():
     assert model.parameters['MAP2K1_0'].value < pold
 
 
+def test_parameter_overwrites():
+    model = _get_gk_model()
+    lst = KQMLList.from_string('(:type "multiple" :value 2.5 ' +
+                               ':quantity (:type "total" ' +
+                               ':entity (:description %s)))' % clj_map2k1)
+    mc = tra_module.get_molecular_condition(lst)
+    model_sim = tra.TRA(use_kappa=False).condition_model(model, [mc])
+    overwrites = tra.get_parameter_overwrites(model, model_sim)
+    assert overwrites == {'MAP2K1_0': 250}, overwrites
+    assert tra.get_parameter_overwrites(model, model) == {}
+
+
+def test_kappa_export_key():
+    model = _get_gk_model()
+    key = tra.get_kappa_export_key(model)
+    assert key == tra.get_kappa_export_key(model)
+    # Conditions change parameters in place
+    model.parameters['MAP2K1_0'].value = 250
+    assert key != tra.get_kappa_export_key(model)
+
+
+def test_trajectory_bundle():
+    dtype = [('A', float), ('B', float)]
+    yobs1 = numpy.array([(1.0, 0.0), (2.5, 1.0)], dtype=dtype)
+    yobs2 = numpy.array([(3.0, 0.0), (4.0, 2.0)], dtype=dtype)
+    bundle = TrajectoryBundle.from_results([([0.0, 10.0], yobs1),
+                                            ([0.0, 10.0], yobs2)])
+    assert bundle.values.shape == (2, 2, 2)
+    assert bundle.values.dtype == numpy.float32
+    assert list(bundle.get('A')[1]) == [3.0, 4.0]
+    assert list(bundle[1].get('B')[0]) == [0.0, 2.0]
+    assert list(bundle[numpy.int64(1)].get('B')[0]) == [0.0, 2.0]
+    assert list(bundle.from_time(5).tspan) == [10.0]
+    assert len(bundle.repeat(3)) == 3
+    # Simulations on different grids are put on the union of the grids
+    yobs3 = numpy.array([(0.0, 0.0), (2.0, 2.0)], dtype=dtype)
+    other = TrajectoryBundle.from_results([([0.0, 5.0], yobs3)])
+    both = TrajectoryBundle.concatenate([bundle, other])
+    assert list(both.tspan) == [0.0, 5.0, 10.0]
+    assert list(both.get('A')[2]) == [0.0, 2.0, 2.0]
+    assert list(both.get('A')[0]) == [1.0, 1.75, 2.5]
+    tspan, yobs = both.to_results()[0]
+    assert list(yobs['A']) == [1.0, 1.75, 2.5]
+
+
+def test_discretize_obs():
+    model = _get_gk_model()
+    assert tra.get_monomer_total(model, 'MAPK1') == 100.0
+    obs = Observable('MAPK1_p', model.monomers['MAPK1'](phospho='p'),
+                     _export=False)
+    yobs1 = numpy.array([(0.0,), (20.0,), (50.0,)], dtype=[('MAPK1_p', float)])
+    yobs2 = numpy.array([(0.0,), (10.0,), (20.0,)], dtype=[('MAPK1_p', float)])
+    results = TrajectoryBundle.from_results([([0, 1, 2], yobs1),
+                                             ([0, 1, 2], yobs2)])
+    thresholds = tra.get_thresholds(model, [obs], results)
+    assert thresholds == {'MAPK1_p': 30.0}, thresholds
+    yobs_bool = results.discretize(thresholds)
+    assert list(yobs_bool[0]['MAPK1_p']) == [False, False, True]
+    assert list(yobs_bool[1]['MAPK1_p']) == [False, False, False]
+    # The raw trajectories are not changed
+    assert list(results.get('MAPK1_p')[0]) == [0.0, 20.0, 50.0]
+
+
+def test_find_steady_state():
+    model = _get_gk_model()
+    model.add_component(Observable('MAPK1_tot', model.monomers['MAPK1'](),
+                                   _export=False))
+    ss = steady_state.find_steady_state(model)
+    assert ss is not None
+    assert ss.relaxation_time > 0
+    rhs = steady_state.get_rhs(model)
+    assert numpy.max(numpy.abs(rhs(ss.species))) < 1e-4
+    # The total amount of MAPK1 is conserved
+    start_val, ss_val = ss.get_obs_values('MAPK1_tot')
+    assert abs(start_val - 100.0) < 1e-6, start_val
+    assert abs(ss_val - 100.0) < 1e-6, ss_val
+
+
+def test_steady_state_bistable():
+    model = _get_bistable_model()
+    tra_obj = tra.TRA(use_kappa=False)
+    agent = Agent('A', mods=[ModCondition('phosphorylation')])
+    obs = tra.get_create_observable(model, agent)
+    pattern = tra.TemporalPattern('eventual_value', [agent], None,
+                                  value=tra.MolecularQuantity('qualitative',
+                                                              'low'))
+    # The model switches on, even if Newton iteration may converge to the
+    # off state
+    holds, _ = tra_obj.check_steady_state(model, pattern, obs, None, 10000.0)
+    assert holds is None
+
+
+def test_steady_state_slow_transient():
+    model = _get_slow_transient_model()
+    tra_obj = tra.TRA(use_kappa=False)
+    agent = Agent('S', mods=[ModCondition('phosphorylation')])
+    obs = tra.get_create_observable(model, agent)
+    pattern = tra.TemporalPattern('eventual_value', [agent], None,
+                                  value=tra.MolecularQuantity('qualitative',
+                                                              'high'))
+    # All of S is eventually phosphorylated, with a relaxation time of 100
+    # seconds at steady state, but that takes far longer than the time
+    # limit since the enzyme is saturated
+    ss = steady_state.find_steady_state(model)
+    assert ss is not None
+    assert 10 * ss.relaxation_time < 10000.0, ss.relaxation_time
+    holds, _ = tra_obj.check_steady_state(model, pattern, obs, None, 10000.0)
+    assert holds is None
+
+
+def test_steady_state_min_time():
+    # A is phosphorylated with a relaxation time of 100 seconds
+    SelfExporter.do_export = True
+    Model()
+    Monomer('A', ['phospho'], {'phospho': ['u', 'p']})
+    Parameter('kc_phos', 0.01)
+    Parameter('A_0', 100.0)
+    Rule('A_phos', A(phospho='u') >> A(phospho='p'), kc_phos)
+    Initial(A(phospho='u'), A_0)
+    SelfExporter.do_export = False
+    tra_obj = tra.TRA(use_kappa=False)
+    agent = Agent('A', mods=[ModCondition('phosphorylation')])
+    obs = tra.get_create_observable(model, agent)
+    pattern = tra.TemporalPattern('eventual_value', [agent], None,
+                                  value=tra.MolecularQuantity('qualitative',
+                                                              'high'))
+    holds, results = tra_obj.check_steady_state(model, pattern, obs, None,
+                                                10000.0)
+    assert holds is True
+    assert results.tspan[0] == 0
+    # From 2000 seconds on, A is already phosphorylated so it does not
+    # become high with respect to its start value
+    holds, results = tra_obj.check_steady_state(model, pattern, obs, None,
+                                                10000.0, 2000.0)
+    assert holds is False
+    assert results.tspan[0] >= 2000.0, results.tspan
+
+
+def test_simulate_odes_adaptive():
+    model = _get_gk_model()
+    model.add_component(Observable('MAPK1_p',
+                                   model.monomers['MAPK1'](phospho='p'),
+                                   _export=False))
+    tra_obj = tra.TRA(use_kappa=False)
+    ts, yobs = tra_obj.simulate_odes_adaptive(model, 1e6, 100)
+    # The model relaxes long before the time limit
+    assert ts[-1] < 1e6, ts[-1]
+    tra_obj.sol = None
+    ts_uniform, yobs_uniform = tra_obj.simulate_odes(model, 1e6, 1e4)
+    assert abs(yobs['MAPK1_p'][-1] - yobs_uniform['MAPK1_p'][-1]) < 0.5
+    idx = numpy.searchsorted(ts_uniform, ts[-1])
+    assert abs(yobs['MAPK1_p'][-1] - yobs_uniform['MAPK1_p'][idx]) < 0.5
+
+
+def test_run_simulations_min_time():
+    model = _get_gk_model()
+    model.add_component(Observable('MAPK1_p',
+                                   model.monomers['MAPK1'](phospho='p'),
+                                   _export=False))
+    tra_obj = tra.TRA(use_kappa=False)
+    results = tra_obj.run_simulations(model, None, 1, 5e5, 1e6, 1e4,
+                                      simulator='ode')
+    # The simulation is not stopped before the lower bound, and only the
+    # output from the lower bound on is returned
+    assert results.num_times > 0
+    assert results.tspan[0] >= 5e5, results.tspan
+    tra_obj.sol = None
+    ts_uniform, yobs_uniform = tra_obj.simulate_odes(model, 1e6, 1e4)
+    idx = numpy.searchsorted(ts_uniform, results.tspan[0])
+    assert abs(results.get('MAPK1_p')[0, 0] -
+               yobs_uniform['MAPK1_p'][idx]) < 0.5
+
+
+def test_short_time_limit():
+    model = _get_gk_model()
+    tra_obj = tra.TRA(use_kappa=False)
+    pattern = tra.TemporalPattern('sometime_value',
+                                  [Agent('MAPK1', mods=[
+                                      ModCondition('phosphorylation')])],
+                                  tra.TimeInterval(0, 50, 'second'),
+                                  value=tra.MolecularQuantity('qualitative',
+                                                              'low'))
+    # A time limit under 100 seconds gives a plot period under a second
+    res = tra_obj.check_property(model, pattern, simulator='ode')
+    assert res[0] == 1.0, res
+
+
+def test_simulate_ssa():
+    model = _get_gk_model()
+    model.add_component(Observable('MAPK1_tot', model.monomers['MAPK1'](),
+                                   _export=False))
+    model.add_component(Observable('MAPK1_p',
+                                   model.monomers['MAPK1'](phospho='p'),
+                                   _export=False))
+    ts = numpy.linspace(0, 1000, 11)
+    for method in ssa.SSA_METHODS:
+        results = ssa.simulate_ssa(model, ts, 3, method, seed=1)
+        assert results.values.shape == (3, 11, 2), results.values.shape
+        assert numpy.all(results.get('MAPK1_tot') == 100)
+        assert numpy.all(results.get('MAPK1_p')[:, 0] == 0)
+
+
+def test_simulate_ssa_dimerization():
+    # Two molecules of A dimerize at rate k: the propensity is k*A*(A-1)/2
+    # so the mean amount of free A is 2*exp(-k*t)
+    SelfExporter.do_export = True
+    Model()
+    Monomer('A', ['a'])
+    Parameter('kf_dimer', 0.01)
+    Parameter('A_0', 2.0)
+    Rule('A_dimerize', A(a=None) + A(a=None) >> A(a=1) % A(a=1), kf_dimer)
+    Initial(A(a=None), A_0)
+    Observable('A_free', A(a=None))
+    SelfExporter.do_export = False
+    ts = numpy.linspace(0, 200, 3)
+    for method in ssa.SSA_METHODS:
+        results = ssa.simulate_ssa(model, ts, 2000, method, seed=1)
+        means = numpy.mean(results.get('A_free'), axis=0)
+        expected = 2 * numpy.exp(-0.01 * ts)
+        assert numpy.all(numpy.abs(means - expected) < 0.1), means
+
+
+def test_benchmark_corpus():
+    corpus = benchmark.get_corpus((1, 3))
+    assert [name for name, _ in corpus] == ['cascade_1', 'cascade_3']
+    assert len(corpus[0][1]) == 1
+    assert corpus[0][1][0].enz.name == 'MAP2K1'
+    assert len(corpus[1][1]) == 6
+    baseline = {'models': {'cascade_1': {'phases': {'simulation':
+                                                    {'time': 2.0}},
+                                         'requests': {}}}}
+    new = {'models': {'cascade_1': {'phases': {'simulation': {'time': 1.0}},
+                                    'requests': {}}}}
+    ratios = benchmark.compare_benchmarks(baseline, new)
+    assert ratios == {'cascade_1': {'simulation': 0.5}}, ratios
+
+
+def test_dose_response_summary():
+    multipliers = numpy.array([0.1, 1.0, 10.0])
+    summary = tra.get_dose_response_summary(multipliers,
+                                            numpy.array([10.0, 5.0, 0.0]))
+    assert summary['direction'] == 'decrease', summary
+    assert abs(summary['ec50'] - 1.0) < 1e-6, summary
+    assert summary['min_response'] == 0.0
+    summary = tra.get_dose_response_summary(multipliers,
+                                            numpy.array([1.0, 1.0, 1.0]))
+    assert summary['direction'] == 'no_change', summary
+    assert summary['ec50'] is None
+
+
+def test_figure_key():
+    ts = numpy.linspace(0, 10, 11)
+    key = tra.get_figure_key('render_results', 'A_obs', [(ts, ts)], 50.0)
+    assert key == tra.get_figure_key('render_results', 'A_obs', [(ts, ts)],
+                                     50.0)
+    assert key != tra.get_figure_key('render_results', 'A_obs',
+                                     [(ts, 2*ts)], 50.0)
+
+
+def test_conditions_key():
+    quantity = tra.MolecularQuantityReference('total', Agent('BRAF'))
+    cond1 = tra.MolecularCondition('multiple', quantity, 10)
+    cond2 = tra.MolecularCondition('multiple', quantity, 10.0)
+    cond3 = tra.MolecularCondition('multiple', quantity, 100)
+    assert tra.get_conditions_key([cond1]) == tra.get_conditions_key([cond2])
+    assert tra.get_conditions_key([cond1]) != tra.get_conditions_key([cond3])
+    assert tra.get_conditions_key(None) == ()
+
+
+def test_multi_pattern_formula():
+    pattern = tra.TemporalPattern('before', [Agent('A'), Agent('B')], None)
+    obs_list = [Observable('%s_obs' % name,
+                           Monomer(name, _export=False)(), _export=False)
+                for name in ('A', 'B')]
+    fstr = tra.get_ltl_from_multi_pattern(pattern, obs_list)
+    assert fstr == '[B_obs,0,0] U [A_obs,1,1]', fstr
+    pattern = tra.TemporalPattern('sustained', [Agent('A'), Agent('B')],
+                                  None)
+    fstr = tra.get_ltl_from_multi_pattern(pattern, obs_list)
+    assert fstr == '(FG[A_obs,1,1]) & (FG[B_obs,1,1])', fstr
+
+
+def test_check_formula():
+    states = numpy.array([(0, 0), (1, 0), (1, 1), (0, 1)],
+                         dtype=[('A', float), ('B', float)])
+    assert model_checker.check_formula('[B,0,0] U [A,1,1]', states)
+    assert not model_checker.check_formula('[A,0,0] U [B,1,1]', states)
+    assert model_checker.check_formula('F([A,1,1] & [B,1,1])', states)
+    assert not model_checker.check_formula('G[A,0,0]', states)
+    assert model_checker.check_formula(
+        '(F[A,1,1] & FG([A,0,0])) & FG[B,1,1]', states)
+
+
+def test_check_property_before():
+    # A is phosphorylated, then phosphorylated A phosphorylates B
+    SelfExporter.do_export = True
+    Model()
+    Monomer('A', ['phospho'], {'phospho': ['u', 'p']})
+    Monomer('B', ['phospho'], {'phospho': ['u', 'p']})
+    Parameter('kc_phos_A', 0.01)
+    Parameter('kf_phos_B', 1e-5)
+    Parameter('A_0', 100.0)
+    Parameter('B_0', 100.0)
+    Rule('A_phos', A(phospho='u') >> A(phospho='p'), kc_phos_A)
+    Rule('A_phos_B', A(phospho='p') + B(phospho='u') >>
+         A(phospho='p') + B(phospho='p'), kf_phos_B)
+    Initial(A(phospho='u'), A_0)
+    Initial(B(phospho='u'), B_0)
+    SelfExporter.do_export = False
+    tra_obj = tra.TRA(use_kappa=False)
+    agent_a, agent_b = [Agent(name, mods=[ModCondition('phosphorylation')])
+                        for name in ('A', 'B')]
+    pattern = tra.TemporalPattern('before', [agent_a, agent_b], None)
+    res = tra_obj.check_property(model, pattern, simulator='ode')
+    assert res[0] == 1.0, res
+    assert res[2] == 1, res
+    pattern = tra.TemporalPattern('before', [agent_b, agent_a], None)
+    res = tra_obj.check_property(model, pattern, simulator='ode')
+    assert res[0] == 0.0, res
+
+
 def test_get_molecular_entity():
     me = KQMLList.from_string('(:description %s)' % clj_complex)
     ent = tra_module.get_molecular_entity(me)
@@ -311,6 +640,40 @@ def test_get_all_patterns():
     print(patterns)
 
 
+def test_sat_rate_interval():
+    lb, ub = tra.get_sat_rate_interval(2, 2)
+    assert 0.3 < lb < 0.5, lb
+    assert ub == 1.0, ub
+    assert not tra.is_sat_rate_decided((lb, ub))
+    lb, ub = tra.get_sat_rate_interval(10, 10)
+    assert lb > 0.5, lb
+    assert tra.is_sat_rate_decided((lb, ub))
+    lb, ub = tra.get_sat_rate_interval(0, 10)
+    assert lb == 0.0 and ub < 0.3, ub
+
+
+def test_sat_rate_interval_deterministic():
+    assert tra.get_sat_rate_interval(1, 1, deterministic=True) == (1.0, 1.0)
+    assert tra.is_sat_rate_decided((1.0, 1.0))
+
+
+def test_get_sim_result():
+    kappa_plot = {'legend': ['[T]', 'A', 'B'],
+                  'series': [[10.0, 3.0, 4.0], [0.0, 1.0, 2.0]]}
+    tspan, yobs = tra.get_sim_result(kappa_plot)
+    assert list(tspan) == [0.0, 10.0], tspan
+    assert list(yobs['A']) == [1.0, 3.0], yobs
+    assert list(yobs['B']) == [2.0, 4.0], yobs
+
+
+def test_stmts_key():
+    stmts = [Activation(Agent('BRAF'), Agent('KRAS')),
+             Inhibition(Agent('DRUG'), Agent('BRAF'))]
+    key = tra_module.get_stmts_key(stmts)
+    assert key == tra_module.get_stmts_key(stmts[::-1])
+    assert key != tra_module.get_stmts_key(stmts[:1])
+
+
 def test_targeted_agents():
     stmts = [Activation(Agent('BRAF'), Agent('KRAS')),
              Inhibition(Agent('DRUG'), Agent('BRAF'))]
@@ -325,6 +688,48 @@ def test_assemble_model_targeted_agents():
     assert model.parameters['BRAF_0_mod'].value == 50.0
 
 
+def test_assemble_model_incremental():
+    stmts = [Activation(Agent('BRAF'), Agent('KRAS')),
+             Inhibition(Agent('DRUG'), Agent('BRAF'))]
+    new_stmt = Phosphorylation(Agent('BRAF'), Agent('MAP2K1'))
+    tra_module.assemble_model(stmts)
+    model = tra_module.assemble_model(stmts + [new_stmt])
+    full_model = tra_module.model_assembler.assemble_full(stmts + [new_stmt])
+    assert set(model.monomers.keys()) == set(full_model.monomers.keys())
+    assert len(model.rules) == len(full_model.rules)
+    assert model.parameters['BRAF_0'].value == 50.0
+    assert model.parameters['MAP2K1_0'].value == 100.0
+    # The cached model is not affected by changes to returned models
+    model.parameters['MAP2K1_0'].value = 0
+    model = tra_module.assemble_model(stmts + [new_stmt])
+    assert model.parameters['MAP2K1_0'].value == 100.0
+
+
+def _get_model_summary(model):
+    return ({(mon.name, tuple(mon.sites)) for mon in model.monomers},
+            {(param.name, param.value) for param in model.parameters},
+            {(rule.name, str(rule.rule_expression)) for rule in model.rules},
+            {(str(initial.pattern), initial.value.name)
+             for initial in model.initials})
+
+
+def test_incremental_assembly_name_clashes():
+    braf = Agent('BRAF')
+    stmts = [Activation(braf, Agent('KRAS')),
+             Phosphorylation(braf, Agent('MAP2K1'))]
+    # A parameter numbered after an existing one, and a rule with the name
+    # of an existing one
+    new_stmts = [Activation(braf, Agent('KIT')),
+                 Phosphorylation(Agent('BRAF', db_refs={'HGNC': '1097'}),
+                                 Agent('MAP2K1'))]
+    for new_stmt in new_stmts:
+        assembler = IncrementalAssembler()
+        assembler.assemble(stmts)
+        model = assembler.assemble(stmts + [new_stmt])
+        full_model = assembler.assemble_full(stmts + [new_stmt])
+        assert _get_model_summary(model) == _get_model_summary(full_model)
+
+
 def test_no_upstream_active():
     stmts = [Phosphorylation(Agent('MEK',
                              activity=ActivityCondition('activity', True)),
@@ -516,6 +921,68 @@ class TraTestModel3(_IntegrationTest):
         assert content.gets('satisfies-rate') == '1.0'
 
 
+class TestSatisfiesBeforePattern(_IntegrationTest):
+    """Test that TRA checks a pattern over several entities."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(tra_module.TRA_Module, use_kappa=False)
+
+    def create_message(self):
+        model = stmts_clj_from_text('BRAF phosphorylates MEK. '
+                                    'Phosphorylated MEK phosphorylates ERK.')
+        entities = KQMLList([
+            KQMLList([':description', agent_clj_from_text(txt)])
+            for txt in ('MEK that is phosphorylated',
+                        'ERK that is phosphorylated')])
+        pattern = KQMLList()
+        pattern.set('entities', entities)
+        pattern.sets('type', 'before')
+
+        content = KQMLList('SATISFIES-PATTERN')
+        content.set('pattern', pattern)
+        content.set('model', model)
+        content.sets('simulator', 'ode')
+        msg = get_request(content)
+        return (msg, content)
+
+    def check_response_to_message(self, output):
+        assert output.head() == 'SUCCESS', output
+        content = output.get('content')
+        assert content.gets('satisfies-rate') == '1.0', output
+
+
+class TraTestModel3_SSA(_IntegrationTest):
+    """Test that TRA can run a model with the in-process stochastic
+    simulator."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(tra_module.TRA_Module, use_kappa=False)
+
+    def create_message(self):
+        model = stmts_clj_from_text('MEK phosphorylates ERK')
+        entity = agent_clj_from_text('ERK that is phosphorylated')
+
+        entities = KQMLList([KQMLList([':description', entity])])
+        pattern = KQMLList()
+        pattern.set('entities', entities)
+        pattern.sets('type', 'sometime_value')
+        value = KQMLList()
+        value.sets('type', 'qualitative')
+        value.sets('value', 'high')
+        pattern.set('value', value)
+
+        content = KQMLList('SATISFIES-PATTERN')
+        content.set('pattern', pattern)
+        content.set('model', model)
+        content.sets('simulator', 'tau_leaping')
+        msg = get_request(content)
+        return (msg, content)
+
+    def check_response_to_message(self, output):
+        assert output.head() == 'SUCCESS'
+        content = output.get('content')
+        assert content.gets('satisfies-rate') == '1.0'
+        assert int(content.gets('num-sim')) > 1
+
+
 class TraTestModelAlwaysValue(_IntegrationTest):
     """Test that TRA can correctly run a model."""
     def __init__(self, *args, **kwargs):
@@ -1001,6 +1468,77 @@ class TraMissingMonomerSite2(_IntegrationTest):
         assert reason == 'MODEL_MISSING_MONOMER_SITE', reason
 
 
+class TestDoseResponse(_IntegrationTest):
+    def __init__(self, *args, **kwargs):
+        super().__init__(tra_module.TRA_Module, use_kappa=False)
+        model_txt = 'Vemurafenib inhibits ERK. MEK activates ERK.'
+        self.model = \
+            stmts_clj_from_text(model_txt)
+
+    def create_message(self):
+        condition_entity = agent_clj_from_text('Vemurafenib')
+        target_entity = agent_clj_from_text('Active ERK')
+        content = KQMLList('MODEL-DOSE-RESPONSE')
+        content.set('model', self.model)
+        content.set('agent', condition_entity)
+        content.set('affected', target_entity)
+        content.set('num-points', '5')
+        msg = get_request(content)
+        return msg, content
+
+    def check_response_to_message(self, output):
+        assert output.head() == 'SUCCESS', output
+        assert len(output.get('multipliers')) == 5, output
+        assert len(output.get('responses')) == 5, output
+        assert output.gets('direction') == 'decrease', output
+
+
+class TestSensitivity(_IntegrationTest):
+    def __init__(self, *args, **kwargs):
+        super().__init__(tra_module.TRA_Module, use_kappa=False)
+        model_txt = 'Vemurafenib inhibits ERK. MEK activates ERK.'
+        self.model = \
+            stmts_clj_from_text(model_txt)
+
+    def create_message(self):
+        target_entity = agent_clj_from_text('Active ERK')
+        content = KQMLList('MODEL-SENSITIVITY')
+        content.set('model', self.model)
+        content.set('affected', target_entity)
+        content.set('num-results', '3')
+        msg = get_request(content)
+        return msg, content
+
+    def check_response_to_message(self, output):
+        assert output.head() == 'SUCCESS', output
+        sensitivities = output.get('sensitivities')
+        assert len(sensitivities) == 3, output
+        values = [abs(float(sens.gets('sensitivity')))
+                  for sens in sensitivities]
+        assert values == sorted(values, reverse=True), values
+
+
+class TestSensitivityInvalidNumResults(_IntegrationTest):
+    def __init__(self, *args, **kwargs):
+        super().__init__(tra_module.TRA_Module, use_kappa=False)
+        model_txt = 'Vemurafenib inhibits ERK. MEK activates ERK.'
+        self.model = \
+            stmts_clj_from_text(model_txt)
+
+    def create_message(self):
+        target_entity = agent_clj_from_text('Active ERK')
+        content = KQMLList('MODEL-SENSITIVITY')
+        content.set('model', self.model)
+        content.set('affected', target_entity)
+        content.set('num-results', 'three')
+        msg = get_request(content)
+        return msg, content
+
+    def check_response_to_message(self, output):
+        assert output.head() == 'FAILURE', output
+        assert output.gets('reason') == 'INVALID_NUM_RESULTS', output
+
+
 class TestCompareConditions(_IntegrationTest):
     def __init__(self, *args, **kwargs):
         super().__init__(tra_module.TRA_Module, use_kappa=False)
@@ -1199,6 +1737,45 @@ def _get_gk_model():
     return model
 
 
+def _get_bistable_model():
+    # Phosphorylation of A with cooperative positive feedback, starting
+    # between the two stable steady states, in the basin of the high one
+    SelfExporter.do_export = True
+    Model()
+    Monomer('A', ['phospho'], {'phospho': ['u', 'p']})
+    Parameter('kf_auto_phos', 2e-3)
+    Parameter('kc_dephos', 1.0)
+    Parameter('A_u_0', 44.0)
+    Parameter('A_p_0', 56.0)
+    Rule('A_auto_phos', A(phospho='u') + A(phospho='p') + A(phospho='p') >>
+         A(phospho='p') + A(phospho='p') + A(phospho='p'), kf_auto_phos)
+    Rule('A_dephos', A(phospho='p') >> A(phospho='u'), kc_dephos)
+    Initial(A(phospho='u'), A_u_0)
+    Initial(A(phospho='p'), A_p_0)
+    SelfExporter.do_export = False
+    return model
+
+
+def _get_slow_transient_model():
+    # A scarce enzyme saturated by its substrate
+    SelfExporter.do_export = True
+    Model()
+    Monomer('E', ['s'])
+    Monomer('S', ['e', 'phospho'], {'phospho': ['u', 'p']})
+    Parameter('kf_bind', 1.0)
+    Parameter('kc_phos', 0.01)
+    Parameter('E_0', 1.0)
+    Parameter('S_0', 10000.0)
+    Rule('E_bind_S', E(s=None) + S(e=None, phospho='u') >>
+         E(s=1) % S(e=1, phospho='u'), kf_bind)
+    Rule('E_phos_S', E(s=1) % S(e=1, phospho='u') >>
+         E(s=None) + S(e=None, phospho='p'), kc_phos)
+    Initial(E(s=None), E_0)
+    Initial(S(e=None, phospho='u'), S_0)
+    SelfExporter.do_export = False
+    return model
+
+
 def _get_gk_model_indra():
     kras = Agent('KRAS', db_refs={'HGNC': '6407', 'UP': 'P01116'})
     braf = Agent('BRAF', db_refs={'HGNC': '1097', 'UP': 'P15056'})
@@ -0,0 +1,264 @@
+"""Benchmarks of the throughput of TRA over a corpus of models.
+
+The corpus consists of phosphorylation cascades of increasing length, with
+a phosphatase acting on every substrate, ranging from the model of
+tests/test_model.ka to hundreds of rules. The agents of the cascades are
+taken from the KQML fixtures of the tests, so that they are grounded like
+the agents of actual dialogues. For each model, the phases of a
+SATISFIES-PATTERN request (assembly, network generation, simulation,
+checking and plotting) are timed separately, along with the peak memory
+allocated in each, and the SATISFIES-PATTERN and MODEL-COMPARE-CONDITIONS
+requests are then timed as a whole. If Kappa is used, the simulation of
+tests/test_model.ka is timed as well. Results are saved as JSON and can be
+compared to those of an earlier version:
+
+    python -m bioagents.tra.benchmark --output new.json --baseline old.json
+"""
+import os
+import sys
+import glob
+import json
+import time
+import logging
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from copy import deepcopy
+from datetime import datetime
+from kqml import KQMLList
+from pysb.bng import generate_equations
+from indra.statements import Agent, ModCondition, Phosphorylation, \
+    Dephosphorylation
+from bioagents.ekb import KQMLGraph, agent_from_term
+from bioagents.incremental_assembly import IncrementalAssembler
+from bioagents.tra import tra, tra_module
+import bioagents.tra.model_checker as mc
+
+logger = logging.getLogger('TRA benchmark')
+
+
+TESTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'tests')
+# The number of kinases in the cascades of the corpus
+CASCADE_LENGTHS = (1, 5, 20, 50, 150)
+
+
+def get_fixture_agents():
+    """Return the distinct proteins mentioned in the KQML fixtures."""
+    agents = {}
+    for fname in sorted(glob.glob(os.path.join(TESTS_PATH, 'kqml',
+                                               '*.kqml'))):
+        with open(fname, 'r') as fh:
+            kqml = KQMLList.from_string(fh.read())
+        graph = KQMLGraph(kqml.get('context'))
+        for node, data in graph.nodes(data=True):
+            if data.get('type') != 'ONT::GENE-PROTEIN':
+                continue
+            try:
+                agent = agent_from_term(graph, node)
+            except Exception:
+                continue
+            if agent is not None and agent.name not in agents:
+                agents[agent.name] = Agent(agent.name,
+                                           db_refs=agent.db_refs)
+    return [agents[name] for name in sorted(agents)]
+
+
+def get_corpus(lengths=CASCADE_LENGTHS):
+    """Return a list of (name, statements) of the models to benchmark.
+
+    The shortest cascade is MAP2K1 phosphorylating MAPK1, the mechanism of
+    tests/test_model.ka.
+    """
+    fixture_agents = [agent for agent in get_fixture_agents()
+                      if agent.name not in ('MAP2K1', 'MAPK1', 'DUSP6')]
+    corpus = []
+    for length in lengths:
+        agents = [Agent('MAP2K1'), Agent('MAPK1')] + fixture_agents
+        agents += [Agent('KINASE%d' % i)
+                   for i in range(max(0, length + 1 - len(agents)))]
+        agents = agents[:length + 1]
+        phosphatase = Agent('DUSP6')
+        stmts = []
+        for enz, sub in zip(agents[:-1], agents[1:]):
+            stmts.append(Phosphorylation(enz, sub))
+            if length > 1:
+                stmts.append(Dephosphorylation(phosphatase, sub))
+        corpus.append(('cascade_%d' % length, stmts))
+    return corpus
+
+
+def measure(phases, phase, track_memory, fun, *args, **kwargs):
+    """Run a function, recording its run time and peak memory in phases."""
+    if track_memory:
+        tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        res = fun(*args, **kwargs)
+        phases[phase] = {'time': time.perf_counter() - start}
+        if track_memory:
+            phases[phase]['peak_memory'] = \
+                tracemalloc.get_traced_memory()[1]
+    finally:
+        if track_memory:
+            tracemalloc.stop()
+    return res
+
+
+def benchmark_model(tra_obj, stmts, simulator, num_sim, max_time=10000.0,
+                    track_memory=True):
+    """Return the benchmark results of a model."""
+    def assemble():
+        model = IncrementalAssembler().assemble_full(stmts)
+        tra_module.initialize_model(model, stmts)
+        return model
+    phases = {}
+    # The target is the last substrate of the cascade
+    target = Agent(stmts[-1].sub.name,
+                   mods=[ModCondition('phosphorylation')])
+    pattern = tra.TemporalPattern('sometime_value', [target], None,
+                                  value=tra.MolecularQuantity('qualitative',
+                                                              'high'))
+    model = measure(phases, 'assembly', track_memory, assemble)
+    model_copy = deepcopy(model)
+    obs = tra.get_create_observable(model, target)
+    measure(phases, 'network_generation', track_memory, generate_equations,
+            model)
+    plot_period = max_time / 100
+    results = measure(phases, 'simulation', track_memory,
+                      tra_obj.run_simulations, model, None, num_sim, 0,
+                      max_time, plot_period, simulator=simulator)
+
+    def check():
+        thresholds = tra.get_thresholds(model, [obs], results)
+        fstr = tra.get_ltl_from_pattern(pattern, obs)
+        return [mc.ModelChecker(fstr, yobs).truth
+                for yobs in results.discretize(thresholds)]
+    measure(phases, 'checking', track_memory, check)
+    measure(phases, 'plotting', track_memory,
+            lambda: tra_obj.plot_results(results, target, obs.name).result())
+
+    # The requests as a whole, on a model without equations generated
+    requests = {}
+
+    def satisfies_pattern():
+        res = tra_obj.check_property(deepcopy(model_copy), pattern,
+                                     simulator=simulator)
+        if res[-1] is not None:
+            res[-1].result()
+    measure(requests, 'satisfies_pattern', track_memory, satisfies_pattern)
+
+    def compare_conditions():
+        _, fig_future = \
+            tra_obj.compare_conditions(deepcopy(model_copy), stmts[0].enz,
+                                       target, 'up', simulator=simulator)
+        fig_future.result()
+    measure(requests, 'compare_conditions', track_memory, compare_conditions)
+    tra_obj.result_cache.clear()
+    tra_obj.figure_cache.clear()
+
+    return {'num_statements': len(stmts),
+            'num_rules': len(model.rules),
+            'num_species': len(model.species),
+            'num_reactions': len(model.reactions),
+            'phases': phases,
+            'requests': requests}
+
+
+def benchmark_kappa(tra_obj, num_sim, max_time=10000.0):
+    """Return the run time of simulating tests/test_model.ka with Kappa."""
+    with open(os.path.join(TESTS_PATH, 'test_model.ka'), 'r') as fh:
+        kappa_model = fh.read()
+    start = time.perf_counter()
+    tra_obj.kappa.run_until(kappa_model, max_time, max_time / 100, num_sim)
+    return {'time': time.perf_counter() - start}
+
+
+def run_benchmarks(simulator=None, num_sim=10, lengths=CASCADE_LENGTHS,
+                   track_memory=True, use_kappa=True):
+    """Return the results of benchmarking TRA over the corpus."""
+    tra_obj = tra.TRA(use_kappa=use_kappa)
+    simulator = tra_obj.get_simulator(simulator)
+    if simulator == 'ode':
+        num_sim = 1
+    benchmarks = {'version': get_version(),
+                  'date': datetime.now().isoformat(),
+                  'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'simulator': simulator,
+                  'num_sim': num_sim,
+                  'track_memory': track_memory,
+                  'models': {}}
+    for name, stmts in get_corpus(lengths):
+        logger.info('Benchmarking %s' % name)
+        benchmarks['models'][name] = \
+            benchmark_model(tra_obj, stmts, simulator, num_sim,
+                            track_memory=track_memory)
+    if simulator == 'kappa':
+        benchmarks['kappa_test_model'] = benchmark_kappa(tra_obj, num_sim)
+    return benchmarks
+
+
+def compare_benchmarks(baseline, benchmarks):
+    """Return the ratios of the run times of benchmarks to a baseline, by
+    model and phase or request."""
+    ratios = {}
+    for name, results in benchmarks['models'].items():
+        base_results = baseline.get('models', {}).get(name)
+        if base_results is None:
+            continue
+        ratios[name] = {}
+        for group in ('phases', 'requests'):
+            for key, entry in results[group].items():
+                base_entry = base_results.get(group, {}).get(key)
+                if base_entry and base_entry['time'] > 0:
+                    ratios[name][key] = entry['time'] / base_entry['time']
+    return ratios
+
+
+def get_version():
+    """Return the git commit of the code being benchmarked, if known."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark TRA.')
+    parser.add_argument('--output', default='tra_benchmark.json',
+                        help='The JSON file to save the results to.')
+    parser.add_argument('--baseline',
+                        help='A JSON file of earlier results to compare to.')
+    parser.add_argument('--simulator', choices=tra.SIMULATORS,
+                        help='The simulator to use.')
+    parser.add_argument('--num-sim', type=int, default=10,
+                        help='The number of stochastic simulations to run.')
+    parser.add_argument('--lengths', type=int, nargs='+',
+                        default=list(CASCADE_LENGTHS),
+                        help='The lengths of the cascades to benchmark.')
+    parser.add_argument('--no-kappa', action='store_true',
+                        help='Do not start Kappa.')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Do not track memory, which slows Python code.')
+    args = parser.parse_args(argv)
+    benchmarks = run_benchmarks(args.simulator, args.num_sim, args.lengths,
+                                not args.no_memory, not args.no_kappa)
+    with open(args.output, 'w') as fh:
+        json.dump(benchmarks, fh, indent=1)
+    if args.baseline:
+        with open(args.baseline, 'r') as fh:
+            baseline = json.load(fh)
+        ratios = compare_benchmarks(baseline, benchmarks)
+        for name, model_ratios in ratios.items():
+            for key, ratio in sorted(model_ratios.items()):
+                print('%s\t%s\t%.2fx' % (name, key, ratio))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
@@ -1,6 +1,9 @@
 """Web API client for a Kappa simulator."""
 
 import kappy
+import hashlib
+from time import sleep, time
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger, DEBUG
 
 logger = getLogger('kappa_client')
@@ -9,6 +12,10 @@ logger = getLogger('kappa_client')
 KAPPA_URL = 'https://api.executableknowledge.org/kappa'
 
 
+class KappaRuntimeError(Exception):
+    pass
+
+
 class KappaRuntime(object):
     def __init__(self, project_name=None, debug=False, use_rest=False):
         """Create a Kappa client."""
@@ -20,6 +27,14 @@ class KappaRuntime(object):
             self.kappa_instance.get_info()
         else:
             self.kappa_instance = kappy.KappaStd()
+        # Simulations submitted to this runtime are run one after the
+        # other on a background thread since a project can only hold a
+        # single simulation at a time.
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # The hash of the code loaded with load and the variable overwrites
+        # the project was last parsed with
+        self.project_hash = None
+        self.project_overwrites = None
         return
 
     def add_code(self, code_str, name=None):
@@ -44,8 +59,45 @@ class KappaRuntime(object):
         for code_str in [] if code_list is None else code_list:
             self.kappa_instance.add_model_string(code_str)
         content = self.kappa_instance.project_parse()
+        self.project_hash = None
         return content
 
+    def load(self, code, overwrites=None):
+        """Make the project consist of the given code and parse it.
+
+        The project is only replaced if the code differs from what was last
+        loaded, and only parsed again if the variable overwrites differ from
+        the last parse, so successive simulations of a model, possibly with
+        different initial conditions, reuse the parsed project.
+
+        Parameters
+        ----------
+        code : str
+            A Kappa model.
+        overwrites : dict or None
+            A dict of values of Kappa variables (e.g. the parameters
+            initial amounts refer to) to use instead of the ones in the code.
+            None by default, indicating no overwrites.
+        """
+        overwrites = {} if overwrites is None else overwrites
+        code_hash = hashlib.md5(code.encode('utf-8')).hexdigest()
+        if code_hash != self.project_hash:
+            self.reset_project()
+            self.add_code(code, name=code_hash)
+            self.project_hash = code_hash
+            self.project_overwrites = None
+        if overwrites != self.project_overwrites:
+            self.kappa_instance.project_parse(**overwrites)
+            self.project_overwrites = dict(overwrites)
+
+    def reset_project(self):
+        """Delete the current simulation and all files of the project."""
+        self.delete_sim()
+        for file_metadata in list(self.kappa_instance.file_info()):
+            self.kappa_instance.file_delete(file_metadata.id)
+        self.project_hash = None
+        self.project_overwrites = None
+
     def start_sim(self, **parameters):
         """Start a simulation with given parameters.
 
@@ -71,23 +123,172 @@ class KappaRuntime(object):
             'seed': None,
             'store_trace': True
             }
+        complete_params.update(parameters)
         sim_params = kappy.SimulationParameter(**complete_params)
-        self.kappa_instance.simulation_start(sim_params)
-        resp = complete_params.update(parameters)
-        return resp.json()
+        return self.kappa_instance.simulation_start(sim_params)
 
     def pause_sim(self):
         """Pause a given simulation."""
         self.kappa_instance.simulation_pause()
 
-    def continue_sim(self):
+    def continue_sim(self, pause_condition='[false]'):
         """Continue the pause simulation."""
-        self.kappa_instance.simulation_continue()
+        self.kappa_instance.simulation_continue(pause_condition)
+
+    def delete_sim(self):
+        """Delete the current simulation, if there is one."""
+        try:
+            self.kappa_instance.simulation_delete()
+        except kappy.KappaError:
+            pass
 
     def sim_status(self):
         """Return status of running simulation."""
         return self.kappa_instance.simulation_info()
 
+    def sim_progress(self):
+        """Return the progress part of the status of the simulation."""
+        status = self.sim_status()
+        return status.get('simulation_info_progress', status)
+
     def sim_plot(self):
         """Get the data from the simulation."""
         return self.kappa_instance.simulation_plot()
+
+    def wait_for_sim(self, timeout=None, min_poll=0.005, max_poll=0.2):
+        """Block until the current simulation stops and return its progress.
+
+        Kappa has no way of notifying clients when a simulation stops so the
+        status is polled, starting with a short period that is doubled up to
+        max_poll. Short simulations are therefore picked up almost
+        immediately while long ones are not queried needlessly often.
+
+        Parameters
+        ----------
+        timeout : float or None
+            The number of seconds after which to give up waiting. None by
+            default, indicating no limit.
+        min_poll : float
+            The first polling period in seconds.
+        max_poll : float
+            The longest polling period in seconds.
+        """
+        start = time()
+        poll = min_poll
+        while True:
+            progress = self.sim_progress()
+            if not progress.get('simulation_progress_is_running'):
+                return progress
+            if timeout is not None and time() - start > timeout:
+                self.pause_sim()
+                raise KappaRuntimeError('Simulation did not finish in %s '
+                                        'seconds.' % timeout)
+            pct = progress.get('simulation_progress_time_percentage')
+            if pct is not None:
+                logger.debug('Sim time percentage: %d' % pct)
+            sleep(poll)
+            poll = min(2 * poll, max_poll)
+
+    def run_until(self, max_time, plot_period=10, seed=None, timeout=None):
+        """Simulate the parsed project up to max_time and return the plot.
+
+        This call blocks until the simulation is done, see submit for a
+        non-blocking version.
+
+        Parameters
+        ----------
+        max_time : float
+            The simulated time at which the simulation is stopped.
+        plot_period : float
+            The time period between output (plot) points.
+        seed : int or None
+            A random seed for the simulation. Default: None
+        timeout : float or None
+            The number of seconds after which the simulation is abandoned.
+            Default: None
+
+        Returns
+        -------
+        kappa_plot : dict
+            The plot data of the simulation, with `legend` and `series`
+            entries.
+        """
+        self.delete_sim()
+        self.start_sim(plot_period=plot_period,
+                       pause_condition='[T] > %g' % max_time, seed=seed)
+        try:
+            self.wait_for_sim(timeout)
+            return self.sim_plot()
+        finally:
+            self.delete_sim()
+
+    def submit(self, max_time, plot_period=10, seed=None, timeout=None,
+               callback=None):
+        """Run a simulation as in run_until on a background thread.
+
+        Parameters
+        ----------
+        callback : function or None
+            A function called with the finished future as its argument,
+            once the simulation is done or has failed.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            A future whose result is the plot data of the simulation.
+        """
+        future = self._executor.submit(self.run_until, max_time, plot_period,
+                                       seed, timeout)
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def shutdown(self):
+        """Stop the background thread and the Kappa instance."""
+        self._executor.shutdown(wait=False)
+        if hasattr(self.kappa_instance, 'shutdown'):
+            self.kappa_instance.shutdown()
+
+
+class KappaRuntimePool(object):
+    """A set of Kappa runtimes which simulate a model concurrently.
+
+    Each runtime has its own project (and, in standard mode, its own Kappa
+    process), so simulations on different runtimes run in parallel.
+
+    Parameters
+    ----------
+    size : int
+        The number of runtimes in the pool.
+    project_name : str or None
+        A prefix for the names of the projects of the runtimes.
+    """
+    def __init__(self, size=2, project_name=None, debug=False,
+                 use_rest=False):
+        self.runtimes = []
+        for i in range(size):
+            name = None if project_name is None else \
+                '%s_%d' % (project_name, i)
+            self.runtimes.append(KappaRuntime(name, debug=debug,
+                                              use_rest=use_rest))
+
+    def run_until(self, code, max_time, plot_period=10, num_sim=1,
+                  timeout=None, overwrites=None):
+        """Run num_sim simulations of a Kappa model and return the plots.
+
+        The simulations are distributed over the runtimes of the pool and
+        the plots are returned in the order the simulations were submitted.
+        Runtimes that already hold the model are not loaded again, see
+        KappaRuntime.load.
+        """
+        runtimes = self.runtimes[:num_sim]
+        for runtime in runtimes:
+            runtime.load(code, overwrites)
+        futures = [runtimes[i % len(runtimes)].submit(max_time, plot_period,
+                                                      timeout=timeout)
+                   for i in range(num_sim)]
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        for runtime in self.runtimes:
+            runtime.shutdown()
@@ -1,41 +1,25 @@
-import re
 from copy import deepcopy
 
 def is_balanced(s, lc='(', rc=')'):
-    is_bal = 0
-    for i in range(len(s))[1:]:
-        is_bal += (s[i] == lc) - (s[i-1] == rc)
-    return is_bal
+    """Return the number of unclosed left parentheses in s (0 if balanced).
+    """
+    return s.count(lc) - s.count(rc)
 
 def build_tree(formula_str, time_lim=None):
     root = None
     fstr = formula_str.strip()
 
-    str_r = fstr
-    str_l = None
-    while True:
-        parts = re.split('\|', fstr)
-        if len(parts) == 1:
-            break
-        str_l, str_r = parts[0], '|'.join(parts[1:])
-        if (is_balanced(str_l) == 0):
-            child1 = build_tree(str_l, time_lim)
-            child2 = build_tree(str_r, time_lim)
-            root = OrNode(time_lim, child1, child2)
-            return root
-
-    str_r = fstr
-    str_l = None
-    while True:
-        parts = re.split('&', fstr)
-        if len(parts) == 1:
-            break
-        str_l, str_r = parts[0], '&'.join(parts[1:])
-        if (is_balanced(str_l) == 0):
-            child1 = build_tree(str_l, time_lim)
-            child2 = build_tree(str_r, time_lim)
-            root = AndNode(time_lim, child1, child2)
-            return root
+    # Binary operators are split at their first occurrence that is not
+    # inside parentheses, in order of increasing precedence
+    for op, node_class in (('|', OrNode), ('&', AndNode), (' U ', UntilNode)):
+        parts = fstr.split(op)
+        for i in range(1, len(parts)):
+            str_l, str_r = op.join(parts[:i]), op.join(parts[i:])
+            if (is_balanced(str_l) == 0):
+                child1 = build_tree(str_l, time_lim)
+                child2 = build_tree(str_r, time_lim)
+                root = node_class(time_lim, child1, child2)
+                return root
 
     first_ch = fstr[0]
     last_ch = fstr[-1]
@@ -185,6 +169,27 @@ class OrNode(Node):
         return self.truth
 
 
+class UntilNode(Node):
+    """Strong until: child2 eventually holds and child1 holds until then."""
+    def eval_node(self):
+        if self.truth is not None:
+            return self.truth
+        tf2 = self.child2.eval_node()
+        if tf2 is True:
+            self.truth = True
+        elif tf2 is None:
+            return None
+        else:
+            tf1 = self.child1.eval_node()
+            if tf1 is False or (tf1 is True and self.is_last):
+                self.truth = False
+            elif tf1 is None or self.next_node is None:
+                self.truth = None
+            else:
+                self.truth = self.next_node.eval_node()
+        return self.truth
+
+
 class NotNode(Node):
     def eval_node(self):
         # If thruth is already known
@@ -1,4 +1,6 @@
-from .ltl_nodes import build_tree
+import numpy
+from .ltl_nodes import build_tree, AtomicNode, NotNode, AndNode, OrNode, \
+    FNode, GNode, UntilNode
 
 
 class ModelChecker(object):
@@ -11,8 +13,8 @@ class ModelChecker(object):
         self.roots.append(root)
 
         if states is not None:
-            # Downsample here for speed
-            states = states[::5]
+            # States are not downsampled since adaptive ODE simulations
+            # output refined time points where observables change fast
             for t, s in enumerate(states):
                 tf = self.update(s, (t == (len(states)-1)))
                 if tf is not None:
@@ -32,6 +34,61 @@ class ModelChecker(object):
         return self.truth
 
 
+def check_formula(formula_str, states):
+    """Return the truth of a formula at the start of a trajectory.
+
+    Unlike ModelChecker, which updates the formula state by state, this
+    evaluates each node of the formula over all time points at once on
+    the trajectory arrays, so all atomic propositions are evaluated on the
+    same states, for any number of variables.
+
+    Parameters
+    ----------
+    formula_str : str
+        The formula to check.
+    states : numpy.ndarray
+        A structured array with a field of values for each variable of the
+        formula.
+    """
+    root = build_tree(formula_str)
+    return bool(_eval_over_time(root, states)[0])
+
+
+def _eval_over_time(node, states):
+    """Return the truth of the node at each time point of the states."""
+    if isinstance(node, AtomicNode):
+        x = states[node.var_id]
+        tf = numpy.ones(len(x), dtype=bool)
+        if node.lb is not None:
+            tf &= (x >= node.lb)
+        if node.ub is not None:
+            tf &= (x <= node.ub)
+        return tf
+    tf1 = _eval_over_time(node.child1, states)
+    if isinstance(node, NotNode):
+        return ~tf1
+    elif isinstance(node, FNode):
+        return numpy.logical_or.accumulate(tf1[::-1])[::-1]
+    elif isinstance(node, GNode):
+        return numpy.logical_and.accumulate(tf1[::-1])[::-1]
+    tf2 = _eval_over_time(node.child2, states)
+    if isinstance(node, AndNode):
+        return tf1 & tf2
+    elif isinstance(node, OrNode):
+        return tf1 | tf2
+    elif isinstance(node, UntilNode):
+        # The next time point (from each one on) at which child2 holds and
+        # at which child1 does not, len(states) if there is none
+        n = len(tf1)
+        idx = numpy.arange(n)
+        next_tf2 = numpy.minimum.accumulate(
+            numpy.where(tf2, idx, n)[::-1])[::-1]
+        next_not_tf1 = numpy.minimum.accumulate(
+            numpy.where(~tf1, idx, n)[::-1])[::-1]
+        return (next_tf2 < n) & (next_tf2 <= next_not_tf1)
+    raise ValueError('Unknown node %s' % node)
+
+
 def transient_formula(var_id):
     fstr = 'F[%s,1,1] & FG([%s,0,0])' % (var_id, var_id)
     return fstr
@@ -60,3 +117,13 @@ def eventual_formula(var_id, value):
 def sometime_formula(var_id, value):
     fstr = 'F[%s,%d,%d]' % (var_id, value, value)
     return fstr
+
+
+def before_formula(var_id1, var_id2):
+    fstr = '[%s,0,0] U [%s,1,1]' % (var_id2, var_id1)
+    return fstr
+
+
+def simultaneous_formula(var_ids):
+    fstr = 'F(%s)' % ' & '.join('[%s,1,1]' % var_id for var_id in var_ids)
+    return fstr
@@ -0,0 +1,201 @@
+"""In-process stochastic simulation of the reaction networks of PySB models.
+
+Ensembles of trajectories are simulated together, with the state of all
+ensemble members held in one array so that propensities are evaluated
+for all of them at once. Two methods are available: Gillespie's direct
+method, which simulates every reaction event, and tau-leaping, which
+fires a Poisson distributed number of each reaction over steps in which
+propensities change little, and falls back to single events when few
+would fire in a step. Propensities are the mass action rates of the
+reactions generated by PySB, with the number of distinct combinations of
+reactant molecules in place of powers of amounts for reactions with
+repeated reactants.
+"""
+import numpy
+import logging
+from pysb.bng import generate_equations
+from bioagents.tra.trajectories import TrajectoryBundle
+from bioagents.tra.steady_state import lambdify_species, \
+    get_initial_species, get_stoichiometry
+
+logger = logging.getLogger('SSA')
+
+
+SSA_METHODS = ('direct', 'tau_leaping')
+
+
+class StochasticSimulationError(Exception):
+    pass
+
+
+def simulate_ssa(model, tspan, num_sim=1, method='tau_leaping', seed=None,
+                 epsilon=0.03, max_steps=100000):
+    """Return stochastic simulations of a model.
+
+    Parameters
+    ----------
+    model : pysb.Model
+        The model to simulate.
+    tspan : numpy.ndarray
+        The increasing time points at which to output the observables.
+    num_sim : int
+        The number of simulations to run.
+    method : str
+        'direct' for Gillespie's direct method or 'tau_leaping'.
+    seed : int or None
+        The seed of the random number generator.
+    epsilon : float
+        The largest relative change of any species amount expected in a
+        tau-leaping step.
+    max_steps : int
+        The largest number of steps to take, beyond which a
+        StochasticSimulationError is raised.
+
+    Returns
+    -------
+    results : TrajectoryBundle
+        The values of the observables of the model in each simulation.
+    """
+    if method not in SSA_METHODS:
+        raise ValueError('Unknown SSA method %s' % method)
+    generate_equations(model)
+    tspan = numpy.asarray(tspan, dtype=float)
+    propensities = get_propensity_function(model)
+    stoich = get_stoichiometry(model)
+    obs_matrix = get_observable_matrix(model)
+    rng = numpy.random.RandomState(seed)
+
+    # The state of each simulation is a column of x
+    x = numpy.tile(numpy.round(get_initial_species(model))[:, None],
+                   (1, num_sim))
+    t = numpy.zeros(num_sim)
+    next_out = numpy.zeros(num_sim, dtype=int)
+    out = numpy.empty((num_sim, len(tspan), obs_matrix.shape[1]))
+    # The tau-leaping step of a simulation is reduced after a step that
+    # would have made an amount negative
+    leap_scale = numpy.ones(num_sim)
+
+    for _ in range(max_steps):
+        active = numpy.flatnonzero(next_out < len(tspan))
+        if not len(active):
+            break
+        xa = x[:, active]
+        a = numpy.maximum(propensities(xa), 0.0) if model.reactions \
+            else numpy.zeros((0, len(active)))
+        a0 = a.sum(axis=0)
+        # Time to the next event of each simulation
+        with numpy.errstate(divide='ignore'):
+            tau = numpy.where(a0 > 0,
+                              -numpy.log(rng.random_sample(len(active))) / a0,
+                              numpy.inf)
+        leap = numpy.zeros(len(active), dtype=bool)
+        if method == 'tau_leaping' and len(a):
+            tau_leap = get_leap_time(xa, a, stoich, epsilon) * \
+                leap_scale[active]
+            # Leap if several events are expected, up to the next output
+            with numpy.errstate(invalid='ignore'):
+                leap = (tau_leap * a0 > 10)
+            next_t = tspan[numpy.minimum(next_out[active], len(tspan) - 1)]
+            tau_leap = numpy.minimum(tau_leap, next_t - t[active])
+            leap &= (tau_leap > 0)
+            tau[leap] = tau_leap[leap]
+        t_new = t[active] + tau
+
+        # Output the current state at the time points before the event
+        _record_outputs(out, tspan, next_out, active, xa, t_new, obs_matrix)
+
+        # Fire single events
+        fire = ~leap & numpy.isfinite(t_new) & (t_new <= tspan[-1])
+        if numpy.any(fire):
+            cum_a = numpy.cumsum(a[:, fire], axis=0)
+            r = rng.random_sample(numpy.count_nonzero(fire)) * a0[fire]
+            reaction_idx = numpy.minimum(numpy.sum(cum_a < r, axis=0),
+                                         len(a) - 1)
+            x[:, active[fire]] += stoich[:, reaction_idx]
+        # Fire leaps, rejecting the ones that make an amount negative
+        if numpy.any(leap):
+            counts = rng.poisson(a[:, leap] * tau[leap])
+            x_leap = xa[:, leap] + stoich.dot(counts)
+            ok = numpy.all(x_leap >= 0, axis=0)
+            leap_idx = active[leap]
+            x[:, leap_idx[ok]] = x_leap[:, ok]
+            leap_scale[leap_idx[ok]] = 1.0
+            leap_scale[leap_idx[~ok]] *= 0.5
+            rejected = numpy.flatnonzero(leap)[~ok]
+            t_new[rejected] = t[active[rejected]]
+        t[active] = t_new
+    else:
+        raise StochasticSimulationError('Simulation did not finish in %d '
+                                        'steps.' % max_steps)
+    obs_names = [obs.name for obs in model.observables]
+    return TrajectoryBundle(tspan, out, obs_names)
+
+
+def get_propensity_function(model):
+    """Return a function of the species amounts giving the propensities of
+    the reactions of a model.
+
+    The rates generated by PySB include the symmetry factor of repeated
+    reactants, e.g. k*A**2/2 for A + A, so for each reactant occurring m
+    times, A**m is replaced by the falling factorial A*(A-1)*...*(A-m+1),
+    e.g. giving k*A*(A-1)/2 for A + A.
+    """
+    rates = lambdify_species(model, [reaction['rate'] for reaction
+                                     in model.reactions])
+    # The reactions, species and multiplicities of repeated reactants
+    repeated = []
+    for j, reaction in enumerate(model.reactions):
+        reactants = list(reaction['reactants'])
+        for idx in sorted(set(reactants)):
+            if reactants.count(idx) > 1:
+                repeated.append((j, idx, reactants.count(idx)))
+
+    def evaluate(x):
+        a = rates(x)
+        for j, idx, mult in repeated:
+            amount = x[idx]
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                factor = numpy.prod([(amount - k) / amount
+                                     for k in range(1, mult)], axis=0)
+                a[j] = numpy.where(amount >= mult, a[j] * factor, 0.0)
+        return a
+    return evaluate
+
+
+def get_leap_time(x, a, stoich, epsilon):
+    """Return the tau-leaping step of each simulation.
+
+    The step is chosen such that the expected change and the standard
+    deviation of the change of each species are below epsilon times its
+    amount (but at least one molecule), following Cao, Gillespie and
+    Petzold (2006) with a highest order of reaction of one.
+    """
+    mu = stoich.dot(a)
+    sigma2 = (stoich**2).dot(a)
+    bound = numpy.maximum(epsilon * x, 1.0)
+    with numpy.errstate(divide='ignore'):
+        tau = numpy.minimum(bound / numpy.abs(mu), bound**2 / sigma2)
+    return numpy.min(tau, axis=0)
+
+
+def get_observable_matrix(model):
+    """Return the matrix mapping species amounts to observable values."""
+    obs_matrix = numpy.zeros((len(model.species), len(model.observables)))
+    for j, obs in enumerate(model.observables):
+        for idx, coeff in zip(obs.species, obs.coefficients):
+            obs_matrix[idx, j] = coeff
+    return obs_matrix
+
+
+def _record_outputs(out, tspan, next_out, active, x, t_new, obs_matrix):
+    # Record the state x of the active simulations at each output time
+    # point before t_new that was not recorded yet
+    while True:
+        pending = next_out[active] < len(tspan)
+        pending[pending] = \
+            tspan[next_out[active][pending]] < t_new[pending]
+        if not numpy.any(pending):
+            break
+        sims = active[pending]
+        out[sims, next_out[sims]] = x[:, pending].T.dot(obs_matrix)
+        next_out[sims] += 1
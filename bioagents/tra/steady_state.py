@@ -0,0 +1,179 @@
+"""Steady state analysis of the ODE semantics of PySB models.
+
+The steady state reached from the initial conditions of a model is found
+by Newton iteration on the right hand side of its ODEs. The iteration is
+carried out in the stoichiometric subspace through the initial state so
+that the conserved totals of the model are kept fixed, which makes the
+steady state isolated even though the full Jacobian is singular.
+"""
+import numpy
+import sympy
+import logging
+from pysb.bng import generate_equations
+
+logger = logging.getLogger('SteadyState')
+
+
+class SteadyState(object):
+    """The steady state of a model reached from its initial state.
+
+    Parameters
+    ----------
+    model : pysb.Model
+        The model, with its equations generated.
+    initial : numpy.ndarray
+        The initial amount of each species.
+    species : numpy.ndarray
+        The steady state amount of each species.
+    relaxation_time : float
+        The time constant of the slowest mode of the linearized system at
+        the steady state.
+    """
+    def __init__(self, model, initial, species, relaxation_time):
+        self.model = model
+        self.initial = initial
+        self.species = species
+        self.relaxation_time = relaxation_time
+
+    def get_obs_values(self, obs_name):
+        """Return the initial and steady state values of an observable."""
+        obs = self.model.observables[obs_name]
+        coeffs = numpy.array(obs.coefficients, dtype=float)
+        idx = list(obs.species)
+        return (float(numpy.dot(coeffs, self.initial[idx])),
+                float(numpy.dot(coeffs, self.species[idx])))
+
+
+def find_steady_state(model, tol=1e-8, max_iter=100):
+    """Return the stable steady state of a model reached from its initial
+    state by Newton iteration.
+
+    Parameters
+    ----------
+    model : pysb.Model
+        The model to analyze.
+    tol : float
+        The largest rate of change of any species at steady state, relative
+        to the largest initial amount.
+    max_iter : int
+        The maximal number of Newton iterations.
+
+    Returns
+    -------
+    steady_state : SteadyState or None
+        The steady state, or None if the iteration did not converge or
+        converged to a fixed point that is not asymptotically stable.
+    """
+    generate_equations(model)
+    rhs = get_rhs(model)
+    x0 = get_initial_species(model)
+    scale = max(numpy.max(numpy.abs(x0)), 1.0) if len(x0) else 1.0
+    stoich = get_stoichiometry(model)
+    if not numpy.any(stoich):
+        return SteadyState(model, x0, x0.copy(), 0.0)
+    # The columns of basis are an orthonormal basis of the stoichiometric
+    # subspace, the rest of the space is spanned by conservation laws
+    _, svals, vh = numpy.linalg.svd(stoich.T)
+    rank = int(numpy.sum(svals > 1e-9 * svals[0]))
+    basis = vh[:rank].T
+
+    x = x0.copy()
+    fx = basis.T.dot(rhs(x))
+    for _ in range(max_iter):
+        if numpy.max(numpy.abs(fx)) < tol * scale:
+            break
+        jac = basis.T.dot(get_jacobian(rhs, x)).dot(basis)
+        dz = numpy.linalg.lstsq(jac, -fx, rcond=None)[0]
+        dx = basis.dot(dz)
+        # Damped step keeping amounts non-negative and reducing the
+        # residual
+        step = 1.0
+        while step > 1e-6:
+            x_new = x + step * dx
+            if numpy.all(x_new > -tol * scale):
+                fx_new = basis.T.dot(rhs(x_new))
+                if numpy.linalg.norm(fx_new) < numpy.linalg.norm(fx):
+                    break
+            step *= 0.5
+        else:
+            logger.info('Newton iteration stalled.')
+            return None
+        x, fx = x_new, fx_new
+    else:
+        logger.info('Newton iteration did not converge.')
+        return None
+    x = numpy.maximum(x, 0.0)
+
+    # The steady state is stable if the Jacobian restricted to the
+    # stoichiometric subspace only has eigenvalues with negative real part
+    jac = basis.T.dot(get_jacobian(rhs, x)).dot(basis)
+    max_real = numpy.max(numpy.real(numpy.linalg.eigvals(jac)))
+    if max_real >= 0:
+        logger.info('Steady state is not asymptotically stable.')
+        return None
+    return SteadyState(model, x0, x, -1.0 / max_real)
+
+
+def get_rhs(model):
+    """Return a function of the species amounts giving their derivatives."""
+    return lambdify_species(model, model.odes)
+
+
+def lambdify_species(model, exprs):
+    """Return a numerical function of the species amounts evaluating
+    expressions of a model.
+
+    The function takes an array whose first axis runs over species and
+    returns an array whose first axis runs over the expressions, so it can
+    be evaluated at several states at once.
+    """
+    species_syms = [sympy.Symbol('__s%d' % i)
+                    for i in range(len(model.species))]
+    expr_subs = {expr: expr.expand_expr(expand_observables=True)
+                 for expr in model.expressions}
+    param_subs = {param: param.value for param in model.parameters}
+    exprs = [sympy.sympify(expr).xreplace(expr_subs).xreplace(param_subs)
+             for expr in exprs]
+    fun = sympy.lambdify(species_syms, exprs, 'numpy')
+
+    def evaluate(x):
+        x = numpy.asarray(x, dtype=float)
+        # Constant expressions are broadcast to the shape of the states
+        return numpy.array([numpy.broadcast_to(val, x.shape[1:])
+                            for val in fun(*x)], dtype=float)
+    return evaluate
+
+
+def get_jacobian(rhs, x):
+    """Return the Jacobian of rhs at x by forward differences."""
+    fx = rhs(x)
+    jac = numpy.empty((len(fx), len(x)))
+    for j in range(len(x)):
+        h = 1e-7 * max(abs(x[j]), 1.0)
+        xh = x.copy()
+        xh[j] += h
+        jac[:, j] = (rhs(xh) - fx) / h
+    return jac
+
+
+def get_initial_species(model):
+    """Return the initial amount of each species of a model."""
+    x0 = numpy.zeros(len(model.species))
+    for initial in model.initials:
+        idx = model.get_species_index(initial.pattern)
+        value = initial.value
+        x0[idx] = value.get_value() if hasattr(value, 'get_value') \
+            else value.value
+    return x0
+
+
+def get_stoichiometry(model):
+    """Return the stoichiometric matrix of a model, with a row for each
+    species and a column for each reaction."""
+    stoich = numpy.zeros((len(model.species), len(model.reactions)))
+    for j, reaction in enumerate(model.reactions):
+        for idx in reaction['reactants']:
+            stoich[idx, j] -= 1
+        for idx in reaction['products']:
+            stoich[idx, j] += 1
+    return stoich
@@ -1,39 +1,59 @@
 from bioagents.tra import kappa_client
-__all__ = ['TRA', 'get_ltl_from_pattern', 'apply_condition',
-           'get_create_observable', 'pysb_to_kappa', 'get_sim_result',
+__all__ = ['TRA', 'get_ltl_from_pattern', 'get_ltl_from_multi_pattern',
+           'apply_condition', 'get_create_observable', 'pysb_to_kappa',
+           'get_sim_result', 'TrajectoryBundle',
            'get_all_patterns', 'TemporalPattern', 'TimeInterval',
            'InvalidTemporalPatternError', 'InvalidTimeIntervalError',
            'MolecularCondition', 'MolecularQuantity',
            'MolecularQuantityReference', 'InvalidMolecularConditionError',
            'InvalidMolecularQuantityError',
-           'InvalidMolecularQuantityRefError', 'SimulatorError']
+           'InvalidMolecularQuantityRefError', 'SimulatorError',
+           'InvalidSimulatorError', 'SIMULATORS',
+           'get_sat_rate_interval', 'get_conditions_key',
+           'get_dose_response_summary']
 import os
 import numpy
+import hashlib
 import logging
-from time import sleep
 from copy import deepcopy
+from concurrent.futures import Future, ThreadPoolExecutor
+from numpy.lib.recfunctions import unstructured_to_structured
 from datetime import datetime
 import sympy.physics.units as units
 import indra.statements as ist
 import indra.assemblers.pysb.assembler as pa
 from indra.assemblers.english import assembler as english_assembler
 from pysb import Observable
-from pysb.integrate import Solver
+from pysb.simulator import ScipyOdeSimulator
 from pysb.export.kappa import KappaExporter
 from pysb.core import ComponentDuplicateNameError
 import bioagents.tra.model_checker as mc
-import matplotlib
-from bioagents import BioagentException, get_img_path
-
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from bioagents.tra.trajectories import TrajectoryBundle
+from bioagents.tra.steady_state import find_steady_state
+from bioagents.tra import ssa
+from matplotlib.figure import Figure
+from matplotlib.patches import Rectangle
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from bioagents import BioagentException, LRUCache, get_img_path
 
 
 logger = logging.getLogger('TRA')
 
+# Below this satisfaction rate of the given pattern, alternative patterns
+# are looked for, and an alternative pattern is suggested if it is
+# satisfied above the second rate
+SUGGESTION_SAT_RATE = 0.3
+PATTERN_SAT_RATE = 0.5
+
+# The simulators that can be requested: Kappa, ODEs, and the in-process
+# stochastic simulator, which uses tau-leaping unless Gillespie's direct
+# method is requested since the latter simulates every single event
+SIMULATORS = ('kappa', 'ode', 'ssa', 'tau_leaping', 'direct')
+
 
 class TRA(object):
-    def __init__(self, use_kappa=True, use_kappa_rest=False):
+    def __init__(self, use_kappa=True, use_kappa_rest=False,
+                 num_kappa_runtimes=2):
         kappa_mode_label = 'rest' if use_kappa_rest else 'standard'
         if not use_kappa:
             self.ode_mode = True
@@ -41,71 +61,148 @@ class TRA(object):
         else:
             self.ode_mode = False
             try:
-                self.kappa = kappa_client.KappaRuntime('TRA_simulations',
-                                                       use_rest=use_kappa_rest)
+                self.kappa = \
+                    kappa_client.KappaRuntimePool(num_kappa_runtimes,
+                                                  'TRA_simulations',
+                                                  use_rest=use_kappa_rest)
                 logger.info('Using kappa %s.' % kappa_mode_label)
             except Exception as e:
                 logger.error('Could not use kappa %s.' % kappa_mode_label)
                 logger.exception(e)
                 self.ode_mode = True
+        # The simulator used unless another one is requested
+        self.simulator = 'ode' if self.ode_mode else 'kappa'
+        # The number of stochastic simulations to start with, to add in
+        # each subsequent round, and to run at most when checking a property
+        self.min_sim = 2
+        self.sim_batch = 2
+        self.max_sim = 20
+        # In adaptive ODE mode, simulations end once the observables can
+        # change by less than ss_tol (relative) over the remaining time
+        # and output is refined where an observable changes by more than
+        # refine_tol (relative to its range) between time points.
+        self.adaptive_ode = True
+        self.ss_tol = 1e-3
+        self.refine_tol = 0.05
+        # In ODE mode, patterns about the eventual value of an observable
+        # are checked at the steady state of the model when possible,
+        # see check_steady_state
+        self.use_steady_state = True
+        # Simulation results by model, conditions, time horizon and
+        # simulator, see run_simulations
+        self.result_cache = LRUCache(32)
+        # Figures are rendered on a background thread and cached by the
+        # hash of the data they show, see render_figure
+        self.plot_executor = ThreadPoolExecutor(max_workers=1)
+        self.figure_cache = LRUCache(64)
+        # The number of processes used to run batches of ODE simulations
+        self.num_processors = os.cpu_count() or 1
+        # The last model exported to Kappa, the key of its content (see
+        # get_kappa_export_key) and its Kappa code
+        self._kappa_export = None
         return
 
-    def check_property(self, model, pattern, conditions=None):
-        # TODO: handle multiple entities (observables) in pattern
-        # TODO: set max_time based on some model property if not given
-        # TODO: make number of simulations and number of time points adaptive
-
-        # Make an observable for the simulations
-        logger.info('Trying to make an observable for: %s',
-                    pattern.entities[0])
-        obs = get_create_observable(model, pattern.entities[0])
+    def check_property(self, model, pattern, conditions=None,
+                       model_key=None, simulator=None):
+        simulator = self.get_simulator(simulator)
+        deterministic = (simulator == 'ode')
+        # Make observables for the simulations
+        logger.info('Trying to make observables for: %s',
+                    ', '.join(str(entity) for entity in pattern.entities))
+        obs_list = [get_create_observable(model, entity)
+                    for entity in pattern.entities]
+        obs = obs_list[0]
+        multi_entity = (len(obs_list) > 1)
 
         # Make pattern
-        fstr = get_ltl_from_pattern(pattern, obs)
+        if multi_entity:
+            fstr = get_ltl_from_multi_pattern(pattern, obs_list)
+        else:
+            fstr = get_ltl_from_pattern(pattern, obs)
         given_pattern = (fstr is not None)
 
         # Set the time limit for the simulations
         if pattern.time_limit is None:
             max_time = 10000.0
         elif pattern.time_limit.ub > 0:
-            max_time = pattern.time_limit.get_ub_seconds()
+            max_time = float(pattern.time_limit.get_ub_seconds())
         # The numer of time points to get output at
         num_times = 100
         # The periof at which the output is sampled
-        plot_period = int(1.0*max_time / num_times)
+        plot_period = 1.0*max_time / num_times
         if pattern.time_limit and pattern.time_limit.lb > 0:
-            min_time = pattern.time_limit.get_lb_seconds()
-            min_time_idx = int(num_times * (1.0*min_time / max_time))
+            min_time = float(pattern.time_limit.get_lb_seconds())
         else:
-            min_time_idx = 0
-
-        # The number of independent simulations to perform
-        num_sim = 2
-        # Run simulations
-        results = self.run_simulations(model, conditions, num_sim,
-                                       min_time_idx, max_time,
-                                       plot_period)
-
-        results_copy = deepcopy(results)
-        yobs_list = [yobs for _, yobs in results]
-
-        # Discretize observations
-        # WARNING: yobs is changed by discretize_obs in place
-        thresholds = [self.discretize_obs(model, yobs, obs.name)
-                      for yobs in yobs_list]
+            min_time = 0
+
+        # If the pattern is found to hold at steady state, only the short
+        # simulation confirming the steady state is needed. Otherwise, we
+        # simulate to look for alternatives.
+        if deterministic and self.use_steady_state and given_pattern and \
+                not multi_entity:
+            holds, results = self.check_steady_state(model, pattern, obs,
+                                                     conditions, max_time,
+                                                     min_time, model_key)
+            if holds:
+                thresholds = get_thresholds(model, obs_list, results)
+                fig_future = self.plot_results(results, pattern.entities[0],
+                                               obs.name, thresholds[obs.name])
+                return 1.0, (1.0, 1.0), 1, None, None, fig_future
+
+        # Run simulations in batches until the satisfaction rate of the
+        # given pattern is known with enough confidence to make a decision
+        # or the budget of simulations runs out. ODE simulations are
+        # deterministic so a single one is sufficient.
+        bundles = []
+        yobs_list = []
+        thresholds = None
+        truths = []
+        while True:
+            if deterministic:
+                num_new = 1
+            elif not yobs_list:
+                num_new = self.min_sim
+            else:
+                num_new = min(self.sim_batch, self.max_sim - len(yobs_list))
+            new_results = self.run_simulations(model, conditions, num_new,
+                                               min_time, max_time,
+                                               plot_period, model_key,
+                                               len(yobs_list), simulator)
+            bundles.append(new_results)
+            # The thresholds are set based on the first batch of
+            # simulations and used for the whole ensemble
+            if thresholds is None:
+                thresholds = get_thresholds(model, obs_list, new_results)
+            # Discretize observations
+            for yobs_bool in new_results.discretize(thresholds):
+                yobs_list.append(yobs_bool)
+                # Run model checker on the given pattern, over the whole
+                # trajectory at once, whatever the number of observables
+                if given_pattern:
+                    truth = mc.check_formula(fstr, yobs_bool)
+                    logger.info('Main property %s' % truth)
+                    truths.append(truth)
+            num_sim = len(yobs_list)
+            if not given_pattern or deterministic or \
+                    num_sim >= self.max_sim:
+                break
+            sat_interval = get_sat_rate_interval(numpy.count_nonzero(truths),
+                                                 num_sim)
+            if is_sat_rate_decided(sat_interval):
+                break
+        logger.info('Ran %d simulations.' % num_sim)
 
-        fig_path = self.plot_results(results_copy, pattern.entities[0],
-                                     obs.name, thresholds[0])
+        results = TrajectoryBundle.concatenate(bundles)
+        fig_future = self.plot_results(results, pattern.entities[0],
+                                       obs.name, thresholds[obs.name])
         # We check for the given pattern
         if given_pattern:
-            truths = []
-            for yobs in yobs_list:
-                # Run model checker on the given pattern
-                MC = mc.ModelChecker(fstr, yobs)
-                logger.info('Main property %s' % MC.truth)
-                truths.append(MC.truth)
             sat_rate = numpy.count_nonzero(truths) / (1.0*num_sim)
-            make_suggestion = (sat_rate < 0.3)
+            sat_interval = get_sat_rate_interval(numpy.count_nonzero(truths),
+                                                 num_sim, deterministic)
+            # Alternative patterns are only suggested for single entities
+            make_suggestion = (sat_rate < SUGGESTION_SAT_RATE) and \
+                not multi_entity
             if make_suggestion:
                 logger.info('MAKING SUGGESTION with sat rate %.2f.' % sat_rate)
         else:
@@ -113,7 +210,7 @@ class TRA(object):
 
         # If no suggestion is to be made, we return
         if not make_suggestion:
-            return sat_rate, num_sim, None, None, fig_path
+            return sat_rate, sat_interval, num_sim, None, None, fig_future
 
         # Run model checker on all patterns
         all_patterns = get_all_patterns(obs.name)
@@ -121,17 +218,109 @@ class TRA(object):
             logger.info('Testing pattern: %s' % kpat)
             truths = []
             for yobs in yobs_list:
-                MC = mc.ModelChecker(fs, yobs)
-                logger.info('Property %s' % MC.truth)
-                truths.append(MC.truth)
+                truth = mc.check_formula(fs, yobs)
+                logger.info('Property %s' % truth)
+                truths.append(truth)
             sat_rate_new = numpy.count_nonzero(truths) / (1.0*num_sim)
-            if sat_rate_new > 0.5:
+            if sat_rate_new > PATTERN_SAT_RATE:
                 if not given_pattern:
-                    return sat_rate_new, num_sim, kpat, pat_obj, fig_path
+                    sat_interval = \
+                        get_sat_rate_interval(numpy.count_nonzero(truths),
+                                              num_sim, deterministic)
+                    return sat_rate_new, sat_interval, num_sim, kpat, \
+                        pat_obj, fig_future
                 else:
-                    return sat_rate, num_sim, kpat, pat_obj, fig_path
-
-    def compare_conditions(self, model, condition_agent, target_agent, up_dn):
+                    return sat_rate, sat_interval, num_sim, kpat, pat_obj, \
+                        fig_future
+
+    def check_steady_state(self, model, pattern, obs, conditions, max_time,
+                           min_time=0, model_key=None):
+        """Return whether a pattern about the eventual value of an
+        observable holds, decided at the steady state of the model, along
+        with the simulation confirming the steady state.
+
+        Eventual value and sustained patterns only depend on the value of
+        the observable at the end of the simulation. If the model has a
+        stable steady state reached from its initial state well within
+        max_time, that value is the steady state value, which is
+        discretized the same way as simulated values are (see
+        get_thresholds). Newton iteration may converge to a steady state
+        that is not the one reached from the initial state (e.g. in
+        bistable models) and the relaxation time does not bound slow
+        transients far from the steady state, so the steady state is only
+        accepted if a single simulation over ten relaxation times reaches
+        it. As for full simulations, the simulation is only considered
+        from min_time on, so its value at min_time is the start value the
+        steady state value is discretized against. None is returned in
+        place of the truth value if the pattern is of another type or
+        cannot be decided this way, in which case the model has to be
+        simulated in full.
+        """
+        if pattern.pattern_type == 'sustained':
+            val = 1
+        elif pattern.pattern_type == 'eventual_value':
+            val = 1 if pattern.value.value == 'high' else 0
+        else:
+            return None, None
+        key = ('steady_state', model_key, tuple(model.observables.keys()),
+               get_conditions_key(conditions))
+        # Entries are tuples since the steady state may be None
+        entry = self.result_cache.get(key) if model_key else None
+        if entry is None:
+            try:
+                model_sim = self.condition_model(model, conditions)
+                entry = (find_steady_state(model_sim),)
+            except Exception as e:
+                logger.info('Could not find steady state.')
+                logger.exception(e)
+                entry = (None,)
+            if model_key:
+                self.result_cache[key] = entry
+        steady_state = entry[0]
+        # The steady state has to be approached closely by the end of the
+        # simulation
+        if steady_state is None or \
+                10 * steady_state.relaxation_time > max_time:
+            return None, None
+        # Every observable has to be at its steady state value at the end
+        # of the confirming simulation, which lasts at least until min_time
+        sim_time = max(10 * steady_state.relaxation_time, min_time, 1.0)
+        results = self.run_simulations(model, conditions, 1, min_time,
+                                       sim_time, sim_time / 100, model_key,
+                                       simulator='ode')
+        for obs_name in results.obs_names:
+            sim_val = results.get(obs_name)[0, -1]
+            obs_ss_val = steady_state.get_obs_values(obs_name)[1]
+            obs_margin = 0.01 * get_obs_total(model,
+                                              model.observables[obs_name])
+            if abs(sim_val - obs_ss_val) > obs_margin:
+                logger.info('Steady state of %s not reached, %.2f instead '
+                            'of %.2f.' % (obs_name, sim_val, obs_ss_val))
+                return None, None
+        start_val = results.get(obs.name)[0, 0]
+        ss_val = steady_state.get_obs_values(obs.name)[1]
+        total = get_obs_total(model, obs)
+        margin = 0.01 * total
+        # If starts low, the threshold only depends on the total value
+        if start_val < 1e-5:
+            thresh = 0.3 * total
+            if abs(ss_val - thresh) < margin:
+                return None, None
+            is_high = (ss_val > thresh)
+        # If starts high, the threshold also depends on the range of the
+        # trajectory, which we only know to include the start and the
+        # steady state
+        elif ss_val < start_val + 0.1 * total - margin:
+            is_high = False
+        else:
+            return None, None
+        holds = (is_high == bool(val))
+        logger.info('Steady state value of %s is %.2f, pattern %s.' %
+                    (obs.name, ss_val, 'holds' if holds else 'does not hold'))
+        return holds, results
+
+    def compare_conditions(self, model, condition_agent, target_agent, up_dn,
+                           model_key=None, simulator=None):
         obs = get_create_observable(model, target_agent)
         cond_quant = MolecularQuantityReference('total', condition_agent)
         all_results = []
@@ -140,15 +329,25 @@ class TRA(object):
         plot_period = time_ul / (nt - 1)
         ts = numpy.linspace(0, time_ul, nt)
         mults = [0.0, 100.0]
+        all_tspans = []
         for mult in mults:
             condition = MolecularCondition('multiple', cond_quant, mult)
             results = self.run_simulations(model, [condition], 1, 0,
-                                           time_ul, plot_period)
-            obs_values = results[0][1][obs.name]
-            all_results.append(obs_values)
-        # Plotting
-        fig_path = self.plot_compare_conditions(ts, all_results, target_agent,
-                                                obs.name)
+                                           time_ul, plot_period, model_key,
+                                           simulator=simulator)
+            all_tspans.append(results.tspan)
+            all_results.append(results.get(obs.name)[0])
+        # Plotting on the union of the output grids of the simulations
+        ts_plot = numpy.union1d(*all_tspans)
+        fig_future = self.plot_compare_conditions(
+            ts_plot, [numpy.interp(ts_plot, tspan, obs_values)
+                      for tspan, obs_values in zip(all_tspans, all_results)],
+            target_agent, obs.name)
+        # The simulations may have been sampled on different grids and
+        # may have ended early at steady state so we compare them on a
+        # common uniform grid, holding the final values constant
+        all_results = [numpy.interp(ts, tspan, obs_values)
+                       for tspan, obs_values in zip(all_tspans, all_results)]
         diff = numpy.sum(all_results[-1][:len(ts)] - all_results[0][:len(ts)])
         logger.info('TRA condition difference: %.2f' % diff)
         # If there is a decrease in the observable, we return True
@@ -159,100 +358,305 @@ class TRA(object):
         else:
             res = 'no_decrease' if (diff < 0) else 'yes_increase'
 
-        return res, fig_path
+        return res, fig_future
+
+    def dose_response(self, model, condition_agent, target_agent,
+                      multipliers=None, model_key=None):
+        """Return the response of an agent's amount to scaling another one's.
+
+        The initial amount of the condition agent is multiplied by each of
+        the multipliers, and the response is the mean amount of the target
+        agent over the simulated time. All multipliers are simulated in a
+        single batched ODE solver run.
+
+        Parameters
+        ----------
+        model : pysb.Model
+            The model to simulate.
+        condition_agent : indra.statements.Agent
+            The agent whose initial amount is scaled.
+        target_agent : indra.statements.Agent
+            The agent whose amount is measured.
+        multipliers : list[float] or None
+            The multipliers to apply. By default, 9 log-spaced values from
+            0.01 to 100.
+        model_key : str or None
+            A key identifying the model, used to cache the responses.
+
+        Returns
+        -------
+        multipliers : numpy.ndarray
+            The multipliers in increasing order.
+        responses : numpy.ndarray
+            The response at each multiplier.
+        summary : dict
+            Summary statistics of the curve, see get_dose_response_summary.
+        fig_future : concurrent.futures.Future
+            A future of the path of a figure of the curve.
+        """
+        obs = get_create_observable(model, target_agent)
+        monomer_name = pa._n(condition_agent.name)
+        if monomer_name not in model.monomers.keys():
+            raise MissingMonomerError('%s is not in the model ' %
+                                      condition_agent.name, condition_agent)
+        ic_name = monomer_name + '_0'
+        param_names = [param.name for param in model.parameters]
+        if ic_name not in param_names:
+            msg = 'No initial amount for %s' % condition_agent.name
+            raise InvalidMolecularConditionError(msg)
+        if multipliers is None:
+            multipliers = numpy.logspace(-2, 2, 9)
+        multipliers = numpy.sort(numpy.asarray(multipliers, dtype=float))
+        time_ul = 10000
+        ts = numpy.linspace(0, time_ul, 101)
+
+        key = ('dose_response', model_key, tuple(model.observables.keys()),
+               ic_name, tuple(multipliers))
+        responses = self.result_cache.get(key) if model_key else None
+        if responses is None:
+            # Each row holds the parameter values of one simulation
+            param_values = numpy.tile([param.value for param in
+                                       model.parameters],
+                                      (len(multipliers), 1))
+            param_values[:, param_names.index(ic_name)] *= multipliers
+            logger.info('Starting %d simulations' % len(multipliers))
+            sim = ScipyOdeSimulator(model, tspan=ts)
+            res = sim.run(param_values=param_values)
+            all_yobs = res.observables if isinstance(res.observables, list) \
+                else [res.observables]
+            responses = numpy.array([numpy.mean(yobs[obs.name])
+                                     for yobs in all_yobs])
+            if model_key:
+                self.result_cache[key] = responses
+        summary = get_dose_response_summary(multipliers, responses)
+        agent_strs = [english_assembler._assemble_agent_str(agent).agent_str
+                      for agent in (condition_agent, target_agent)]
+        fig_future = self.render_figure(render_dose_response, obs.name,
+                                        multipliers, responses,
+                                        summary['ec50'], *agent_strs)
+        return multipliers, responses, summary, fig_future
+
+    def sensitivity(self, model, target_agent, rel_step=0.1,
+                    model_key=None):
+        """Return the sensitivities of an agent's amount to each parameter.
+
+        The response is the mean amount of the target agent over the
+        simulated time, and the sensitivity to a parameter is estimated by
+        a forward finite difference in which the parameter is increased by
+        rel_step of its value. The sensitivity is the relative change of
+        the response divided by rel_step, where responses below one
+        molecule are taken as one to avoid dividing by zero. All perturbed
+        simulations are run in one batch over a pool of processes.
+
+        Parameters
+        ----------
+        model : pysb.Model
+            The model to simulate.
+        target_agent : indra.statements.Agent
+            The agent whose amount is measured.
+        rel_step : float
+            The relative perturbation of each parameter.
+        model_key : str or None
+            A key identifying the model, used to cache the sensitivities.
+
+        Returns
+        -------
+        sensitivities : list[tuple]
+            Tuples of parameter name, parameter type ('initial' or 'rate'),
+            and sensitivity, ordered by decreasing absolute sensitivity.
+            Parameters with zero value are left out.
+        """
+        obs = get_create_observable(model, target_agent)
+        key = ('sensitivity', model_key, tuple(model.observables.keys()),
+               rel_step)
+        sensitivities = self.result_cache.get(key) if model_key else None
+        if sensitivities is not None:
+            return list(sensitivities)
+        initial_params = {initial.value.name for initial in model.initials}
+        params = [param for param in model.parameters if param.value != 0]
+        param_names = [param.name for param in model.parameters]
+        # The first row holds the nominal parameter values and each
+        # subsequent one has a single parameter perturbed
+        base_values = [param.value for param in model.parameters]
+        param_values = numpy.tile(base_values, (len(params) + 1, 1))
+        for i, param in enumerate(params):
+            param_values[i+1, param_names.index(param.name)] *= 1 + rel_step
+        ts = numpy.linspace(0, 10000, 101)
+        logger.info('Starting %d simulations' % len(param_values))
+        sim = ScipyOdeSimulator(model, tspan=ts)
+        res = sim.run(param_values=param_values,
+                      num_processors=self.num_processors)
+        all_yobs = res.observables if isinstance(res.observables, list) \
+            else [res.observables]
+        responses = numpy.array([numpy.mean(yobs[obs.name])
+                                 for yobs in all_yobs])
+        scale = max(abs(responses[0]), 1.0)
+        rel_changes = (responses[1:] - responses[0]) / (scale * rel_step)
+        sensitivities = [(param.name,
+                          'initial' if param.name in initial_params
+                          else 'rate', float(sens))
+                         for param, sens in zip(params, rel_changes)]
+        sensitivities.sort(key=lambda x: abs(x[2]), reverse=True)
+        if model_key:
+            self.result_cache[key] = list(sensitivities)
+        return sensitivities
 
     def plot_compare_conditions(self, ts, results, agent, obs_name):
-        plt.figure()
-        plt.ion()
-        plt.plot(ts, results[0][:len(ts)], label='Without condition')
-        plt.plot(ts, results[-1][:len(ts)], label='With condition')
-        plt.xlabel('Time (s)')
-        plt.ylabel('Amount (molecules)')
         agent_str = english_assembler._assemble_agent_str(agent).agent_str
-        plt.title('Simulation results for %s' % agent_str)
-        plt.legend()
-        fig_path = get_img_path(obs_name + '.png')
-        plt.savefig(fig_path)
-        return fig_path
+        curves = [numpy.array(result[:len(ts)], dtype=float)
+                  for result in (results[0], results[-1])]
+        return self.render_figure(render_compare_conditions, obs_name,
+                                  numpy.array(ts, dtype=float), curves,
+                                  agent_str)
 
     def plot_results(self, results, agent, obs_name, thresh=50):
-        plt.figure()
-        plt.ion()
-        max_val_lim = max(max((numpy.max(results[0][1][obs_name]) + 0.25*numpy.max(results[0][1][obs_name])), 101.0),
-                          thresh)
-        max_time = max([result[0][-1] for result in results])
-        lr = matplotlib.patches.Rectangle((0, 0), max_time, thresh, color='red',
-                                          alpha=0.1)
-        hr = matplotlib.patches.Rectangle((0, thresh), max_time,
-                                          max_val_lim-thresh,
-                                          color='green', alpha=0.1)
-        ax = plt.gca()
-        ax.add_patch(lr)
-        ax.add_patch(hr)
-        if thresh + 0.05*max_val_lim < max_val_lim:
-            plt.text(10, thresh + 0.05*max_val_lim, 'High', fontsize=10)
-        plt.text(10, thresh - 0.05*max_val_lim, 'Low')
-        for tspan, yobs in results:
-            plt.plot(tspan, yobs[obs_name])
-        plt.ylim(-5, max_val_lim)
-        plt.xlim(-100, 10100)
-        plt.xlabel('Time (s)')
-        plt.ylabel('Amount (molecules)')
         agent_str = english_assembler._assemble_agent_str(agent).agent_str
-        plt.title('Simulation results for %s' % agent_str)
-        fig_path = get_img_path(obs_name + '.png')
-        plt.savefig(fig_path)
-        return fig_path
+        return self.render_figure(render_results, obs_name, results.tspan,
+                                  results.get(obs_name), float(thresh),
+                                  agent_str)
+
+    def render_figure(self, render_fun, obs_name, *args):
+        """Render a figure on the background thread, unless cached.
+
+        Parameters
+        ----------
+        render_fun : function
+            A function taking the path of the figure to make, followed by
+            args.
+        obs_name : str
+            The name of the observable the figure is about, used as the
+            base of the file name.
+        args :
+            The arguments of render_fun, consisting of numpy arrays,
+            lists or tuples of these, and other values with a fixed string
+            representation.
+
+        Returns
+        -------
+        fig_future : concurrent.futures.Future
+            A future whose result is the path of the figure.
+        """
+        key = get_figure_key(render_fun.__name__, obs_name, *args)
+        fig_path = self.figure_cache.get(key)
+        if fig_path is not None and os.path.exists(fig_path):
+            logger.info('Using cached figure %s' % fig_path)
+            fig_future = Future()
+            fig_future.set_result(fig_path)
+            return fig_future
+
+        def render():
+            fig_path = get_img_path('%s_%s.png' % (obs_name, key[:8]))
+            render_fun(fig_path, *args)
+            self.figure_cache[key] = fig_path
+            return fig_path
+        return self.plot_executor.submit(render)
+
+    def get_simulator(self, simulator=None):
+        """Return the simulator to use given the one requested, if any."""
+        if simulator is None:
+            return self.simulator
+        if simulator not in SIMULATORS:
+            raise InvalidSimulatorError('Unknown simulator %s' % simulator)
+        if simulator == 'kappa' and self.ode_mode:
+            logger.warning('Kappa is not available, using ODEs instead.')
+            return 'ode'
+        return simulator
+
+    def run_simulations(self, model, conditions, num_sim, min_time,
+                        max_time, plot_period, model_key=None, first_sim=0,
+                        simulator=None):
+        """Return a TrajectoryBundle of simulations of the model under the
+        conditions, from min_time on.
+
+        If a model_key identifying the model is given, results are stored in
+        the result cache and the first_sim-th to the
+        (first_sim + num_sim - 1)-th simulations of the model under the same
+        conditions and time horizon are returned, running only those that
+        are not in the cache yet. ODE simulations are deterministic so a
+        single one is run and cached for any number of simulations. The
+        returned bundle is a view of the cached one.
+        """
+        simulator = self.get_simulator(simulator)
+        deterministic = (simulator == 'ode')
+        if model_key is None:
+            runs = self._run_simulations(model, conditions, num_sim,
+                                         min_time, max_time, plot_period,
+                                         simulator)
+        else:
+            mode = 'ode_adaptive' if deterministic and self.adaptive_ode \
+                else simulator
+            key = (model_key, tuple(model.observables.keys()),
+                   get_conditions_key(conditions), min_time, max_time,
+                   plot_period, mode)
+            cached_runs = self.result_cache.get(key)
+            num_cached = 0 if cached_runs is None else len(cached_runs)
+            num_total = 1 if deterministic else first_sim + num_sim
+            if num_cached < num_total:
+                new_runs = \
+                    self._run_simulations(model, conditions,
+                                          num_total - num_cached,
+                                          min_time, max_time, plot_period,
+                                          simulator)
+                cached_runs = new_runs if cached_runs is None else \
+                    TrajectoryBundle.concatenate([cached_runs, new_runs])
+                self.result_cache[key] = cached_runs
+            else:
+                logger.info('Using cached simulation results.')
+            if deterministic:
+                runs = cached_runs.repeat(num_sim)
+            else:
+                runs = cached_runs[first_sim:first_sim + num_sim]
+        return runs.from_time(min_time)
 
-    def run_simulations(self, model, conditions, num_sim, min_time_idx,
-                        max_time, plot_period):
+    def _run_simulations(self, model, conditions, num_sim, min_time,
+                         max_time, plot_period, simulator):
         self.sol = None
-        results = []
-        for i in range(num_sim):
-            # Apply molecular condition to model
+        # Apply molecular condition to model
+        try:
+            model_sim = self.condition_model(model, conditions)
+        except MissingMonomerError as e:
+            raise e
+        except Exception as e:
+            logger.exception(e)
+            msg = 'Applying molecular condition failed.'
+            raise InvalidMolecularConditionError(msg)
+        # Run the simulations
+        if simulator in ('ssa', 'tau_leaping', 'direct'):
+            logger.info('Starting %d %s simulations' % (num_sim, simulator))
+            method = 'direct' if simulator == 'direct' else 'tau_leaping'
             try:
-                model_sim = self.condition_model(model, conditions)
-            except MissingMonomerError as e:
-                raise e
+                return self.simulate_ssa(model_sim, max_time, plot_period,
+                                         num_sim, method)
             except Exception as e:
                 logger.exception(e)
-                msg = 'Applying molecular condition failed.'
-                raise InvalidMolecularConditionError(msg)
-            # Run a simulation
-            logger.info('Starting simulation %d' % (i+1))
-            if not self.ode_mode:
-                try:
-                    tspan, yobs = self.simulate_kappa(model_sim, max_time,
-                                                      plot_period)
-                except Exception as e:
-                    logger.exception(e)
-                    raise SimulatorError('Kappa simulation failed.')
-            else:
-                tspan, yobs = self.simulate_odes(model_sim, max_time,
-                                                 plot_period)
-            # Get and plot observable
-            start_idx = min(min_time_idx, len(yobs))
-            yobs_from_min = yobs[start_idx:]
-            tspan = tspan[start_idx:]
-            results.append((tspan, yobs_from_min))
-        return results
-
-    def discretize_obs(self, model, yobs, obs_name):
-        # TODO: This needs to be done in a model/observable-dependent way
-        default_total_val = 100
-        start_val = yobs[obs_name][0]
-        max_val = numpy.max(yobs[obs_name])
-        min_val = numpy.min(yobs[obs_name])
-        # If starts low, discretize wrt total value
-        if start_val < 1e-5:
-            thresh = 0.3 * default_total_val
-        # If starts high, discretize wrt range with a certain minimum
+                raise SimulatorError('Stochastic simulation failed.')
+        elif simulator == 'kappa':
+            logger.info('Starting %d simulations' % num_sim)
+            # If the conditions only change parameter values, the model
+            # loaded into Kappa is reused with those values overwritten
+            overwrites = get_parameter_overwrites(model, model_sim)
+            if overwrites is not None:
+                model_sim = model
+            try:
+                runs = self.simulate_kappa(model_sim, max_time, plot_period,
+                                           num_sim, overwrites)
+            except Exception as e:
+                logger.exception(e)
+                raise SimulatorError('Kappa simulation failed.')
         else:
-            thresh = start_val + max(0.5*(max_val - min_val),
-                                     default_total_val * 0.10)
-        for i, v in enumerate(yobs[obs_name]):
-            yobs[obs_name][i] = 1 if v > thresh else 0
-        return thresh
+            runs = []
+            num_times = int(round(max_time / plot_period))
+            for i in range(num_sim):
+                logger.info('Starting simulation %d' % (i+1))
+                if self.adaptive_ode:
+                    runs.append(self.simulate_odes_adaptive(model_sim,
+                                                            max_time,
+                                                            num_times,
+                                                            min_time))
+                else:
+                    runs.append(self.simulate_odes(model_sim, max_time,
+                                                   plot_period))
+        return TrajectoryBundle.from_results(runs)
 
     def condition_model(self, model, conditions):
         # Set up simulation conditions
@@ -264,35 +668,115 @@ class TRA(object):
             model_sim = model
         return model_sim
 
-    def simulate_kappa(self, model_sim, max_time, plot_period):
-        # Export kappa model
-        kappa_model = pysb_to_kappa(model_sim)
-        # Start simulation
-        self.kappa.compile(code_list=[kappa_model])
-        self.kappa.start_sim(plot_period=plot_period,
-                         pause_condition="[T] > %d" % max_time)
-        while True:
-            sleep(0.2)
-            status_json = self.kappa.sim_status()
-            is_running = status_json.get('simulation_progress_is_running')
-            if not is_running:
-                break
-            else:
-                if status_json.get('time_percentage') is not None:
-                    logger.info(
-                        'Sim time percentage: %d' %
-                        status_json.get('simulation_progress_time_percentage')
-                        )
-        tspan, yobs = get_sim_result(self.kappa.sim_plot())
-        self.kappa.reset_project()
-        return tspan, yobs
+    def simulate_kappa(self, model_sim, max_time, plot_period, num_sim=1,
+                       overwrites=None):
+        # Export kappa model, unless it was the last one exported. Since
+        # observables are added to models in place and conditions may
+        # change parameters and initial conditions in place, these are
+        # checked along with identity.
+        export_key = get_kappa_export_key(model_sim)
+        if self._kappa_export is None or \
+                self._kappa_export[0] is not model_sim or \
+                self._kappa_export[1] != export_key:
+            self._kappa_export = (model_sim, export_key,
+                                  pysb_to_kappa(model_sim))
+        kappa_model = self._kappa_export[2]
+        # Run the simulations concurrently and wait for all of them
+        kappa_plots = self.kappa.run_until(kappa_model, max_time, plot_period,
+                                           num_sim, overwrites=overwrites)
+        return [get_sim_result(kappa_plot) for kappa_plot in kappa_plots]
+
+    def simulate_ssa(self, model_sim, max_time, plot_period, num_sim=1,
+                     method='tau_leaping'):
+        ts = numpy.linspace(0, max_time,
+                            int(round(1.0*max_time/plot_period)) + 1)
+        return ssa.simulate_ssa(model_sim, ts, num_sim, method)
 
     def simulate_odes(self, model_sim, max_time, plot_period):
-        ts = numpy.linspace(0, max_time, int(1.0*max_time/plot_period) + 1)
+        ts = numpy.linspace(0, max_time,
+                            int(round(1.0*max_time/plot_period)) + 1)
         if self.sol is None:
-            self.sol = Solver(model_sim, ts)
-        self.sol.run()
-        return ts, self.sol.yobs
+            self.sol = ScipyOdeSimulator(model_sim, tspan=ts)
+        res = self.sol.run(tspan=ts)
+        return ts, res.observables
+
+    def simulate_odes_adaptive(self, model_sim, max_time, num_times,
+                               min_time=0):
+        """Return ODE results on an adaptively chosen, non-uniform time grid.
+
+        The simulation is extended by segments of doubling length and ends
+        before max_time once a steady state is reached (but not before
+        min_time). The output grid is then refined where any observable
+        changes quickly between consecutive time points.
+        """
+        if self.sol is None:
+            self.sol = ScipyOdeSimulator(model_sim)
+        # Find the end of the simulation
+        t_end = min(max_time, max(1.0, max_time / 1024.0))
+        seg_start, y_start = 0.0, None
+        scale = 1.0
+        while True:
+            seg_ts = numpy.linspace(seg_start, t_end, 11)
+            res = self.sol.run(tspan=seg_ts, initials=y_start)
+            y = res.species
+            scale = max(scale, numpy.max(numpy.abs(y)))
+            max_deriv = numpy.max(numpy.abs(numpy.diff(y, axis=0)) /
+                                  numpy.diff(seg_ts)[:, None])
+            if t_end >= max_time:
+                break
+            # The largest change still possible in the remaining time
+            # is small: we consider this to be steady state
+            if t_end >= min_time and \
+                    max_deriv * (max_time - t_end) < self.ss_tol * scale:
+                logger.info('Steady state reached at t=%.1f' % t_end)
+                break
+            seg_start, y_start = t_end, y[-1]
+            t_end = min(max_time, 2 * t_end)
+
+        # Refine the output grid where the observables change quickly
+        ts = numpy.linspace(0, t_end, num_times + 1)
+        yobs = self.sol.run(tspan=ts).observables
+        for _ in range(3):
+            refine = numpy.zeros(len(ts) - 1, dtype=bool)
+            for obs_name in yobs.dtype.names:
+                vals = yobs[obs_name]
+                obs_range = numpy.max(vals) - numpy.min(vals)
+                if obs_range > 0:
+                    refine |= (numpy.abs(numpy.diff(vals)) >
+                               self.refine_tol * obs_range)
+            if not numpy.any(refine) or len(ts) > 4 * num_times:
+                break
+            ts = numpy.sort(numpy.concatenate(
+                [ts, 0.5*(ts[:-1][refine] + ts[1:][refine])]))
+            yobs = self.sol.run(tspan=ts).observables
+        return ts, yobs
+
+
+def get_sat_rate_interval(num_sat, num_sim, deterministic=False, z=1.96):
+    """Return a confidence interval on the rate of satisfying a pattern.
+
+    The interval is the Wilson score interval of a binomial proportion
+    with a normal quantile of z (95% confidence by default). For
+    deterministic simulations the rate is exact and the interval is
+    degenerate.
+    """
+    if num_sim == 0:
+        return 0.0, 1.0
+    rate = 1.0 * num_sat / num_sim
+    if deterministic:
+        return rate, rate
+    denom = 1 + z**2 / num_sim
+    center = (rate + z**2 / (2.0*num_sim)) / denom
+    half_width = z * numpy.sqrt(rate * (1 - rate) / num_sim +
+                                z**2 / (4.0*num_sim**2)) / denom
+    return max(0.0, center - half_width), min(1.0, center + half_width)
+
+
+def is_sat_rate_decided(sat_interval):
+    """Return True if the interval lies on one side of each threshold."""
+    lb, ub = sat_interval
+    return not any(lb < th < ub for th in (SUGGESTION_SAT_RATE,
+                                           PATTERN_SAT_RATE))
 
 
 def get_ltl_from_pattern(pattern, obs):
@@ -353,6 +837,30 @@ def get_ltl_from_pattern(pattern, obs):
     return fstr
 
 
+def get_ltl_from_multi_pattern(pattern, obs_list):
+    """Return an LTL formula of a pattern over several observables.
+
+    The before pattern means that the first entity becomes high before the
+    second one does, and the simultaneous pattern that the entities are
+    high at the same time at some point. Any other pattern has to hold for
+    each entity, as defined in get_ltl_from_pattern.
+    """
+    if not pattern.pattern_type:
+        return None
+    obs_names = [obs.name for obs in obs_list]
+    if pattern.pattern_type == 'before':
+        if len(obs_names) != 2:
+            msg = 'The before pattern needs exactly two entities.'
+            raise InvalidTemporalPatternError(msg)
+        fstr = mc.before_formula(obs_names[0], obs_names[1])
+    elif pattern.pattern_type == 'simultaneous':
+        fstr = mc.simultaneous_formula(obs_names)
+    else:
+        fstr = ' & '.join('(%s)' % get_ltl_from_pattern(pattern, obs)
+                          for obs in obs_list)
+    return fstr
+
+
 def apply_condition(model, condition):
     agent = condition.quantity.entity
     try:
@@ -385,6 +893,157 @@ def apply_condition(model, condition):
     logger.info('New initial condition: %s' % model.parameters[ic_name])
 
 
+def get_parameter_overwrites(model, model_sim):
+    """Return the parameter values in which model_sim differs from model.
+
+    None is returned if the models differ in more than parameter values,
+    for instance if a condition introduced a new initial condition.
+    """
+    if list(model_sim.parameters.keys()) != list(model.parameters.keys()) \
+            or len(model_sim.initials) != len(model.initials):
+        return None
+    return {param.name: param.value for param in model_sim.parameters
+            if param.value != model.parameters[param.name].value}
+
+
+def get_dose_response_summary(multipliers, responses, rel_tol=1e-3):
+    """Return summary statistics of a dose-response curve.
+
+    Parameters
+    ----------
+    multipliers : numpy.ndarray
+        Increasing multipliers of the dose.
+    responses : numpy.ndarray
+        The response at each multiplier.
+    rel_tol : float
+        Changes of the response below this fraction of its magnitude are
+        considered no change.
+
+    Returns
+    -------
+    summary : dict
+        The direction of the response from the lowest to the highest
+        dose ('increase', 'decrease' or 'no_change'), the smallest and
+        largest responses, and the EC50, the multiplier at which the
+        response is halfway between its values at the lowest and the
+        highest dose. The EC50 is interpolated on a log scale if all
+        multipliers are positive and is None if there is no change.
+    """
+    r_low, r_high = responses[0], responses[-1]
+    summary = {'min_response': float(numpy.min(responses)),
+               'max_response': float(numpy.max(responses)),
+               'ec50': None}
+    if abs(r_high - r_low) <= rel_tol * max(abs(r_low), abs(r_high), 1.0):
+        summary['direction'] = 'no_change'
+        return summary
+    summary['direction'] = 'increase' if r_high > r_low else 'decrease'
+    half = 0.5 * (r_low + r_high)
+    log_scale = numpy.all(multipliers > 0)
+    xs = numpy.log10(multipliers) if log_scale else multipliers
+    for i in range(len(responses) - 1):
+        r0, r1 = responses[i], responses[i+1]
+        if r0 != r1 and (r0 - half) * (r1 - half) <= 0:
+            x = xs[i] + (half - r0) / (r1 - r0) * (xs[i+1] - xs[i])
+            summary['ec50'] = float(10**x if log_scale else x)
+            break
+    return summary
+
+
+def get_figure_key(*args):
+    """Return a hash of the data making up a figure."""
+    md5 = hashlib.md5()
+
+    def update(arg):
+        if isinstance(arg, numpy.ndarray):
+            md5.update(arg.tobytes())
+        elif isinstance(arg, (list, tuple)):
+            md5.update(b'(')
+            for elem in arg:
+                update(elem)
+            md5.update(b')')
+        else:
+            md5.update(repr(arg).encode('utf-8'))
+        md5.update(b',')
+    update(args)
+    return md5.hexdigest()
+
+
+def render_results(fig_path, tspan, trajectories, thresh, agent_str):
+    """Save a figure of the trajectories of an observable with its
+    low and high ranges, given as an array of shape (n_sims, n_times)."""
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    first_max = numpy.max(trajectories[0])
+    max_val_lim = max(max(first_max + 0.25*first_max, 101.0), thresh)
+    max_time = tspan[-1]
+    ax.add_patch(Rectangle((0, 0), max_time, thresh, color='red',
+                           alpha=0.1))
+    ax.add_patch(Rectangle((0, thresh), max_time, max_val_lim-thresh,
+                           color='green', alpha=0.1))
+    if thresh + 0.05*max_val_lim < max_val_lim:
+        ax.text(10, thresh + 0.05*max_val_lim, 'High', fontsize=10)
+    ax.text(10, thresh - 0.05*max_val_lim, 'Low')
+    for obs_values in trajectories:
+        ax.plot(tspan, obs_values)
+    ax.set_ylim(-5, max_val_lim)
+    ax.set_xlim(-0.01*max_time, 1.01*max_time)
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('Amount (molecules)')
+    ax.set_title('Simulation results for %s' % agent_str)
+    fig.savefig(fig_path)
+    fig.clear()
+
+
+def render_compare_conditions(fig_path, ts, curves, agent_str):
+    """Save a figure of an observable without and with a condition."""
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    ax.plot(ts, curves[0], label='Without condition')
+    ax.plot(ts, curves[1], label='With condition')
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('Amount (molecules)')
+    ax.set_title('Simulation results for %s' % agent_str)
+    ax.legend()
+    fig.savefig(fig_path)
+    fig.clear()
+
+
+def render_dose_response(fig_path, multipliers, responses, ec50,
+                         condition_str, target_str):
+    """Save a figure of a dose-response curve."""
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    ax.plot(multipliers, responses, marker='o')
+    if numpy.all(multipliers > 0):
+        ax.set_xscale('log')
+    if ec50 is not None:
+        ax.axvline(ec50, color='gray', linestyle='--', label='EC50')
+        ax.legend()
+    ax.set_xlabel('Multiplier of the amount of %s' % condition_str)
+    ax.set_ylabel('Mean amount of %s (molecules)' % target_str)
+    ax.set_title('Dose response of %s' % target_str)
+    fig.savefig(fig_path)
+    fig.clear()
+
+
+def get_conditions_key(conditions):
+    """Return a hashable key of a list of molecular conditions."""
+    if not conditions:
+        return ()
+    key = []
+    for condition in conditions:
+        value = condition.value
+        if isinstance(value, MolecularQuantity):
+            value = (value.quant_type, str(value.value))
+        entity = condition.quantity.entity
+        key.append((condition.condition_type, condition.quantity.quant_type,
+                    entity.name, entity.matches_key(), value))
+    return tuple(key)
+
+
 def get_create_observable(model, agent):
     site_pattern = pa.get_site_pattern(agent)
     obs_name = pa.get_agent_rule_str(agent) + '_obs'
@@ -407,28 +1066,99 @@ def get_create_observable(model, agent):
     return obs
 
 
+def get_monomer_total(model, monomer_name):
+    """Return the total initial amount of a monomer in a model.
+
+    This is the sum of the initial amounts of all species, weighted by the
+    number of times the monomer occurs in each. Since the models are closed
+    with respect to monomers, this is conserved over time unless there is
+    synthesis or degradation.
+    """
+    total = 0.0
+    for initial in model.initials:
+        count = sum(1 for mp in initial.pattern.monomer_patterns
+                    if mp.monomer.name == monomer_name)
+        if count:
+            value = initial.value
+            amount = value.get_value() if hasattr(value, 'get_value') \
+                else value.value
+            total += count * float(amount)
+    return total
+
+
+def get_obs_total(model, obs, default_total_val=100.0):
+    """Return the total amount of the monomer of an observable, or
+    default_total_val if the total is zero."""
+    monomer_name = \
+        obs.reaction_pattern.complex_patterns[0].monomer_patterns[0]\
+        .monomer.name
+    return get_monomer_total(model, monomer_name) or default_total_val
+
+
+def get_thresholds(model, obs_list, results, default_total_val=100.0):
+    """Return thresholds to discretize observables with for an ensemble.
+
+    If an observable starts low, its threshold is 30% of the total amount
+    of its monomer, otherwise it is above the start value by half the range
+    of the observable over all the results, but at least by 10% of the
+    total amount. If the total is zero, default_total_val is used instead.
+
+    Parameters
+    ----------
+    model : pysb.Model
+        The model whose initial amounts determine the totals.
+    obs_list : list[pysb.Observable]
+        The observables to get thresholds for.
+    results : TrajectoryBundle
+        The simulation results.
+
+    Returns
+    -------
+    thresholds : dict
+        The threshold of each observable by name.
+    """
+    thresholds = {}
+    for obs in obs_list:
+        total = get_obs_total(model, obs, default_total_val)
+        obs_values = results.get(obs.name)
+        start_val = numpy.mean(obs_values[:, 0])
+        # If starts low, discretize wrt total value
+        if start_val < 1e-5:
+            thresh = 0.3 * total
+        # If starts high, discretize wrt range with a certain minimum
+        else:
+            thresh = start_val + max(0.5*(numpy.max(obs_values) -
+                                          numpy.min(obs_values)),
+                                     total * 0.10)
+        thresholds[obs.name] = float(thresh)
+    return thresholds
+
+
 def pysb_to_kappa(model):
     ke = KappaExporter(model)
     kappa_model = ke.export()
     return kappa_model
 
 
+def get_kappa_export_key(model):
+    """Return a key of the components, parameter values and initial
+    conditions of a model, which change its Kappa export."""
+    return (len(model.all_components()),
+            tuple(param.value for param in model.parameters),
+            tuple((str(initial.pattern), initial.value.name)
+                  for initial in model.initials))
+
+
 def get_sim_result(kappa_plot):
-    values = kappa_plot['series']
-    i_t = kappa_plot['legend'].index('[T]')
-    values.sort(key=lambda x: x[i_t])
-    nt = len(values)
-    obs_dict = {
-        j: key.encode('utf8') for j, key in enumerate(kappa_plot['legend'])
-        if key != '[T]'
-        }
-    yobs = numpy.ndarray(nt, zip(obs_dict.values(), [float]*len(obs_dict)))
-
-    tspan = []
-    for i, value in enumerate(values):
-        tspan.append(value[i_t])
-        for j, obs in obs_dict.items():
-            yobs[obs][i] = value[j]
+    legend = kappa_plot['legend']
+    values = numpy.array(kappa_plot['series'], dtype=float)
+    values = values.reshape((-1, len(legend)))
+    i_t = legend.index('[T]')
+    values = values[numpy.argsort(values[:, i_t], kind='stable')]
+    obs_idx = [j for j, key in enumerate(legend) if key != '[T]']
+    dtype = [(legend[j], float) for j in obs_idx]
+    yobs = unstructured_to_structured(values[:, obs_idx], numpy.dtype(dtype))
+    tspan = values[:, i_t]
     return (tspan, yobs)
 
 
@@ -685,3 +1415,7 @@ class MissingMonomerSiteError(BioagentException):
 
 class SimulatorError(BioagentException):
     pass
+
+
+class InvalidSimulatorError(BioagentException):
+    pass
@@ -1,14 +1,17 @@
 import sys
 import json
+import hashlib
+import numpy
 import logging
-from kqml import KQMLList, KQMLPerformative
+from copy import deepcopy
+from kqml import KQMLList, KQMLPerformative, KQMLToken
 from indra.assemblers.pysb import assembler as pysb_assembler
-from indra.assemblers.pysb import PysbAssembler
 from indra.statements import stmts_from_json, Activation, Inhibition, \
     ActiveForm
 from indra.sources.trips import processor as trips_processor
 from bioagents.tra import tra
-from bioagents import Bioagent, BioagentException
+from bioagents import Bioagent, BioagentException, LRUCache
+from bioagents.incremental_assembly import IncrementalAssembler, get_stmt_key
 
 # This version of logging is coming from tra...
 logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
@@ -29,7 +32,8 @@ def get_bool_arg(arg_name, kwargs, default=True):
 
 class TRA_Module(Bioagent):
     name = "TRA"
-    tasks = ['SATISFIES-PATTERN', 'MODEL-COMPARE-CONDITIONS']
+    tasks = ['SATISFIES-PATTERN', 'MODEL-COMPARE-CONDITIONS',
+             'MODEL-DOSE-RESPONSE', 'MODEL-SENSITIVITY']
 
     def __init__(self, **kwargs):
         use_kappa = get_bool_arg('use_kappa', kwargs, default=False)
@@ -40,18 +44,36 @@ class TRA_Module(Bioagent):
             logger.warning('You have chosen to not use Kappa.')
 
         self.tra = tra.TRA(use_kappa, use_kappa_rest)
+        # Futures of figures to display once the reply is sent
+        self.figure_futures = []
         super(TRA_Module, self).__init__(**kwargs)
         return
 
+    def receive_request(self, msg, content):
+        """Handle request messages and respond.
+
+        Figures made while responding are rendered in the background, and
+        the display-image tells for them are sent after the reply, as soon
+        as rendering is done.
+        """
+        self.figure_futures = []
+        super(TRA_Module, self).receive_request(msg, content)
+        for fig_future in self.figure_futures:
+            fig_future.add_done_callback(self._send_rendered_figure)
+        self.figure_futures = []
+        return
+
     def respond_satisfies_pattern(self, content):
         """Return response content to satisfies-pattern request."""
         model_indra_clj = content.get('model')
         pattern_lst = content.get('pattern')
         conditions_lst = content.get('conditions')
+        simulator = content.gets('simulator')
 
         try:
             stmts = decode_indra_stmts(model_indra_clj)
             model = assemble_model(stmts)
+            model_key = get_stmts_key(stmts)
         except Exception as e:
             logger.exception(e)
             reply_content = self.make_failure('INVALID_MODEL')
@@ -86,8 +108,14 @@ class TRA_Module(Bioagent):
                 return reply_content
 
         try:
-            sat_rate, num_sim, suggestion_kqml, suggestion_obj, fig_path = \
-                self.tra.check_property(model, pattern, conditions)
+            sat_rate, sat_interval, num_sim, suggestion_kqml, \
+                suggestion_obj, fig_future = \
+                self.tra.check_property(model, pattern, conditions,
+                                        model_key, simulator)
+        except tra.InvalidSimulatorError as e:
+            logger.exception(e)
+            reply_content = self.make_failure('INVALID_SIMULATOR')
+            return reply_content
         except tra.MissingMonomerError as e:
             logger.exception(e)
             reply_content = self.make_failure('MODEL_MISSING_MONOMER')
@@ -107,11 +135,15 @@ class TRA_Module(Bioagent):
             reply_content = self.make_failure('INVALID_PATTERN')
             return reply_content
 
-        self.send_display_figure(fig_path)
+        self.send_display_figure(fig_future)
 
         reply = KQMLList('SUCCESS')
         content = KQMLList()
         content.set('satisfies-rate', '%.1f' % sat_rate)
+        interval = KQMLList()
+        interval.set('lower-bound', '%.2f' % sat_interval[0])
+        interval.set('upper-bound', '%.2f' % sat_interval[1])
+        content.set('satisfies-rate-interval', interval)
         content.set('num-sim', '%d' % num_sim)
         if suggestion_kqml:
             sugg = KQMLList.from_string(suggestion_kqml)
@@ -124,9 +156,11 @@ class TRA_Module(Bioagent):
         target_agent_clj = content.get('affected')
         model_indra_clj = content.get('model')
         up_dn = content.gets('up-dn')
+        simulator = content.gets('simulator')
         try:
             stmts = decode_indra_stmts(model_indra_clj)
             model = assemble_model(stmts)
+            model_key = get_stmts_key(stmts)
         except Exception as e:
             logger.exception(e)
             reply_content = self.make_failure('INVALID_MODEL')
@@ -143,9 +177,14 @@ class TRA_Module(Bioagent):
             logger.info('Checking %s against %s with polarity %s' %
                         (condition_agent, target_agent, up_dn))
 
-            result, fig_path = \
+            result, fig_future = \
                 self.tra.compare_conditions(model, condition_agent,
-                                            target_agent, up_dn)
+                                            target_agent, up_dn, model_key,
+                                            simulator)
+        except tra.InvalidSimulatorError as e:
+            logger.exception(e)
+            reply_content = self.make_failure('INVALID_SIMULATOR')
+            return reply_content
         except tra.MissingMonomerError as e:
             logger.exception(e)
             reply_content = self.make_failure('MODEL_MISSING_MONOMER')
@@ -161,13 +200,141 @@ class TRA_Module(Bioagent):
             reply_content = self.make_failure('KAPPA_FAILURE')
             return reply_content
 
-        self.send_display_figure(fig_path)
+        self.send_display_figure(fig_future)
 
         reply = KQMLList('SUCCESS')
         reply.set('result', result)
         return reply
 
-    def send_display_figure(self, path):
+    def respond_model_dose_response(self, content):
+        """Return response content to model-dose-response request."""
+        condition_agent_clj = content.get('agent')
+        target_agent_clj = content.get('affected')
+        model_indra_clj = content.get('model')
+        try:
+            stmts = decode_indra_stmts(model_indra_clj)
+            model = assemble_model(stmts)
+            model_key = get_stmts_key(stmts)
+        except Exception as e:
+            logger.exception(e)
+            reply_content = self.make_failure('INVALID_MODEL')
+            return reply_content
+        try:
+            condition_agent = self.get_agent(condition_agent_clj)
+            target_agent = self.get_agent(target_agent_clj)
+        except Exception as e:
+            logger.exception(e)
+            reply_content = self.make_failure('INVALID_PATTERN')
+            return reply_content
+        try:
+            multipliers = get_multipliers(content)
+        except Exception as e:
+            logger.exception(e)
+            reply_content = self.make_failure('INVALID_MULTIPLIERS')
+            return reply_content
+        try:
+            multipliers, responses, summary, fig_future = \
+                self.tra.dose_response(model, condition_agent, target_agent,
+                                       multipliers, model_key)
+        except tra.MissingMonomerError as e:
+            logger.exception(e)
+            reply_content = self.make_failure('MODEL_MISSING_MONOMER')
+            if e.monomer:
+                reply_content.set('entity', self.make_cljson(e.monomer))
+            return reply_content
+        except tra.MissingMonomerSiteError as e:
+            logger.exception(e)
+            reply_content = self.make_failure('MODEL_MISSING_MONOMER_SITE')
+            return reply_content
+        except tra.InvalidMolecularConditionError as e:
+            logger.exception(e)
+            reply_content = self.make_failure('INVALID_CONDITIONS')
+            return reply_content
+
+        self.send_display_figure(fig_future)
+
+        reply = KQMLList('SUCCESS')
+        reply.set('multipliers',
+                  KQMLList([KQMLToken('%.3g' % m) for m in multipliers]))
+        reply.set('responses',
+                  KQMLList([KQMLToken('%.3g' % r) for r in responses]))
+        reply.set('direction', summary['direction'])
+        reply.set('min-response', '%.3g' % summary['min_response'])
+        reply.set('max-response', '%.3g' % summary['max_response'])
+        if summary['ec50'] is not None:
+            reply.set('ec50', '%.3g' % summary['ec50'])
+        return reply
+
+    def respond_model_sensitivity(self, content):
+        """Return response content to model-sensitivity request."""
+        target_agent_clj = content.get('affected')
+        model_indra_clj = content.get('model')
+        num_results = content.gets('num-results')
+        try:
+            num_results = 10 if num_results is None else int(num_results)
+            if num_results < 1:
+                raise ValueError('Invalid number of results %d' %
+                                 num_results)
+        except ValueError as e:
+            logger.exception(e)
+            reply_content = self.make_failure('INVALID_NUM_RESULTS')
+            return reply_content
+        try:
+            stmts = decode_indra_stmts(model_indra_clj)
+            model = assemble_model(stmts)
+            model_key = get_stmts_key(stmts)
+        except Exception as e:
+            logger.exception(e)
+            reply_content = self.make_failure('INVALID_MODEL')
+            return reply_content
+        try:
+            target_agent = self.get_agent(target_agent_clj)
+        except Exception as e:
+            logger.exception(e)
+            reply_content = self.make_failure('INVALID_PATTERN')
+            return reply_content
+        try:
+            sensitivities = self.tra.sensitivity(model, target_agent,
+                                                 model_key=model_key)
+        except tra.MissingMonomerError as e:
+            logger.exception(e)
+            reply_content = self.make_failure('MODEL_MISSING_MONOMER')
+            if e.monomer:
+                reply_content.set('entity', self.make_cljson(e.monomer))
+            return reply_content
+        except tra.MissingMonomerSiteError as e:
+            logger.exception(e)
+            reply_content = self.make_failure('MODEL_MISSING_MONOMER_SITE')
+            return reply_content
+
+        sens_lst = KQMLList()
+        for param_name, param_type, sens in sensitivities[:num_results]:
+            entry = KQMLList()
+            entry.sets('parameter', param_name)
+            entry.sets('type', param_type)
+            entry.set('sensitivity', '%.3g' % sens)
+            sens_lst.append(entry)
+        reply = KQMLList('SUCCESS')
+        reply.set('sensitivities', sens_lst)
+        return reply
+
+    def send_display_figure(self, fig_future):
+        if fig_future is None:
+            return
+        # When testing, the figure is sent right away so that the reply
+        # remains the last message sent
+        if self.testing:
+            self._send_rendered_figure(fig_future)
+        else:
+            self.figure_futures.append(fig_future)
+
+    def _send_rendered_figure(self, fig_future):
+        try:
+            path = fig_future.result()
+        except Exception as e:
+            logger.error('Could not render figure.')
+            logger.exception(e)
+            return
         msg = KQMLPerformative('tell')
         content = KQMLList('display-image')
         content.set('type', 'simulation')
@@ -180,17 +347,43 @@ def decode_indra_stmts(stmts_clj):
     return TRA_Module.get_statement(stmts_clj)
 
 
+def get_stmts_key(stmts):
+    """Return a key of the statements that is independent of their order."""
+    stmt_keys = sorted(get_stmt_key(stmt) for stmt in stmts)
+    return hashlib.md5('\n'.join(stmt_keys).encode('utf-8')).hexdigest()
+
+
+# Models assembled for earlier requests, by statements
+model_assembler = IncrementalAssembler(policies='one_step',
+                                       default_initial=100.0)
+initialized_models = LRUCache(16)
+
+
 def assemble_model(stmts):
-    pa = PysbAssembler()
-    pa.add_statements(stmts)
-    model = pa.make_model(policies='one_step')
-    pa.add_default_initial_conditions(100.0)
+    """Return an initialized PySB model of the statements.
+
+    Initialized models are cached by the set of statements, and models of
+    statements extending an earlier set are assembled incrementally, see
+    IncrementalAssembler. The returned model can be modified by the caller.
+    """
+    stmts_key = get_stmts_key(stmts)
+    model = initialized_models.get(stmts_key)
+    if model is None:
+        model = model_assembler.assemble(stmts)
+        initialize_model(model, stmts)
+        initialized_models[stmts_key] = model
+    return deepcopy(model)
 
+
+def initialize_model(model, stmts):
+    """Set the initial conditions and parameters of a model for TRA."""
     try:
         targeted_agents = get_targeted_agents(stmts)
-        no_upstream_active_agents = get_no_upstream_active_agents(stmts)
     except:
         targeted_agents = []
+    try:
+        no_upstream_active_agents = get_no_upstream_active_agents(stmts)
+    except:
         no_upstream_active_agents = []
     try:
         chemical_agents = get_chemical_agents(stmts)
@@ -214,7 +407,6 @@ def assemble_model(stmts):
     for param in model.parameters:
         if 'kf' in param.name and 'bind' in param.name:
             param.value = param.value * 100
-    return model
 
 
 def get_targeted_agents(stmts):
@@ -259,6 +451,31 @@ def get_chemical_agents(stmts):
     return list(chemicals)
 
 
+def get_multipliers(content):
+    """Return the multipliers of a dose-response request.
+
+    The multipliers are either given explicitly as a list, or as a range
+    from min-multiplier to max-multiplier (0.01 and 100 by default) in
+    which num-points (9 by default) log-spaced values are taken.
+    """
+    multipliers_lst = content.get('multipliers')
+    if multipliers_lst is not None:
+        multipliers = [float(m.data) for m in multipliers_lst.data]
+        if not multipliers or any(m < 0 for m in multipliers):
+            raise ValueError('Invalid multipliers %s' % multipliers)
+        return multipliers
+    min_mult = content.gets('min-multiplier')
+    max_mult = content.gets('max-multiplier')
+    num_points = content.gets('num-points')
+    min_mult = 0.01 if min_mult is None else float(min_mult)
+    max_mult = 100.0 if max_mult is None else float(max_mult)
+    num_points = 9 if num_points is None else int(num_points)
+    if not 0 < min_mult < max_mult or num_points < 2:
+        raise ValueError('Invalid multiplier range')
+    return list(numpy.logspace(numpy.log10(min_mult), numpy.log10(max_mult),
+                               num_points))
+
+
 def get_molecular_entity(lst):
     description_clj = lst.get('description')
     return TRA_Module.get_agent(description_clj)
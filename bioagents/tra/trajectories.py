@@ -0,0 +1,141 @@
+"""A compact container of the simulation results of a model."""
+
+import numbers
+import numpy
+
+
+class TrajectoryBundle(object):
+    """The trajectories of the observables of a set of simulations.
+
+    The values are held in a single contiguous float32 array of shape
+    (n_sims, n_times, n_obs) on a time grid shared by all simulations.
+    The array is read-only, so slices of the bundle and the values of
+    single observables are views of it that can be shared, for instance
+    between a cache and its users, without copying.
+
+    Parameters
+    ----------
+    tspan : numpy.ndarray
+        The time points of the simulations.
+    values : numpy.ndarray
+        The values of the observables, of shape (n_sims, n_times, n_obs).
+    obs_names : list[str]
+        The names of the observables in the order of the last axis of
+        values.
+    """
+    def __init__(self, tspan, values, obs_names):
+        self.tspan = numpy.asarray(tspan, dtype=float)
+        self.values = numpy.asarray(values, dtype=numpy.float32)
+        self.values.flags.writeable = False
+        self.obs_names = list(obs_names)
+        self.obs_idx = {name: i for i, name in enumerate(self.obs_names)}
+
+    @classmethod
+    def from_results(cls, results):
+        """Return a bundle of (tspan, yobs) simulation results.
+
+        Here yobs is a structured array of observable values. If the
+        simulations were output on different time grids, their values are
+        interpolated on the union of the grids, holding the final values
+        constant.
+        """
+        tspans = [numpy.asarray(tspan, dtype=float) for tspan, _ in results]
+        obs_names = list(results[0][1].dtype.names)
+        if all(len(ts) == len(tspans[0]) and numpy.array_equal(ts, tspans[0])
+               for ts in tspans[1:]):
+            tspan = tspans[0]
+        else:
+            tspan = numpy.unique(numpy.concatenate(tspans))
+        values = numpy.empty((len(results), len(tspan), len(obs_names)),
+                             dtype=numpy.float32)
+        for i, (ts, (_, yobs)) in enumerate(zip(tspans, results)):
+            for j, name in enumerate(obs_names):
+                if len(ts) == len(tspan):
+                    values[i, :, j] = yobs[name]
+                else:
+                    values[i, :, j] = numpy.interp(tspan, ts, yobs[name])
+        return cls(tspan, values, obs_names)
+
+    @classmethod
+    def concatenate(cls, bundles):
+        """Return a bundle of the simulations of several bundles."""
+        bundles = [bundle for bundle in bundles if len(bundle)]
+        if len(bundles) == 1:
+            return bundles[0]
+        first = bundles[0]
+        if any(bundle.obs_names != first.obs_names or
+               not numpy.array_equal(bundle.tspan, first.tspan)
+               for bundle in bundles[1:]):
+            return cls.from_results([result for bundle in bundles
+                                     for result in bundle.to_results()])
+        return cls(first.tspan,
+                   numpy.concatenate([bundle.values for bundle in bundles]),
+                   first.obs_names)
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def __getitem__(self, sims):
+        """Return a bundle of the given simulations, as a view."""
+        values = self.values[sims]
+        if isinstance(sims, numbers.Integral):
+            values = values[numpy.newaxis]
+        return TrajectoryBundle(self.tspan, values, self.obs_names)
+
+    def repeat(self, num_sims):
+        """Return a view of a bundle of one simulation repeated num_sims
+        times."""
+        values = numpy.broadcast_to(self.values[:1],
+                                    (num_sims,) + self.values.shape[1:])
+        return TrajectoryBundle(self.tspan, values, self.obs_names)
+
+    @property
+    def num_times(self):
+        return len(self.tspan)
+
+    def get(self, obs_name):
+        """Return a view of the values of an observable in each simulation,
+        of shape (n_sims, n_times)."""
+        return self.values[:, :, self.obs_idx[obs_name]]
+
+    def from_time(self, min_time):
+        """Return a view of the bundle from the first time point not before
+        min_time."""
+        start_idx = numpy.searchsorted(self.tspan, min_time)
+        return TrajectoryBundle(self.tspan[start_idx:],
+                                self.values[:, start_idx:],
+                                self.obs_names)
+
+    def discretize(self, thresholds):
+        """Return whether observables are above thresholds.
+
+        Parameters
+        ----------
+        thresholds : dict
+            Thresholds by observable name. Only these observables are
+            included in the returned array.
+
+        Returns
+        -------
+        yobs_bool : numpy.ndarray
+            A structured array of shape (n_sims, n_times) with a boolean
+            field for each observable, whose rows are the discretized
+            trajectories of the simulations.
+        """
+        dtype = [(name, bool) for name in thresholds]
+        yobs_bool = numpy.empty((len(self), self.num_times), dtype=dtype)
+        for name, thresh in thresholds.items():
+            yobs_bool[name] = self.get(name) > thresh
+        return yobs_bool
+
+    def to_results(self):
+        """Return the simulations as (tspan, yobs) tuples where yobs is a
+        structured array of float values."""
+        dtype = [(name, float) for name in self.obs_names]
+        results = []
+        for sim_values in self.values:
+            yobs = numpy.empty(self.num_times, dtype=dtype)
+            for j, name in enumerate(self.obs_names):
+                yobs[name] = sim_values[:, j]
+            results.append((self.tspan.copy(), yobs))
+        return results